@@ -1,7 +1,10 @@
 from credo.asker import ask_user_for_secrets, ask_for_choice_or_new, ask_for_env, ask_user_for_saml, get_response, ask_for_choice
-from credo.errors import CantEncrypt, CantSign, BadCredential, ProgrammerError, SamlNotAuthorized, CredoError
-from credo.helper import print_list_of_tuples, make_export_commands, normalise_half_life
+from credo.errors import CantEncrypt, CantSign, BadCredential, ProgrammerError, SamlNotAuthorized, CredoError, AgentError
+from credo.shell import do_unset, print_exports, exec_with_exports, make_export_commands
+from credo.helper import print_list_of_tuples, normalise_half_life, write_aws_profiles
 from credo.structure.credentials import SamlCredentials
+from credo.agent import Agent, AgentClient
+from credo.rotation import FleetRotation
 from credo.amazon import IamPair, IamSaml
 from credo.server import Server
 from credo import structure
@@ -9,24 +12,47 @@ from credo import structure
 import requests
 import logging
 import base64
-import pickle
 import json
+import sys
 import os
 
 log = logging.getLogger("credo.actions")
 
-def do_serve(credo, port=80, host="169.254.169.254", **kwargs):
-    Server(host, port, credo).start()
+def do_serve(credo, port=None, host=None, refresh_margin=300, container=False, auth_token=None, **kwargs):
+    if not container:
+        Server(host or "169.254.169.254", port or 80, credo, refresh_margin=refresh_margin).start()
+        return
+
+    auth_token = auth_token or base64.urlsafe_b64encode(os.urandom(32)).rstrip("=")
+    server = Server(host or "127.0.0.1", port or 9911, credo, refresh_margin=refresh_margin, container=True, auth_token=auth_token)
+
+    print("# Point sdks at this server with")
+    exports = [("AWS_CONTAINER_CREDENTIALS_FULL_URI", server.container_credentials_uri()), ("AWS_CONTAINER_AUTHORIZATION_TOKEN", auth_token)]
+    for command in make_export_commands(exports):
+        print(command)
+    sys.stdout.flush()
 
-def do_switch(credo, port=80, host="169.254.169.254", **kwargs):
+    server.start()
+
+def do_switch(credo, port=80, host="169.254.169.254", role_name=None, auth_token=None, **kwargs):
     url = "http://{0}:{1}/latest/meta-data/switch/".format(host, port)
+    headers = {"Content-Type": "application/json"}
+
+    # Servers started with --container only let us switch with their auth token
+    auth_token = auth_token or os.environ.get("AWS_CONTAINER_AUTHORIZATION_TOKEN")
+    if auth_token:
+        headers["Authorization"] = auth_token
+
     chosen = credo._chosen = credo.make_chosen(rotate=False)
     if not isinstance(chosen, SamlCredentials):
         raise CredoError("Switch only supports idp roles")
 
-    request = {"credentials": chosen}
+    keys = chosen.keys
+    request = {"provider": keys.provider, "idp_username": keys.idp_username, "principal_arn": keys.role.principal_arn, "role_arn": keys.role.role_arn}
+    if role_name:
+        request["role_name"] = role_name
     while True:
-        response = requests.post(url, data=pickle.dumps(request))
+        response = requests.post(url, data=json.dumps(request), headers=headers)
         if response.status_code == 500:
             error = response.json()["error"]
             if error in ("NEED_AUTH", "BAD_PASSWORD"):
@@ -41,6 +67,41 @@ def do_switch(credo, port=80, host="169.254.169.254", **kwargs):
 
     print("{0}: {1}".format(response.status_code, response.text))
 
+def do_assume_all(credo, roles=None, workers=8, write_profiles=False, **kwargs):
+    """Assume many idp roles from one login and print a summary"""
+    chosen = credo._chosen = credo.make_chosen(rotate=False)
+    if not isinstance(chosen, SamlCredentials):
+        raise CredoError("assume_all only supports idp roles")
+
+    results = chosen.assume_many(roles=roles, workers=workers)
+
+    profiles = {}
+    print("Assumed roles")
+    for role, creds, error in results:
+        if creds is None:
+            print("  failed\t{0}\t{1}".format(role.role_arn, error))
+            continue
+
+        name = "{0}-{1}".format(role.account_id, role.role_name.replace("/", "-"))
+        profiles[name] = {"aws_access_key_id": creds.access_key, "aws_secret_access_key": creds.secret_key, "aws_session_token": creds.session_token}
+        print("  assumed\t{0}{1}".format(role.role_arn, "\tprofile={0}".format(name) if write_profiles else ""))
+
+    if write_profiles and profiles:
+        location = os.path.expanduser("~/.aws/credentials")
+        write_aws_profiles(location, profiles)
+        print("Wrote {0} profiles to {1}".format(len(profiles), location))
+
+def do_agent(credo, ttl=3600, socket_location=None, **kwargs):
+    """Run a credo agent that keeps our keys warm"""
+    Agent(socket_location, ttl=ttl).start(credo)
+
+def do_lock(credo, socket_location=None, **kwargs):
+    """Tell a running agent to forget everything it has decrypted"""
+    response = AgentClient(socket_location).request("lock")
+    if response is None:
+        raise AgentError("Couldn't find a running credo agent", location=AgentClient(socket_location).location)
+    print("Locked the credo agent")
+
 def do_current(credo, **kwargs):
     """Print out what user is currently in our environment"""
     if "AWS_ACCESS_KEY_ID" not in os.environ or "AWS_SECRET_ACCESS_KEY" not in os.environ:
@@ -58,18 +119,6 @@ def do_current(credo, **kwargs):
                 iam_pair.ask_amazon_for_username(), aliases[0], iam_pair.ask_amazon_for_account()
                 )
 
-def do_unset(credo, **kwargs):
-    """Just print out the exports and unsets necessary to unset credo exports"""
-    exports = []
-    for key, val in os.environ.items():
-        if key.startswith("CREDO_UNSET"):
-            name = key[12:]
-            exports.append((name, val))
-            exports.append((key, "CREDO_UNSET"))
-
-    for command in make_export_commands(exports):
-        print(command)
-
 def do_exports(credo, chosen=None, repository=None, half_life=None, **kwargs):
     """Just print out the chosen creds"""
     half_life = normalise_half_life(half_life or getattr(credo, "half_life", None))
@@ -80,32 +129,7 @@ def do_exports(credo, chosen=None, repository=None, half_life=None, **kwargs):
     if repository is None:
         repository = credo.chosen.credential_path.repository
 
-    shell_exports = {}
-    for key, val in chosen.shell_exports():
-        shell_exports[key] = val
-
-    if not shell_exports:
-        print("# {0} has no environment variables".format(chosen.path))
-
-    unsetters = {}
-    for key, val in shell_exports.items():
-        name = "CREDO_UNSET_{0}".format(key)
-        if key not in os.environ or os.environ[key] == val:
-            unsetters[name] = "CREDO_UNSET"
-        else:
-            unsetters[name] = os.environ[key]
-
-    print("## Find values to unset")
-    do_unset(credo)
-
-    print("\n## Values to be set now")
-    for command in make_export_commands(sorted(shell_exports.items())):
-        print(command)
-
-    print("\n## And unsetters for when we change")
-    for command in make_export_commands(sorted(unsetters.items()), no_transform=True):
-        print(command)
-
+    print_exports(chosen.shell_exports(), chosen.path)
     repository.synchronize()
 
 def do_capture(credo, env=None, remove_env=None, all_accounts=False, all_users=False, find_user=False, **kwargs):
@@ -133,33 +157,67 @@ def do_env(credo, all_accounts=False, all_users=False, find_user=False, **kwargs
 def do_synchronize(credo, **kwargs):
     """Just synchronize some repo"""
     repo_name, location = credo.find_one_repository(want_new=False)
-    structure.repository.synchronize(repo_name, location, credo.crypto)
+    structure.repository.synchronize(repo_name, location, credo.crypto, cache_dir=credo.cache_dir)
 
 def do_exec(credo, command, half_life=None, **kwargs):
     """Exec some command with aws credentials in the environment"""
     half_life = normalise_half_life(half_life or getattr(credo, "half_life", None))
     credo._chosen = credo.make_chosen(rotate=True, half_life=half_life)
 
-    environment = dict(os.environ)
-    for key, val in credo.chosen.shell_exports():
-        if val == "CREDO_UNSET":
-            if key in environment:
-                del environment[key]
-        else:
-            environment[key] = val
-    os.execvpe(command[0], command, environment)
-    credo.chosen.credential_path.repository.synchronize()
+    # We won't get to the end of the action, so commit and save what we have now
+    credo.chosen.credential_path.repository.commit_pending_changes()
+    credo.save_caches()
+    exec_with_exports(command, credo.chosen.shell_exports())
 
-def do_rotate(credo, force=False, half_life=None, **kwargs):
+def do_rotate(credo, force=False, half_life=None, rotate_all=False, workers=8, per_account=2, **kwargs):
     """Rotate some keys"""
-    log.info("Doing a rotation")
     half_life = normalise_half_life(half_life or getattr(credo, "half_life", None))
+    if rotate_all:
+        return do_rotate_all(credo, force=force, half_life=half_life, workers=workers, per_account=per_account)
+
+    log.info("Doing a rotation")
     credo.make_chosen(rotate=True, invalidate_creds=force, half_life=half_life).credential_path.repository.synchronize()
 
+def do_rotate_all(credo, force=False, half_life=None, workers=8, per_account=2):
+    """Rotate all the credentials that match our filters at the same time and print a summary"""
+    structure, chains = credo.find_credentials()
+    repositories = credo.synchronize_repositories(structure, chains)
+
+    credentials = [creds for creds in credo.credentials_from(structure, chains) if not isinstance(creds, SamlCredentials)]
+    for creds in credentials:
+        repositories[creds.credential_path.repository.name] = creds.credential_path.repository
+    for repository in repositories.values():
+        repository.pub_key_syncer.sync()
+
+    log.info("Rotating credentials\tcount=%s\tworkers=%s\tper_account=%s", len(credentials), workers, per_account)
+    results = FleetRotation(credentials, half_life=half_life, force=force, workers=workers, per_account=per_account).run()
+
+    # Saving encrypts and commits, so it's done here rather than in the workers
+    failed_saves = {}
+    for creds in credentials:
+        try:
+            creds.save(rotate=False)
+        except CredoError as error:
+            failed_saves[creds.path] = "Failed to save: {0}: {1}".format(error.__class__.__name__, error)
+
+    for repository in repositories.values():
+        repository.synchronize()
+
+    counts = {}
+    print("Rotation summary")
+    for result in results:
+        status, detail = result.status, result.detail
+        if result.path in failed_saves:
+            status, detail = "failed", failed_saves[result.path]
+        counts[status] = counts.get(status, 0) + 1
+        if status != "unchanged":
+            print("  {0}\t{1}{2}".format(status, result.path, "\t{0}".format(detail) if detail else ""))
+    print("  {0}".format(" | ".join("{0}={1}".format(status, count) for status, count in sorted(counts.items()))))
+
 def do_remote(credo, remote=None, version_with=None, **kwargs):
     """Setup remotes for some repository"""
     repo_name, location = credo.find_one_repository()
-    structure.repository.configure(repo_name, location, credo.crypto, new_remote=remote, version_with=version_with)
+    structure.repository.configure(repo_name, location, credo.crypto, new_remote=remote, version_with=version_with, cache_dir=credo.cache_dir)
 
 def do_import(credo, source=False, half_life=None, **kwargs):
     """Import some creds"""
@@ -0,0 +1,283 @@
+from credo.errors import CredoError, AgentError, NeedsInteraction
+
+import SocketServer
+import threading
+import logging
+import Queue
+import socket
+import json
+import time
+import os
+
+log = logging.getLogger("credo.agent")
+
+def default_socket_location():
+    """Where the agent listens unless we are told otherwise"""
+    return os.environ.get("CREDO_AGENT_SOCKET", os.path.expanduser("~/.credo/agent.sock"))
+
+class AgentClient(object):
+    """Knows how to ask a running agent to do things for us"""
+    def __init__(self, location=None, timeout=30):
+        if location is None:
+            location = default_socket_location()
+        self.timeout = timeout
+        self.location = location
+
+    @property
+    def available(self):
+        """Say whether there looks to be an agent"""
+        return os.path.exists(self.location)
+
+    def request(self, command, **info):
+        """
+        Send a command to the agent and return it's response as a dictionary
+
+        Return None if there is no agent or we couldn't talk to it
+        """
+        if not self.available:
+            return None
+
+        request = dict(info, command=command)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.location)
+            sock.sendall("{0}\n".format(json.dumps(request)))
+            line = sock.makefile().readline()
+        except socket.error as error:
+            log.debug("Couldn't talk to the credo agent\tlocation=%s\terror=%s", self.location, error)
+            return None
+        finally:
+            sock.close()
+
+        try:
+            return json.loads(line)
+        except ValueError as error:
+            log.debug("Credo agent gave back something that wasn't json\tlocation=%s\terror=%s", self.location, error)
+            return None
+
+    def exports(self, repo=None, account=None, user=None, half_life=None, offline=False):
+        """Return (exports, path) from the agent or None if it can't give them to us"""
+        info = dict(repo=repo, account=account, user=user, half_life=half_life)
+        if offline:
+            info["offline"] = True
+        response = self.request("exports", **info)
+        if not response or response.get("status") != "ok":
+            if response:
+                log.debug("Credo agent couldn't do exports\tstatus=%s\treason=%s", response.get("status"), response.get("error"))
+            return None
+        return [tuple(export) for export in response["exports"]], response["path"]
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+    """Reads a line of json from the client and writes a line of json back"""
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict):
+            response, after = {"status": "error", "error": "Request needs to be a json dictionary"}, None
+        else:
+            response, after = self.server.agent.handle(request)
+
+        self.wfile.write("{0}\n".format(json.dumps(response)))
+        self.wfile.flush()
+
+        if after:
+            self.server.agent.later(after)
+
+class Agent(object):
+    """
+    Keeps a Credo's crypto and the exports it has made warm in memory
+
+    Everything we know is forgotten after ttl seconds or when we are locked
+    """
+    def __init__(self, location=None, ttl=3600):
+        if location is None:
+            location = default_socket_location()
+        self.ttl = ttl
+        self.location = location
+        self.after_work = Queue.Queue()
+        self.lock()
+
+    def start(self, credo):
+        """Warm up using this credo and serve requests until interrupted"""
+        from credo.asker import non_interactive
+        self.config_file = credo.config_file_location
+
+        if os.path.exists(self.location):
+            if AgentClient(self.location).request("status") is not None:
+                raise AgentError("There is already an agent running", location=self.location)
+            os.remove(self.location)
+
+        # Requests can't ask for passwords, so unlock our private keys now and keep them for the ttl
+        if not credo.crypto.unlock():
+            log.warning("Couldn't unlock any private keys, so requests will be done without the agent")
+        self.remember_crypto(credo.crypto)
+
+        dirname = os.path.dirname(self.location)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        original_umask = os.umask(0o077)
+        try:
+            server = SocketServer.UnixStreamServer(self.location, AgentRequestHandler)
+        finally:
+            os.umask(original_umask)
+        server.agent = self
+
+        # Nothing in the agent may ask questions, whichever thread it's in
+        log.info("Credo agent listening\tlocation=%s\tttl=%s", self.location, self.ttl)
+        try:
+            with non_interactive():
+                worker = threading.Thread(target=self.do_after_work)
+                worker.daemon = True
+                worker.start()
+                server.serve_forever()
+        finally:
+            server.server_close()
+            if os.path.exists(self.location):
+                os.remove(self.location)
+
+    def later(self, after):
+        """Do this after work in the background so it doesn't hold up other requests"""
+        self.after_work.put(after)
+
+    def do_after_work(self):
+        """Do the after work for requests one at a time"""
+        while True:
+            after = self.after_work.get()
+            try:
+                after()
+            except CredoError as error:
+                log.error("Failed to finish a request\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            except Exception as error:
+                log.exception("Failed to finish a request\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            finally:
+                self.after_work.task_done()
+
+    def lock(self):
+        """Forget everything we have decrypted"""
+        self.crypto = None
+        self.crypto_time = None
+        self.chosen = {}
+
+    def expired(self, created):
+        """Say whether something we made at this time is too old to keep"""
+        return created is None or time.time() - created > self.ttl
+
+    def remember_crypto(self, crypto):
+        """Hold onto this crypto object"""
+        self.crypto = crypto
+        self.crypto_time = time.time()
+
+    def handle(self, request):
+        """Return (response, after) for this request, where after is something to do after responding"""
+        request = dict(request)
+        command = request.pop("command", None)
+        handler = getattr(self, "handle_{0}".format(command), None)
+        if handler is None:
+            return {"status": "error", "error": "Unknown command {0}".format(command)}, None
+
+        try:
+            return handler(**request)
+        except NeedsInteraction as error:
+            return {"status": "fallback", "error": str(error)}, None
+        except CredoError as error:
+            log.error("Failed to handle a request\tcommand=%s\terror_type=%s\terror=%s", command, error.__class__.__name__, error)
+            return {"status": "error", "error_type": error.__class__.__name__, "error": str(error)}, None
+
+    def handle_status(self):
+        """Say what we have warm"""
+        return {"status": "ok", "pid": os.getpid(), "ttl": self.ttl, "unlocked": self.crypto is not None, "cached": len(self.chosen)}, None
+
+    def handle_lock(self):
+        """Forget what we know"""
+        log.info("Locking the agent")
+        self.lock()
+        return {"status": "ok"}, None
+
+    def handle_exports(self, repo=None, account=None, user=None, half_life=None, offline=False):
+        """Return the exports for the chosen credentials"""
+        from credo.structure.repository import batched_changes
+        from credo.structure.credentials import SamlCredentials
+        from credo.connections import offline_mode
+        from credo.helper import normalise_half_life
+        from credo.asker import non_interactive
+
+        if self.expired(self.crypto_time):
+            self.lock()
+
+        key = (repo, account, user, half_life)
+        if key in self.chosen:
+            created, exports, path = self.chosen[key]
+            if not self.expired(created):
+                return {"status": "ok", "exports": exports, "path": path}, None
+            self.chosen.pop(key, None)
+
+        with non_interactive(), batched_changes():
+            credo = self.make_credo(repo=repo, account=account, user=user)
+            offline = offline or credo.stay_offline
+            with offline_mode(offline):
+                credo.deferred_rotations = []
+                half_life = normalise_half_life(half_life or getattr(credo, "half_life", None))
+                chosen = credo.make_chosen(rotate=True, half_life=half_life)
+                exports = chosen.shell_exports()
+
+        # Saml sessions expire on their own schedule and the session cache already knows when
+        if not isinstance(chosen, SamlCredentials):
+            self.chosen[key] = (time.time(), exports, chosen.path)
+        response = {"status": "ok", "exports": exports, "path": chosen.path}
+
+        repository = chosen.credential_path.repository
+        def after():
+            credo.save_caches()
+
+            # Nothing else to do until we are online again
+            if offline:
+                return
+
+            # We are the background, so rotate after responding rather than asking ourselves to
+            if credo.deferred_rotations:
+                _, rotate = self.handle_rotate(repo=credo.repo, account=credo.account, user=credo.user, half_life=credo.deferred_rotations[0])
+                rotate()
+            else:
+                repository.synchronize(in_background=False)
+        return response, after
+
+    def handle_rotate(self, repo=None, account=None, user=None, half_life=None):
+        """Rotate the keys for these credentials after responding"""
+        from credo.background import rotate_credentials
+
+        def rotate():
+            credo = self.make_credo(repo=repo, account=account, user=user)
+            chosen = rotate_credentials(credo, half_life=half_life)
+            self.forget(chosen.path)
+        return {"status": "ok"}, rotate
+
+    def forget(self, path):
+        """Forget the exports we made for this path"""
+        for key, (_, _, chosen_path) in list(self.chosen.items()):
+            if chosen_path == path:
+                self.chosen.pop(key, None)
+
+    def handle_sync(self, location):
+        """Synchronize the repository at this location after responding"""
+        from credo.background import synchronize_location
+        if not os.path.isdir(location):
+            return {"status": "error", "error": "No repository at {0}".format(location)}, None
+        return {"status": "ok"}, lambda: synchronize_location(location)
+
+    def make_credo(self, **options):
+        """Make a Credo object that shares our crypto"""
+        from credo.overview import Credo
+
+        credo = Credo()
+        credo.setup(config_file=self.config_file, **options)
+        if self.crypto is None:
+            self.remember_crypto(credo.crypto)
+        else:
+            credo._crypto = self.crypto
+        return credo
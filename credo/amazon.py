@@ -1,6 +1,7 @@
-from credo.errors import BadSamlProvider, CredoError, SamlNotAuthorized
+from credo.errors import BadSamlProvider, CredoError, SamlNotAuthorized, Offline
 from credo.asker import ask_user_for_half_life
 from credo.cred_types.saml import SamlRole
+from credo import connections
 
 from boto.iam.connection import IAMConnection
 from boto.sts.connection import STSConnection
@@ -10,9 +11,10 @@ import xml.etree.ElementTree as ET
 from textwrap import dedent
 import requests
 import xml.sax
-import httplib
+import threading
 import logging
 import base64
+import Queue
 import time
 import uuid
 import boto
@@ -152,7 +154,9 @@ class IamBase(object):
 ########################
 
 class IamPair(IamBase):
-    def __init__(self, aws_access_key_id, aws_secret_access_key, aws_security_token=None, create_epoch=None, half_life=None):
+    def __init__(self, aws_access_key_id, aws_secret_access_key, aws_security_token=None, create_epoch=None, half_life=None, identity_cache=None, key_info_digest=None):
+        self.identity_cache = identity_cache
+        self.key_info_digest = key_info_digest
         self.aws_access_key_id = aws_access_key_id
         self.aws_security_token = aws_security_token
         self.aws_secret_access_key = aws_secret_access_key
@@ -171,7 +175,26 @@ class IamPair(IamBase):
         self._works
         self.username
         self.account_id
+
+        Use what our identity_cache remembers if we haven't asked amazon yet
         """
+        if getattr(self, "_got_user", None) is None and self.identity_cache is not None:
+            entry = self.identity_cache.lookup(self.aws_access_key_id, self.aws_secret_access_key, any_age=connections.is_offline())
+            if entry:
+                log.debug("Using cached account id and username\taccess_key=%s", self.aws_access_key_id)
+                self._invalid = False
+                self._works = True
+                self._got_user = True
+                self.username = entry["username"]
+                self.account_id = entry["account_id"]
+                self.account_aliases = entry["aliases"]
+                if not self._create_epoch and entry["create_epoch"]:
+                    self._create_epoch = entry["create_epoch"]
+                return
+
+        if connections.is_offline():
+            raise Offline("Can't ask amazon about keys we haven't verified before", access_key=self.aws_access_key_id)
+
         try:
             if getattr(self, "_got_user", None) is None or not get_cached:
                 log.info("Asking amazon for account id and username\taccess_key=%s", self.aws_access_key_id)
@@ -185,10 +208,15 @@ class IamPair(IamBase):
                 # arn is arn:aws:iam::<account_id>:<other>
                 self.account_id = details["arn"].split(":")[4]
                 self.account_aliases = aliases
+
+                if self.identity_cache is not None:
+                    self.identity_cache.record(self.aws_access_key_id, self.aws_secret_access_key, self.account_id, self.username, self.account_aliases, create_epoch=self._create_epoch)
         except boto.exception.BotoServerError as error:
             self._works = False
             self._got_user = False
             self._connection = None
+            if self.identity_cache is not None:
+                self.identity_cache.forget(self.aws_access_key_id, key_info_digests=[self.key_info_digest] if self.key_info_digest else [])
             if error.status == 403 and error.code in ("InvalidClientTokenId", "SignatureDoesNotMatch"):
                 self._invalid = True
                 if not quiet:
@@ -249,7 +277,7 @@ class FixedSTSConnection(STSConnection):
     assume_role_with_saml seems broken because it puts the assertion in the query parameters.
     awscli puts it in the POST data and isn't broken, so lets do that here as well.
     """
-    def assume_role_with_saml(self, role_arn, principal_arn, saml_assertion, policy=None, duration_seconds=None):
+    def assume_role_with_saml(self, role_arn, principal_arn, saml_assertion, policy=None, duration_seconds=None, deadline=None):
         data = {
             'RoleArn': role_arn,
             'PrincipalArn': principal_arn,
@@ -261,7 +289,7 @@ class FixedSTSConnection(STSConnection):
             data['DurationSeconds'] = duration_seconds
 
         params = {"Action": "AssumeRoleWithSAML", "Version": self.APIVersion}
-        response = requests.post("https://{0}".format(self.host), headers={"User-Agent": boto.UserAgent}, params=params, data=data)
+        response = connections.post("https://{0}".format(self.host), headers={"User-Agent": boto.UserAgent}, params=params, data=data, deadline=deadline)
 
         if response.status_code == 200:
             obj = AssumedRole(self)
@@ -300,9 +328,9 @@ class IamSaml(IamBase):
             self._get_info()
         return self._assertion
 
-    def _get_info(self, get_cached=False, quiet=False):
+    def _get_info(self, get_cached=False, quiet=False, deadline=None):
         """
-        Authenticate against the provided username and password
+        Authenticate against the provided username and password within this connections.Deadline
 
         Create some variables:
             idpid = your idp entity id
@@ -313,14 +341,20 @@ class IamSaml(IamBase):
         And then make a soap request with base64 encoded ldap username and password
         and get back the authentication string
         """
+        if connections.is_offline():
+            raise Offline("Can't log into the saml provider", provider=self.provider)
+
         idpid = "https://{0}/idp/shibboleth".format(self.provider)
         rpid = "urn:amazon:webservices"
         acsurl = "https://signin.aws.amazon.com/saml"
         acsurlbinding = "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
 
         tree = None
-        tree_body = None
-        for _ in range(5):
+        url = "https://{0}/idp/profile/SAML2/SOAP/ECP".format(self.provider)
+        if deadline is None:
+            deadline = connections.Deadline()
+
+        for attempt in connections.backoff(deadline=deadline):
             now = (datetime.utcnow() - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%S")
             ident = uuid.uuid1().hex
             envelope = dedent("""
@@ -346,28 +380,33 @@ class IamSaml(IamBase):
             </S:Envelope>
             """).format(acsurl=acsurl, acsurlbinding=acsurlbinding, ident=ident, now=now, idpid=idpid, rpid=rpid)
 
-            headers = {"Accept": "*/*", "Authorization": "Basic {0}".format(self.basic_auth), "Content-Type": "application/x-www-form-urlencoded", "Content-Length": len(envelope)}
-            connection = httplib.HTTPSConnection(self.provider, 443)
-            connection.request("POST", "/idp/profile/SAML2/SOAP/ECP", envelope, headers)
-            resp = connection.getresponse()
+            headers = {"Accept": "*/*", "Authorization": "Basic {0}".format(self.basic_auth), "Content-Type": "application/x-www-form-urlencoded"}
+            try:
+                resp = connections.session().post(url, data=envelope, headers=headers, timeout=deadline.timeout())
+            except requests.exceptions.RequestException as error:
+                log.info("Failed to talk to the saml provider, trying again\tattempt=%s\terror_type=%s\terror=%s", attempt, error.__class__.__name__, error)
+                self._works = False
+                continue
 
-            if resp.status == 401:
+            if resp.status_code == 401:
                 log.info("Not authorized, perhaps you entered the wrong password")
                 self._works = False
                 raise SamlNotAuthorized()
-            elif resp.status != 200:
-                log.info("Failed to authenticate, trying again in 5 seconds")
-                time.sleep(5)
+            elif resp.status_code != 200:
+                log.info("Failed to authenticate, trying again\tattempt=%s\tstatus=%s", attempt, resp.status_code)
                 self._works = False
             else:
-                body = resp.read()
-                tree = ET.fromstring(body)
-                tree_body = tree.find("{http://schemas.xmlsoap.org/soap/envelope/}Body")
-                if tree_body is None:
-                    log.info("Failed to authenticate, saml provider didn't return any soap. Trying again in 5 seconds")
-                    time.sleep(5)
+                body = resp.content
+                try:
+                    parsed = ET.fromstring(body)
+                except ET.ParseError:
+                    parsed = None
+
+                if parsed is None or parsed.find("{http://schemas.xmlsoap.org/soap/envelope/}Body") is None:
+                    log.info("Failed to authenticate, saml provider didn't return any soap. Trying again\tattempt=%s", attempt)
                     self._works = False
                 else:
+                    tree = parsed
                     self._works = True
                     break
 
@@ -383,13 +422,22 @@ class IamSaml(IamBase):
 
     def exports(self, role):
         """Get exports for this account"""
+        return self.exports_for(self.session(role))
+
+    def session(self, role):
+        """Log in if we need to and assume this role, all within one deadline, and return the sts credentials"""
+        deadline = connections.Deadline()
+        if not getattr(self, "_arns", None):
+            self._get_info(deadline=deadline)
+
         if role.role_arn not in [r.role_arn for r in self.arns]:
             raise CredoError("Your user doesn't have specified account anymore"
                 , username=self.keys.idp_username, provider=self.keys.provider, wanted=self.keys.role.role_arn
                 )
+        return self.get_result(role, deadline=deadline).credentials
 
-        result = self.get_result(role)
-        creds = result.credentials
+    def exports_for(self, creds):
+        """Return exports for these sts credentials"""
         return [
               ("AWS_ACCESS_KEY_ID", creds.access_key)
             , ("AWS_SECRET_ACCESS_KEY", creds.secret_key)
@@ -398,7 +446,55 @@ class IamSaml(IamBase):
             , ("AWS_SECURITY_TOKEN", creds.session_token)
             ]
 
-    def get_result(self, role):
-        """Get back the sts assume result"""
-        return self.connection.assume_role_with_saml(role.role_arn, role.principal_arn, self.assertion, duration_seconds=3600)
+    def get_result(self, role, connection=None, deadline=None):
+        """Get back the sts assume result, logging in first if we need to, all within one deadline"""
+        connection = connection or self.connection
+        if deadline is None:
+            deadline = connections.Deadline()
+        if not getattr(self, "_assertion", None):
+            self._get_info(deadline=deadline)
+        return connection.assume_role_with_saml(role.role_arn, role.principal_arn, self.assertion, duration_seconds=3600, deadline=deadline)
+
+    def sessions(self, roles=None, workers=8):
+        """
+        Assume many roles with the one assertion and return [(role, credentials, error)]
+
+        Roles defaults to every role the idp says we have, and each worker gets
+        it's own sts connection.
+        """
+        roles = list(self.arns if roles is None else roles)
+        assertion = self.assertion
+
+        jobs = Queue.Queue()
+        for role in roles:
+            jobs.put(role)
+
+        results = []
+        def worker():
+            connection = FixedSTSConnection(anon=True)
+            while True:
+                try:
+                    role = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    creds = connection.assume_role_with_saml(role.role_arn, role.principal_arn, assertion, duration_seconds=3600).credentials
+                    results.append((role, creds, None))
+                except boto.exception.BotoServerError as error:
+                    results.append((role, None, "{0}: {1}".format(error.__class__.__name__, error.message or error.reason)))
+                except Exception as error:
+                    log.exception("Unexpected error assuming role\trole=%s", role.role_arn)
+                    results.append((role, None, "{0}: {1}".format(error.__class__.__name__, error)))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(max(1, workers), len(roles)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with a timeout so ctrl-c still works
+            while thread.is_alive():
+                thread.join(1)
+
+        return sorted(results, key=lambda result: result[0].role_arn)
 
@@ -1,5 +1,6 @@
-from credo.errors import BadConfigFile, BadSSHKey, BadCredentialSource, ProgrammerError, UserQuit
+from credo.errors import BadConfigFile, BadSSHKey, BadCredentialSource, ProgrammerError, UserQuit, NeedsInteraction
 
+from contextlib import contextmanager
 from collections import OrderedDict
 from itertools import chain
 import ConfigParser
@@ -12,8 +13,25 @@ import os
 
 log = logging.getLogger("credo.asker")
 
+# Whether get_response may ask the user anything
+interactive = True
+
+@contextmanager
+def non_interactive():
+    """Make get_response complain instead of waiting for a user that isn't there"""
+    global interactive
+    original = interactive
+    interactive = False
+    try:
+        yield
+    finally:
+        interactive = original
+
 def get_response(*messages, **kwargs):
     """Get us a response from the user"""
+    if not interactive:
+        raise NeedsInteraction(messages=messages, prompt=kwargs.get("prompt"))
+
     password = kwargs.get("password", False)
     if password:
         prompt = kwargs.get("prompt", ":")
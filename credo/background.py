@@ -0,0 +1,243 @@
+"""
+Things credo does in a detached process so the command that wanted them done
+can return straight away.
+
+Used as ``python -m credo.background <task> <arguments>``
+"""
+from credo.errors import CredoError, Offline, RepoError
+
+import subprocess
+import argparse
+import logging
+import time
+import sys
+import os
+
+log = logging.getLogger("credo.background")
+
+def run_detached(args, log_location=None):
+    """
+    Run ``python -m credo.background <args>`` in it's own session and return whether it started
+
+    Output goes to log_location if we have one, otherwise it is thrown away
+    """
+    command = [sys.executable, "-m", "credo.background"] + list(args)
+    devnull = open(os.devnull, "r+")
+    output = devnull
+    try:
+        if log_location:
+            try:
+                output = open(log_location, "a")
+            except (IOError, OSError) as error:
+                log.debug("Couldn't open background log\tlocation=%s\terror=%s", log_location, error)
+
+        subprocess.Popen(command, stdin=devnull, stdout=output, stderr=subprocess.STDOUT, close_fds=True, cwd="/", preexec_fn=os.setsid)
+        return True
+    except OSError as error:
+        log.warning("Failed to start background process\tcommand=%s\terror=%s", " ".join(command), error)
+        return False
+    finally:
+        if output is not devnull:
+            output.close()
+        devnull.close()
+
+def synchronize(location, log_location=None):
+    """Get the repository at this location synchronized by the agent or a detached process"""
+    from credo.agent import AgentClient
+    response = AgentClient(timeout=5).request("sync", location=location)
+    if response and response.get("status") == "ok":
+        log.debug("Credo agent is synchronizing\tlocation=%s", location)
+        return True
+
+    log.debug("Synchronizing in the background\tlocation=%s", location)
+    return run_detached(["sync", location], log_location=log_location)
+
+def read_scheduled(cache_dir):
+    """Return {name: when} for what we have scheduled"""
+    from credo.helper import read_json_file
+    scheduled = read_json_file(os.path.join(cache_dir, "scheduled.json"), {})
+    if not isinstance(scheduled, dict):
+        scheduled = {}
+    return scheduled
+
+def write_scheduled(cache_dir, scheduled):
+    """Write out {name: when} for what we have scheduled"""
+    from credo.helper import write_json_atomically
+    location = os.path.join(cache_dir, "scheduled.json")
+    try:
+        write_json_atomically(location, scheduled)
+    except (IOError, OSError) as error:
+        log.warning("Failed to record what we scheduled\tlocation=%s\terror=%s", location, error)
+
+def scheduled_recently(cache_dir, name, within):
+    """Say whether we scheduled something with this name in the last within seconds"""
+    return time.time() - read_scheduled(cache_dir).get(name, 0) < within
+
+def record_scheduled(cache_dir, name, within):
+    """Record that we scheduled something with this name just now, forgetting anything older than within seconds"""
+    now = time.time()
+    scheduled = dict((key, val) for key, val in read_scheduled(cache_dir).items() if now - val < within)
+    scheduled[name] = now
+    write_scheduled(cache_dir, scheduled)
+
+def forget_scheduled(cache_dir, name):
+    """Forget we scheduled something with this name so it can be scheduled again straight away"""
+    scheduled = read_scheduled(cache_dir)
+    if name in scheduled:
+        del scheduled[name]
+        write_scheduled(cache_dir, scheduled)
+
+def rotate_name(repo, account, user):
+    """Return what we record a rotation for these credentials as"""
+    return "rotate|{0}|{1}|{2}".format(repo, account, user)
+
+def rotate(config_file, repo, account, user, half_life=None, cache_dir=None, retry_after=600):
+    """
+    Get these credentials rotated by the agent or a detached process
+
+    Unless we already asked for that in the last retry_after seconds
+    """
+    log_location = None
+    name = rotate_name(repo, account, user)
+    if cache_dir:
+        log_location = os.path.join(cache_dir, "background.log")
+        if scheduled_recently(cache_dir, name, retry_after):
+            log.info("Rotation was already scheduled recently, see %s for how it went\trepo=%s\taccount=%s\tuser=%s", log_location, repo, account, user)
+            return True
+
+    from credo.agent import AgentClient
+    response = AgentClient(timeout=5).request("rotate", repo=repo, account=account, user=user, half_life=half_life)
+    if response and response.get("status") == "ok":
+        log.info("Credo agent is rotating keys\trepo=%s\taccount=%s\tuser=%s", repo, account, user)
+        started = True
+    else:
+        log.info("Rotating keys in the background\trepo=%s\taccount=%s\tuser=%s", repo, account, user)
+        args = ["rotate", "--repo", repo, "--account", account, "--user", user]
+        if config_file:
+            args.extend(["--config", config_file])
+        if half_life:
+            args.extend(["--half-life", str(half_life)])
+        started = run_detached(args, log_location=log_location)
+
+    if started and cache_dir:
+        record_scheduled(cache_dir, name, retry_after)
+    return started
+
+def refresh_pems(cache_location, urls, retry_after=300):
+    """
+    Get the pems from these urls refreshed in the pem cache by a detached process
+
+    Unless we already asked for that in the last retry_after seconds
+    """
+    cache_dir = os.path.dirname(cache_location)
+    name = "pems|{0}".format(",".join(sorted(urls)))
+    if scheduled_recently(cache_dir, name, retry_after):
+        log.debug("Refreshing pems was already scheduled\turls=%s", ",".join(urls))
+        return True
+
+    log.info("Refreshing pems in the background\turls=%s", ",".join(urls))
+    started = run_detached(["pems", cache_location] + list(urls), log_location=os.path.join(cache_dir, "background.log"))
+    if started:
+        record_scheduled(cache_dir, name, retry_after)
+    return started
+
+def refresh_pem_cache(cache_location, urls):
+    """Refresh the pems from these urls in the pem cache at this location"""
+    from credo.pub_keys import PemCache
+    cache = PemCache(cache_location)
+    cache.refresh(urls)
+    cache.save()
+
+def rotate_credentials(credo, half_life=None):
+    """Rotate the chosen credentials for this credo without asking anyone anything and return them"""
+    from credo.structure.repository import batched_changes
+    from credo.asker import non_interactive
+
+    try:
+        with non_interactive(), batched_changes():
+            chosen = credo.make_chosen(rotate=True, half_life=half_life, background_rotation=False)
+        chosen.credential_path.repository.synchronize(in_background=False)
+    finally:
+        credo.save_caches()
+    return chosen
+
+def is_transient(error):
+    """Say whether this error is likely to go away if we try again soon"""
+    from credo.rotation import FleetRotation
+    import requests
+    import socket
+    import boto
+
+    if isinstance(error, (Offline, RepoError, requests.exceptions.RequestException, socket.error)):
+        return True
+    return isinstance(error, boto.exception.BotoServerError) and (error.status >= 500 or error.status == 429 or error.code in FleetRotation.throttled_codes)
+
+def synchronize_location(location):
+    """Synchronize the repository at this location without asking anyone anything"""
+    from credo.versioning import determine_driver
+    from credo.asker import non_interactive
+
+    try:
+        with non_interactive():
+            determine_driver(location).synchronize()
+    except CredoError as error:
+        log.error("Failed to synchronize\tlocation=%s\terror_type=%s\terror=%s", location, error.__class__.__name__, error)
+        return False
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Things credo does in the background")
+    subparsers = parser.add_subparsers(dest="task")
+
+    sync_parser = subparsers.add_parser("sync", help="Synchronize a repository with it's remote")
+    sync_parser.add_argument("location", help="Location of the repository")
+
+    rotate_parser = subparsers.add_parser("rotate", help="Rotate the keys for some credentials")
+    rotate_parser.add_argument("--config", dest="config_file", default=None, help="Location of the credo config file")
+    rotate_parser.add_argument("--repo", required=True, help="The repository of the credentials")
+    rotate_parser.add_argument("--account", required=True, help="The account of the credentials")
+    rotate_parser.add_argument("--user", required=True, help="The user of the credentials")
+    rotate_parser.add_argument("--half-life", dest="half_life", type=int, default=None, help="Half life for new keys")
+
+    pems_parser = subparsers.add_parser("pems", help="Refresh the cache of pems we got from urls")
+    pems_parser.add_argument("cache_location", help="Location of the pem cache")
+    pems_parser.add_argument("urls", nargs="+", help="The urls to refresh")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(process)d %(levelname)-7s %(name)-15s %(message)s", level=logging.INFO)
+
+    if args.task == "sync":
+        if not synchronize_location(args.location):
+            sys.exit(1)
+
+    elif args.task == "pems":
+        refresh_pem_cache(args.cache_location, args.urls)
+
+    elif args.task == "rotate":
+        from credo.overview import Credo
+        credo = Credo()
+        try:
+            if args.config_file:
+                credo.setup(config_file=args.config_file, repo=args.repo, account=args.account, user=args.user)
+            else:
+                credo.setup(repo=args.repo, account=args.account, user=args.user)
+        except CredoError as error:
+            log.error("Failed to setup credo\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            sys.exit(1)
+
+        try:
+            rotate_credentials(credo, half_life=args.half_life)
+        except Exception as error:
+            if isinstance(error, CredoError):
+                log.error("Failed to rotate\trepo=%s\taccount=%s\tuser=%s\terror_type=%s\terror=%s", args.repo, args.account, args.user, error.__class__.__name__, error)
+            else:
+                log.exception("Failed to rotate\trepo=%s\taccount=%s\tuser=%s", args.repo, args.account, args.user)
+
+            # Let the next command try again rather than waiting out retry_after
+            # Other errors (like needing a password) won't go away by trying again straight away
+            if is_transient(error):
+                forget_scheduled(credo.cache_dir, rotate_name(args.repo, args.account, args.user))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Http connections credo makes to idps and sts
+
+Everything goes through one requests session so connections are kept alive
+and reused instead of doing a tcp and tls handshake for every request.
+"""
+from credo.errors import Offline
+
+from contextlib import contextmanager
+import threading
+import requests
+import logging
+import random
+import time
+
+log = logging.getLogger("credo.connections")
+
+pool_size = 10
+default_timeout = 30
+default_deadline = 15
+
+_session = None
+_session_lock = threading.Lock()
+
+# Whether credo should stay off the network and use what it has locally
+# Kept per thread so an offline request to the agent doesn't affect its background work
+_state = threading.local()
+
+def is_offline():
+    """Say whether this thread should stay off the network"""
+    return getattr(_state, "offline", False)
+
+@contextmanager
+def offline_mode(enabled=True):
+    """Make credo use what it has locally instead of talking to anything over the network"""
+    original = is_offline()
+    _state.offline = enabled
+    try:
+        yield
+    finally:
+        _state.offline = original
+
+def session():
+    """Return the shared requests session, making it if we haven't yet"""
+    global _session
+    if is_offline():
+        raise Offline("Not talking to the network in offline mode")
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+class Deadline(object):
+    """When some requests and all their retries have to be done by"""
+    def __init__(self, seconds=None):
+        self.give_up_at = time.time() + (default_deadline if seconds is None else seconds)
+
+    def remaining(self):
+        """Return how many seconds we have left"""
+        return self.give_up_at - time.time()
+
+    def timeout(self, timeout=None):
+        """Return the timeout for the next request, which is what we have left but at least a second"""
+        return max(1, min(timeout or default_timeout, self.remaining()))
+
+def backoff(attempts=5, base=0.5, cap=4, deadline=None):
+    """
+    Yield attempt numbers, sleeping with exponential backoff and jitter before every attempt after the first
+
+    Stops after attempts, or earlier if waiting again would take us past the
+    deadline, which is default_deadline seconds from now unless given.
+    """
+    if deadline is None:
+        deadline = Deadline()
+
+    for attempt in range(attempts):
+        if attempt > 0:
+            wait = random.uniform(0, min(cap, base * (2 ** attempt)))
+            if wait > deadline.remaining():
+                log.info("Giving up, out of time for retries\tattempts=%s", attempt)
+                return
+            time.sleep(wait)
+        yield attempt
+
+def post(url, retry_statuses=(500, 502, 503, 504), deadline=None, timeout=None, **kwargs):
+    """
+    Post to this url with the shared session, retrying connection errors and retry_statuses
+
+    Every attempt and the waits between them fit in the one deadline.
+
+    Returns the last response we got, or raises the last connection error if we never got one
+    """
+    if deadline is None:
+        deadline = Deadline()
+
+    response = None
+    error = None
+    for attempt in backoff(deadline=deadline):
+        try:
+            response = session().post(url, timeout=deadline.timeout(timeout), **kwargs)
+            error = None
+        except requests.exceptions.RequestException as err:
+            log.info("Failed to talk to the server\turl=%s\tattempt=%s\terror_type=%s\terror=%s", url, attempt, err.__class__.__name__, err)
+            error = err
+            continue
+
+        if response.status_code not in retry_statuses:
+            return response
+        log.info("Server had a problem\turl=%s\tattempt=%s\tstatus=%s", url, attempt, response.status_code)
+
+    if response is None and error is not None:
+        raise error
+    return response
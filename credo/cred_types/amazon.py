@@ -2,7 +2,10 @@ from credo.errors import BadCredentialFile, NoCredentialsFound, BadCredential, U
 from credo.asker import ask_user_for_half_life, ask_for_choice_or_new
 from credo.amazon import IamPair
 
+import hashlib
 import logging
+import json
+import time
 import sys
 
 log = logging.getLogger("credo.cred_types.amazon")
@@ -61,14 +64,22 @@ class AmazonKey(object):
 
     def basic_validation(self):
         """Make sure the keys have basic requirements"""
-        if "fingerprints" not in self.key_info:
-            return "No fingerprints for this key"
-        if not isinstance(self.fingerprints, dict):
-            return "Fingerprints for this key are not a dictionary"
-        if not self.crypto.decryptable(self.fingerprints):
+        if self.key_info.get("envelope") is not None:
+            envelope = self.key_info["envelope"]
+            if not isinstance(envelope, dict) or not isinstance(envelope.get("secrets"), dict):
+                return "Envelope for this key is not a dictionary with secrets"
+            if not all(attr in envelope for attr in ("data", "verifier")):
+                return "Envelope for this key doesn't contain data and verifier"
+        else:
+            if "fingerprints" not in self.key_info:
+                return "No fingerprints for this key"
+            if not isinstance(self.fingerprints, dict):
+                return "Fingerprints for this key are not a dictionary"
+            if any(not all(attr in value for attr in ("secret", "data", "verifier")) for value in self.fingerprints.values()):
+                return "One or more of the fingeprints doesn't contain secret, data and verifier"
+
+        if not self.crypto.decryptable_values(self.key_info):
             return "No private key can decrypt secrets"
-        if any(not all(attr in value for attr in ("secret", "data", "verifier")) for value in self.fingerprints.values()):
-            return "One or more of the fingeprints doesn't contain secret, data and verifier"
 
     @property
     def fingerprints(self):
@@ -84,7 +95,7 @@ class AmazonKey(object):
                 yield key
             return
 
-        decrypted = self.crypto.decrypt_by_fingerprint(self.fingerprints, self.verifier)
+        decrypted = self.crypto.decrypt_values(self.key_info, self.verifier)
         if decrypted:
             yield decrypted["aws_access_key_id"], decrypted["aws_secret_access_key"]
 
@@ -97,26 +108,60 @@ class AmazonKey(object):
                 break
         return getattr(self, "_iam_pair", None)
 
+    @property
+    def info_digest(self):
+        """Return a hash of our key_info that identifies this key without decrypting it"""
+        identifying = [self.key_info.get(name) or None for name in ("envelope", "fingerprints", "create_epoch", "half_life")]
+        return hashlib.sha256(json.dumps(identifying, sort_keys=True)).hexdigest()
+
+    def past_half_life_from_metadata(self):
+        """
+        Say whether this key is past it's half life using only the unencrypted parts of key_info
+
+        Return None if we can't tell without decrypting, which is when we have
+        already decrypted it, key_info doesn't have create_epoch and half_life,
+        or the identity cache hasn't seen this key work recently.
+        """
+        if getattr(self, "_iam_pair", None) is not None:
+            return None
+
+        create_epoch = self.key_info.get("create_epoch")
+        half_life = self.key_info.get("half_life")
+        if not isinstance(create_epoch, (int, long, float)) or not isinstance(half_life, (int, long, float)):
+            return None
+
+        identity_cache = getattr(self.credential_path, "identity_cache", None)
+        if identity_cache is None or not identity_cache.key_info_verified(self.info_digest):
+            return None
+
+        return time.time() - create_epoch > half_life
+
+    @property
+    def secret_fingerprints(self):
+        """Return the fingerprints this key is encrypted for"""
+        return self.crypto.fingerprints_for_values(self.key_info)
+
     def make_iam_pair(self, access_key, secret_key, half_life=None):
         """Make an iam pair, or get cached pair"""
         if (access_key, secret_key) not in self.iam_pairs:
             if half_life is None:
                 half_life = self.key_info.get("half_life")
-            iam_pair = IamPair(access_key, secret_key, create_epoch=self.key_info.get("create_epoch"), half_life=half_life)
+            identity_cache = getattr(self.credential_path, "identity_cache", None)
+            iam_pair = IamPair(access_key, secret_key, create_epoch=self.key_info.get("create_epoch"), half_life=half_life, identity_cache=identity_cache, key_info_digest=self.info_digest)
             self.iam_pairs[(access_key, secret_key)] = iam_pair
         return self.iam_pairs[(access_key, secret_key)]
 
     @property
     def encrypted_values(self):
         """
-        Return this key as a dictionary of {"fingerprints": {<fingerprint>: <info>, ...}, <other_options>}
+        Return this key as a dictionary of {"envelope": <envelope>, <other_options>}
 
-        Where <info> is {"aws_access_key_id", "aws_secret_access_key"}
+        Where <envelope> is {"aws_access_key_id", "aws_secret_access_key"} encrypted by crypto.envelope
 
-        and <other_options> includes {"create_epoch"}
+        and <other_options> includes {"create_epoch", "half_life"}
         """
-        fingerprints = self.crypto.fingerprinted({"aws_access_key_id": self.iam_pair.aws_access_key_id, "aws_secret_access_key": self.iam_pair.aws_secret_access_key})
-        return {"fingerprints": fingerprints, "create_epoch": self.iam_pair.create_epoch, "half_life": self.iam_pair.half_life}
+        envelope = self.crypto.envelope({"aws_access_key_id": self.iam_pair.aws_access_key_id, "aws_secret_access_key": self.iam_pair.aws_secret_access_key})
+        return {"envelope": envelope, "create_epoch": self.iam_pair.create_epoch, "half_life": self.iam_pair.half_life}
 
     def verifier(self, data=None, iam_pair=None):
         """Say that these values is an amazon key for this account and user"""
@@ -182,6 +227,11 @@ class AmazonKeys(object):
         """Say whether there has been any changes"""
         return self._changed or any(key.changed for key in self.keys)
 
+    @property
+    def secret_fingerprints(self):
+        """Return the fingerprints any of our keys are encrypted for"""
+        return set(fingerprint for key in self.keys for fingerprint in key.secret_fingerprints)
+
     def unchanged(self):
         """Reset changed on everything"""
         self._changed = False
@@ -283,17 +333,46 @@ class AmazonKeys(object):
                     print >> sys.stderr, "The secret key you entered was not valid"
 
     def needs_rotation(self):
-        """Say whether the current keys that we know about need any rotation"""
+        """
+        Say whether the current keys that we know about need any rotation
+
+        If the identity cache says all our keys worked recently and none of them
+        are past their half life, then we say so without decrypting anything or
+        asking amazon.
+        """
+        if self.keys:
+            past = [key.past_half_life_from_metadata() for key in self.keys]
+            if past.count(False) == len(past):
+                log.debug("Keys don't need rotating according to their metadata\tcount=%s", len(past))
+                return False
+
         working = []
+        broken = []
         for key in self.keys:
             if key.iam_pair and key.iam_pair.works:
                 working.append(key)
                 if key.iam_pair.past_half_life() or key.iam_pair.expired():
                     return True
+            else:
+                broken.append(key)
+
+        # Remember which keys work so next time we can decide from metadata alone
+        identity_cache = getattr(self.credential_path, "identity_cache", None)
+        if identity_cache is not None:
+            if broken:
+                identity_cache.forget(key_info_digests=[key.info_digest for key in broken])
+            identity_cache.record_key_infos([key.info_digest for key in working])
 
         # Only need rotation if we have no working keys
         return len(working) == 0
 
+    def usable_until_rotated(self):
+        """Say whether we have a working key that isn't expired, so rotation can wait a little"""
+        for key in self.keys:
+            if key.iam_pair and key.iam_pair.works and not key.iam_pair.expired():
+                return True
+        return False
+
     def rotate(self, half_life=None):
         """Rotate the keys and return whether any of them changed"""
         while True:
@@ -2,7 +2,9 @@ from credo.errors import BadKeyFile, CredoError, UserQuit
 from credo.asker import ask_for_choice
 from credo.structure.keys import Keys
 
+import hashlib
 import logging
+import json
 import os
 
 log = logging.getLogger("credo.cred_types.environment")
@@ -132,19 +134,30 @@ class EnvironmentFile(Keys):
         """Return our keys as a dictionary with encrypted values"""
         result = []
         log.info("Making encrypted values for environment variables")
-        fingerprints = self.crypto.fingerprinted(self.keys)
-        result = {"fingerprints": fingerprints}
+        result = {"envelope": self.crypto.envelope(self.keys)}
         return result, self.keys.keys()
 
     def make_keys(self, contents):
-        """Get us our keys from the contents of the file"""
+        """
+        Get us our keys from the contents of the file
+
+        Decrypted values are remembered on the crypto object by a digest of
+        what was decrypted, so the same environment is only decrypted once
+        """
         if contents.typ != self.type:
             raise BadKeyFile("Unknown type", type=contents.typ)
-        keys = self.crypto.decrypt_by_fingerprint(contents.keys.get("fingerprints", {}), lambda *args, **kwargs: True)
+
+        digest = "environment|{0}".format(hashlib.sha256(json.dumps(contents.keys, sort_keys=True)).hexdigest())
+        keys = self.crypto.decrypted.get(digest)
+        if keys is None:
+            keys = self.crypto.decrypt_values(contents.keys, lambda *args, **kwargs: True)
+            if keys:
+                self.crypto.decrypted[digest] = keys
+
         if not keys:
             return {}
         else:
-            return keys
+            return dict(keys)
 
     def exports(self):
         """Return list of (key, val) exports we want to have in the shell"""
@@ -3,7 +3,8 @@ from credo.errors import (
     , BadPlainText, PasswordRequired, BadPrivateKey, BadPublicKey
     , NoSuchFingerPrint, CantFindPrivateKey, InvalidData
     )
-from credo.asker import ask_for_choice, get_response, ask_for_ssh_key_folders
+from credo.asker import ask_for_choice, get_response, ask_for_ssh_key_folders, non_interactive
+from credo.helper import read_json_file, write_json_atomically
 
 from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.PublicKey import RSA
@@ -12,11 +13,13 @@ from Crypto import Random
 from binascii import hexlify, unhexlify
 from base64 import b64decode, b64encode
 from paramiko import Message
-import tempfile
 import paramiko
+import hashlib
 import logging
 import random
+import threading
 import string
+import time
 import json
 import os
 import re
@@ -30,6 +33,7 @@ class KeyCollection(object):
         self.private_fingerprints = {}
 
         self.private_key_locations = {}
+        self.public_key_locations = {}
         self.fingerprint_to_location = {}
 
         self._location_to_public_rsaobj = {}
@@ -59,20 +63,37 @@ class KeyCollection(object):
             self.fingerprint_to_location[fingerprint] = location
         return fingerprint
 
+    def add_known_public_key(self, fingerprint, location):
+        """Record a public key we already know the fingerprint of and only read it when we need it"""
+        if fingerprint not in self.public_fingerprints:
+            self.public_fingerprints[fingerprint] = None
+        self.public_key_locations[fingerprint] = location
+        self.fingerprint_to_location[fingerprint] = location
+        return fingerprint
+
     def remove_public_key(self, fingerprint):
-        """Remove this public key"""
+        """Remove this public key and forget where it is so it isn't read back in"""
         if fingerprint in self.public_fingerprints:
             del self.public_fingerprints[fingerprint]
 
-    def add_private_key(self, location):
+        self.public_key_locations.pop(fingerprint, None)
+        if fingerprint in self.private_key_locations:
+            self.fingerprint_to_location[fingerprint] = self.private_key_locations[fingerprint]
+        else:
+            self.fingerprint_to_location.pop(fingerprint, None)
+
+    def add_private_key(self, location, fingerprint=None):
         """
         Record this private key
 
         Only get the fingerprint from the public key for now if it needs a password
         So we can delay getting the password till it's absolutely necessary
+
+        If we already know the fingerprint then we don't read the key till we need it
         """
-        rsaobj = self.rsaobj_from_location(location, only_need_public=True)
-        fingerprint = self.make_fingerprint(rsaobj)
+        if fingerprint is None:
+            rsaobj = self.rsaobj_from_location(location, only_need_public=True)
+            fingerprint = self.make_fingerprint(rsaobj)
         self.private_fingerprints[fingerprint] = None
         self.private_key_locations[fingerprint] = location
         self.fingerprint_to_location[fingerprint] = location
@@ -87,11 +108,23 @@ class KeyCollection(object):
         return "ssh-rsa {0}".format(self.public_rsaobj_for(fingerprint).get_base64())
 
     def public_rsaobj_for(self, fingerprint):
-        """Get the rsaobj for this public fingerprint"""
+        """
+        Get the rsaobj for this public fingerprint
+
+        Reading it from disk if we only know where it is
+        """
+        if self.public_fingerprints.get(fingerprint) is None and fingerprint in self.public_key_locations:
+            rsaobj = self.make_rsakey(self.public_key_locations[fingerprint])
+            if self.make_fingerprint(rsaobj) != fingerprint:
+                raise BadPublicKey("Public key doesn't have the fingerprint we expected", fingerprint=fingerprint, location=self.public_key_locations[fingerprint])
+            self.public_fingerprints[fingerprint] = rsaobj
+
         if fingerprint in self.public_fingerprints:
             return self.public_fingerprints[fingerprint]
 
         if fingerprint in self.private_fingerprints:
+            if self.private_fingerprints[fingerprint] is None and fingerprint in self.private_key_locations:
+                return self.rsaobj_from_location(self.private_key_locations[fingerprint], only_need_public=True)
             return self.private_fingerprints[fingerprint]
 
         raise NoSuchFingerPrint(fingerprint=fingerprint, looking_for="public")
@@ -107,7 +140,10 @@ class KeyCollection(object):
             if fingerprint not in self.private_key_locations:
                 raise NoSuchFingerPrint(fingerprint=fingerprint, looking_for="private")
 
-            rsaobj = self.rsaobj_from_location(self.private_key_locations[fingerprint])
+            location = self.private_key_locations[fingerprint]
+            rsaobj = self.rsaobj_from_location(location)
+            if rsaobj is None or self.make_fingerprint(rsaobj) != fingerprint:
+                raise BadPrivateKey("Private key doesn't have the fingerprint we expected", fingerprint=fingerprint, location=location)
             self.private_fingerprints[fingerprint] = rsaobj
 
         return self.private_fingerprints[fingerprint]
@@ -119,15 +155,7 @@ class KeyCollection(object):
 
     def rsaobj_from_pem(self, pem_data):
         """Get us a paramiko.RSAKey from a public key pem_data."""
-        tmp = None
-        try:
-            tmp = tempfile.NamedTemporaryFile(delete=True).name
-            with open(tmp, 'w') as fle:
-                fle.write(pem_data)
-            return self.make_rsakey(tmp)
-        finally:
-            if tmp and os.path.exists(tmp):
-                os.remove(tmp)
+        return self.make_rsakey(None, pem_data=pem_data)
 
     def rsaobj_from_location(self, location, only_need_public=False):
         """
@@ -177,13 +205,17 @@ class KeyCollection(object):
 
         return rsaobj
 
-    def make_rsakey(self, location, password=None, private=False):
-        """Get us an rsa object for this location"""
+    def make_rsakey(self, location, password=None, private=False, pem_data=None):
+        """Get us an rsa object for this location, or from pem_data for a public key if that is given"""
         try:
             if private:
                 return paramiko.RSAKey.from_private_key_file(location, password=password)
             else:
-                txt = open(location).read()
+                if pem_data is not None:
+                    txt = pem_data
+                else:
+                    with open(location) as fle:
+                        txt = fle.read()
                 if not txt.startswith("ssh-rsa"):
                     raise BadPublicKey("Doesn't start with ssh-rsa")
                 split = txt.split(" ")
@@ -201,12 +233,150 @@ class KeyCollection(object):
         except paramiko.ssh_exception.SSHException as err:
             raise BadSSHKey("Couldn't decode key, perhaps bad password?", err=err)
 
+class SSHKeyIndex(object):
+    """
+    Remembers what kind of key each file in our ssh key folders is and it's fingerprint
+
+    Entries are keyed by location and only trusted if the inode, size and mtime are the same
+    """
+    def __init__(self, location):
+        self.location = location
+        self.changed = False
+        self.files = read_json_file(location, {}).get("files", {})
+
+    def identity(self, stat):
+        """Return the bits of the stat that say whether a file has changed"""
+        return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+    def lookup(self, location, stat):
+        """Return (kind, fingerprint) for this location if we know it hasn't changed"""
+        entry = self.files.get(location)
+        if isinstance(entry, dict) and entry.get("identity") == self.identity(stat):
+            return entry.get("kind"), entry.get("fingerprint")
+
+    def record(self, location, stat, kind, fingerprint):
+        """Remember what this location is"""
+        self.files[location] = {"identity": self.identity(stat), "kind": kind, "fingerprint": fingerprint}
+        self.changed = True
+
+    def forget_missing(self, folder, seen):
+        """Forget anything under this folder we didn't see"""
+        prefix = os.path.join(folder, "")
+        for location in list(self.files):
+            if location.startswith(prefix) and location not in seen:
+                del self.files[location]
+                self.changed = True
+
+    def save(self):
+        """Write out the index if it has changed"""
+        if self.changed:
+            try:
+                write_json_atomically(self.location, {"files": self.files})
+                self.changed = False
+            except (IOError, OSError) as error:
+                log.warning("Failed to write ssh key index\tlocation=%s\terror=%s", self.location, error)
+
+class SignatureCache(object):
+    """
+    Remembers signatures we have already verified
+
+    Entries are a hash of the fingerprint, signature and what was signed, so any
+    change to the signed content means verifying it again.
+
+    The file is signed as a whole by one of our private keys and ignored if it
+    isn't. New entries are only written when save is called, which should be
+    once at the end of a run, and only if we can sign without asking for a
+    password. Otherwise they are verified again by a later run.
+    """
+    max_age = 60 * 60 * 24 * 30
+
+    def __init__(self, location):
+        self.crypto = None
+        self.changed = False
+        self.location = location
+        self.lock = threading.Lock()
+        self._verified = None
+
+    @property
+    def verified(self):
+        """Memoize what is in our file, as long as we signed it"""
+        if self._verified is None:
+            self._verified = self.load()
+        return self._verified
+
+    def signature_value(self, verified):
+        """Return the string we sign for these entries"""
+        return json.dumps(verified, sort_keys=True)
+
+    def load(self):
+        """Return the entries from our file or nothing if one of our private keys didn't sign them"""
+        contents = read_json_file(self.location, {})
+        if not isinstance(contents, dict) or not isinstance(contents.get("verified"), dict) or not contents["verified"]:
+            return {}
+
+        verified = contents["verified"]
+        fingerprint = contents.get("fingerprint")
+        try:
+            if fingerprint in self.crypto.private_key_fingerprints and self.crypto.check_signature(self.signature_value(verified), fingerprint, contents.get("signature")):
+                return verified
+        except (CredoError, TypeError, ValueError) as error:
+            log.debug("Failed to check signature cache\tlocation=%s\terror_type=%s\terror=%s", self.location, error.__class__.__name__, error)
+
+        log.warning("Ignoring signature cache we didn't sign\tlocation=%s", self.location)
+        return {}
+
+    def key_for(self, signed, fingerprint, signature):
+        """Return what we remember this verification as"""
+        if isinstance(signed, unicode):
+            signed = signed.encode("utf-8")
+        return hashlib.sha256("{0}|{1}|{2}".format(fingerprint, signature, signed)).hexdigest()
+
+    def known_valid(self, signed, fingerprint, signature):
+        """Say whether we already verified this signature"""
+        with self.lock:
+            return self.key_for(signed, fingerprint, signature) in self.verified
+
+    def record(self, signed, fingerprint, signature):
+        """Remember that this signature is valid until we are saved"""
+        with self.lock:
+            self.verified[self.key_for(signed, fingerprint, signature)] = int(time.time())
+            self.changed = True
+
+    def save(self):
+        """Sign and write out what we have verified if it changed, forgetting anything we haven't seen in a while"""
+        with self.lock:
+            if not self.changed:
+                return
+
+            now = time.time()
+            for key, verified in list(self.verified.items()):
+                if not isinstance(verified, int) or now - verified > self.max_age:
+                    del self.verified[key]
+
+            # Not worth asking for a password just to remember what we verified
+            try:
+                with non_interactive():
+                    fingerprint, signature = self.crypto.create_signature(self.signature_value(self.verified))
+            except CredoError as error:
+                log.debug("Couldn't sign signature cache\tlocation=%s\terror_type=%s\terror=%s", self.location, error.__class__.__name__, error)
+                return
+
+            try:
+                write_json_atomically(self.location, {"verified": self.verified, "fingerprint": fingerprint, "signature": signature})
+                self.changed = False
+            except (IOError, OSError) as error:
+                log.warning("Failed to write signature cache\tlocation=%s\terror=%s", self.location, error)
+
 class SSHKeys(object):
     """Stores private and public ssh keys by fingerprint"""
-    def __init__(self):
+    def __init__(self, index_location=None):
         self._RSA = {}
         self.collection = KeyCollection()
 
+        self.index = None
+        if index_location:
+            self.index = SSHKeyIndex(index_location)
+
     def have_private(self, fingerprint):
         """Says whether we have a private key with this fingerprint"""
         return fingerprint in self.collection.private_fingerprints
@@ -216,37 +386,61 @@ class SSHKeys(object):
         return fingerprint in self.collection.public_fingerprints
 
     def find_keys(self, folder):
-        """Find more private and public keys in specified folder"""
+        """
+        Find more private and public keys in specified folder
+
+        Files our index knows haven't changed aren't read again
+        """
         if not os.path.exists(folder):
             raise BadFolder("Doesn't exist", folder=folder)
         if not os.access(folder, os.R_OK):
             raise BadFolder("Not readable", folder=folder)
 
+        seen = set()
         for root, dirs, files in os.walk(folder):
             for filename in files:
                 location = os.path.join(root, filename)
-                if not filename.endswith(".pub") and filename not in ("known_hosts", "authorized_keys", "config"):
-                    if os.access(location, os.R_OK):
-                        is_private = False
-                        try:
-                            self.collection.add_private_key(location)
-                            is_private = True
-                        except BadSSHKey:
-                            pass
-
-                        if not is_private:
-                            try:
-                                with open(location) as fle:
-                                    self.collection.add_public_key(fle.read(), location)
-                            except BadSSHKey:
-                                pass
-
-                elif filename.endswith(".pub"):
-                    try:
-                        with open(location) as fle:
-                            self.collection.add_public_key(fle.read(), location)
-                    except BadSSHKey:
-                        pass
+                if filename in ("known_hosts", "authorized_keys", "config") or not os.access(location, os.R_OK):
+                    continue
+
+                try:
+                    stat = os.stat(location)
+                except OSError:
+                    continue
+
+                seen.add(location)
+                known = None
+                if self.index:
+                    known = self.index.lookup(location, stat)
+
+                if known is None:
+                    kind, fingerprint = self.read_key(location, filename)
+                    if self.index:
+                        self.index.record(location, stat, kind, fingerprint)
+                else:
+                    kind, fingerprint = known
+                    if kind == "private":
+                        self.collection.add_private_key(location, fingerprint=fingerprint)
+                    elif kind == "public":
+                        self.collection.add_known_public_key(fingerprint, location)
+
+        if self.index:
+            self.index.forget_missing(folder, seen)
+            self.index.save()
+
+    def read_key(self, location, filename):
+        """Add the key at this location to our collection and return (kind, fingerprint)"""
+        if not filename.endswith(".pub"):
+            try:
+                return "private", self.collection.add_private_key(location)
+            except BadSSHKey:
+                pass
+
+        try:
+            with open(location) as fle:
+                return "public", self.collection.add_public_key(fle.read(), location)
+        except BadSSHKey:
+            return "neither", None
 
     def add_public_keys(self, public_keys):
         """Add the specified public keys"""
@@ -312,11 +506,26 @@ class SSHKeys(object):
 
 class Crypto(object):
     """Knows how to do crypto"""
-    def __init__(self, keys=None):
+    def __init__(self, keys=None, signature_cache=None):
         if keys is None:
             keys = SSHKeys()
         self.keys = keys
         self.ssh_key_folders = []
+        self.signature_cache = signature_cache
+
+        # Things we decrypted, keyed by a digest of what they were decrypted from
+        self.decrypted = {}
+
+    @property
+    def signature_cache(self):
+        return self._signature_cache
+
+    @signature_cache.setter
+    def signature_cache(self, cache):
+        """Use this cache of verified signatures, which is signed with our keys"""
+        self._signature_cache = cache
+        if cache is not None:
+            cache.crypto = self
 
     @property
     def can_encrypt(self):
@@ -364,8 +573,46 @@ class Crypto(object):
         """Say whether we have a private key for any of these fingerprints"""
         return any(fingerprint in self.keys.collection.private_fingerprints for fingerprint in fingerprints)
 
+    def unlock(self, fingerprints=None):
+        """
+        Load the private keys for these fingerprints, asking for their passwords if we need to
+
+        So that whatever happens later without being able to ask questions can still decrypt.
+        Return the fingerprints we now have private keys for.
+        """
+        if fingerprints is None:
+            fingerprints = self.private_key_fingerprints
+
+        unlocked = []
+        for fingerprint in sorted(set(fingerprints)):
+            if not self.keys.have_private(fingerprint):
+                continue
+
+            try:
+                self.keys.collection.private_rsaobj_for(fingerprint)
+                unlocked.append(fingerprint)
+            except (BadPrivateKey, BadSSHKey) as error:
+                log.warning("Couldn't unlock private key\tfingerprint=%s\terror_type=%s\terror=%s", fingerprint, error.__class__.__name__, error)
+        return unlocked
+
+    def verified_before(self, signed, fingerprint, signature):
+        """Say whether our signature cache says this signature is valid, as long as we still know the key that made it"""
+        if self.signature_cache is None or not self.keys.collection.location_for_fingerprint(fingerprint):
+            return False
+        return self.signature_cache.known_valid(signed, fingerprint, signature)
+
     def is_signature_valid(self, signed, fingerprint, signature):
         """Return whether this signature is valid for the signed data"""
+        if self.verified_before(signed, fingerprint, signature):
+            return True
+
+        valid = self.check_signature(signed, fingerprint, signature)
+        if valid and self.signature_cache is not None:
+            self.signature_cache.record(signed, fingerprint, signature)
+        return valid
+
+    def check_signature(self, signed, fingerprint, signature):
+        """Verify this signature with the public key, without looking at our signature cache"""
         try:
             return self.keys.collection.public_rsaobj_for(fingerprint).verify_ssh_sig(signed, paramiko.Message(unhexlify(signature)))
         except TypeError:
@@ -430,7 +677,7 @@ class Crypto(object):
             self.keys.find_public_keys()
 
     def decrypt_by_fingerprint(self, fingerprints, verifier, **info):
-        """Return the first valid decrypted value"""
+        """Return the first valid decrypted value from a version 1 {<fingerprint>: {secret, data, verifier}} dictionary"""
         for fingerprint, values in fingerprints.items():
             if self.keys.have_private(fingerprint) and set(["secret", "data", "verifier"]) - set(values.keys()) == set():
                 verifier_val = values['verifier']
@@ -438,7 +685,7 @@ class Crypto(object):
                     log.error("Ignoring value with invalid verifier (Verifier is not a list of [fingerprint, signature])")
                     continue
 
-                fingerprint, signature = verifier_val
+                signed_by, signature = verifier_val
                 encrypted_data = values['data']
                 encrypted_secret = values['secret']
 
@@ -452,7 +699,7 @@ class Crypto(object):
                     log.error("Couldn't load decrypted data as a json dictionary\terror_type=%s\terror=%s\tfingerprint=%s", error.__class__.__name__, error, fingerprint)
 
                 if decrypted:
-                    if not self.is_signature_valid(secret, fingerprint, signature):
+                    if not self.is_signature_valid(secret, signed_by, signature):
                         log.error("Ignoring decrypted secrets, because can't verify signature\tfingerprint=%s", fingerprint)
                     else:
                         if not verifier(decrypted):
@@ -460,6 +707,67 @@ class Crypto(object):
                         else:
                             return decrypted
 
+    def decrypt_envelope(self, envelope, verifier, **info):
+        """Return the decrypted value from a version 2 envelope as made by self.envelope"""
+        if not isinstance(envelope, dict) or set(["secrets", "data", "verifier"]) - set(envelope.keys()):
+            log.error("Ignoring envelope that doesn't have secrets, data and verifier")
+            return
+
+        verifier_val = envelope["verifier"]
+        if not isinstance(verifier_val, list) or len(verifier_val) != 2:
+            log.error("Ignoring envelope with invalid verifier (Verifier is not a list of [fingerprint, signature])")
+            return
+
+        signed_by, signature = verifier_val
+        failure = None
+        for fingerprint, encrypted_secret in envelope["secrets"].items():
+            if not self.keys.have_private(fingerprint):
+                continue
+
+            # Try our other private keys if we can't use this one
+            try:
+                secret = self.keys.decrypt(encrypted_secret, fingerprint, key_fingerprint=fingerprint, action="decrypting", value="Secret for decrypting with")
+            except (BadCypherText, BadSSHKey, PasswordRequired) as error:
+                log.warning("Couldn't decrypt envelope secret\tfingerprint=%s\terror_type=%s\terror=%s", fingerprint, error.__class__.__name__, error)
+                failure = error
+                continue
+
+            if not self.is_signature_valid(self.envelope_signing_value(secret, envelope["data"]), signed_by, signature):
+                log.error("Ignoring envelope secret, because can't verify signature\tfingerprint=%s\tsigned_by=%s", fingerprint, signed_by)
+                continue
+
+            decrypted = None
+            try:
+                decrypted = json.loads(self.decrypt_with_secret(envelope["data"], secret))
+            except (ValueError, TypeError) as error:
+                log.error("Couldn't load decrypted data as a json dictionary\terror_type=%s\terror=%s\tfingerprint=%s", error.__class__.__name__, error, fingerprint)
+
+            if decrypted:
+                if not verifier(decrypted):
+                    log.error("Ignoring invalid data")
+                else:
+                    return decrypted
+
+        if failure is not None:
+            raise failure
+
+    def decrypt_values(self, values, verifier, **info):
+        """Decrypt from either an "envelope" or the older "fingerprints" in this dictionary"""
+        if values.get("envelope") is not None:
+            return self.decrypt_envelope(values["envelope"], verifier, **info)
+        return self.decrypt_by_fingerprint(values.get("fingerprints") or {}, verifier, **info)
+
+    def fingerprints_for_values(self, values):
+        """Return the fingerprints that anything in an "envelope" or "fingerprints" in this dictionary is encrypted for"""
+        envelope = values.get("envelope")
+        if isinstance(envelope, dict):
+            return list(envelope.get("secrets") or {})
+        return list(values.get("fingerprints") or {})
+
+    def decryptable_values(self, values):
+        """Say whether we have a private key for anything in an "envelope" or "fingerprints" in this dictionary"""
+        return self.decryptable(self.fingerprints_for_values(values))
+
     def fingerprinted(self, decrypted_vals, **info):
         """
         Return dictionary of {<fingerprint>: {secret: <secret>, data:<data>, verifier:<verifier>}
@@ -469,14 +777,10 @@ class Crypto(object):
         and <verifier> is a signature that says the secret was created using this private key
 
         Decrypted_vals is assumed to be a json dictionary
-        """
-        if not isinstance(decrypted_vals, dict):
-            raise CredoError("Fingerprinted should only be called with dictionaries", got_type=type(decrypted_vals))
 
-        try:
-            data_str = json.dumps(decrypted_vals, sort_keys=True)
-        except (ValueError, TypeError) as error:
-            raise InvalidData("Couldn't dump values for encryption", error_type=error.__class__.__name__, error=error, **info)
+        This is the version 1 format, new files are written using envelope
+        """
+        data_str = self.dump_for_encryption(decrypted_vals, **info)
 
         result = {}
         for fingerprint in self.public_key_fingerprints:
@@ -489,6 +793,45 @@ class Crypto(object):
 
         return result
 
+    def envelope(self, decrypted_vals, fingerprints=None, **info):
+        """
+        Return dictionary of {secrets: {<fingerprint>: <secret>}, data: <data>, verifier: <verifier>}
+
+        Where <data> is the original data encrypted with AES using one randomly generated secret,
+        each <secret> is that secret encrypted with the public key for that fingerprint
+        and <verifier> is a signature that says one of our private keys made the secret and data
+
+        Fingerprints defaults to all our public keys and decrypted_vals is assumed to be a json dictionary
+        """
+        data_str = self.dump_for_encryption(decrypted_vals, **info)
+        if fingerprints is None:
+            fingerprints = self.public_key_fingerprints
+
+        secret = self.generate_secret()
+        encrypted_data = self.encrypt_with_secret(data_str, secret)
+        verifier = self.create_signature(self.envelope_signing_value(secret, encrypted_data))
+
+        log.info("Encrypting credentials using AES\trecipients=%s", len(fingerprints))
+        secrets = {}
+        for fingerprint in fingerprints:
+            secrets[fingerprint] = self.keys.encrypt(secret, fingerprint, key_fingerprint=fingerprint, action="encrypting", value="Secret for encrypting with")
+
+        return dict(secrets=secrets, data=encrypted_data, verifier=list(verifier))
+
+    def envelope_signing_value(self, secret, encrypted_data):
+        """Return what we sign for an envelope so the signature covers both the secret and the data"""
+        return "{0}|{1}".format(hexlify(secret), encrypted_data)
+
+    def dump_for_encryption(self, decrypted_vals, **info):
+        """Return decrypted_vals as a json string, complaining if it isn't a dictionary"""
+        if not isinstance(decrypted_vals, dict):
+            raise CredoError("Can only encrypt dictionaries", got_type=type(decrypted_vals))
+
+        try:
+            return json.dumps(decrypted_vals, sort_keys=True)
+        except (ValueError, TypeError) as error:
+            raise InvalidData("Couldn't dump values for encryption", error_type=error.__class__.__name__, error=error, **info)
+
     def generate_secret(self, key_size=256):
         """Generate a secret that may be used for encrypting values"""
         return Random.OSRNG.posix.new().read(key_size // 8)
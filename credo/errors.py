@@ -93,3 +93,12 @@ class BadSamlProvider(CredoError):
 class SamlNotAuthorized(CredoError):
     desc = "Saml said no"
 
+
+class NeedsInteraction(CredoError):
+    desc = "Needed to ask the user something, but nobody is there to answer"
+
+class AgentError(CredoError):
+    desc = "Something wrong with the credo agent"
+
+class Offline(CredoError):
+    desc = "Needed the network, but we are offline"
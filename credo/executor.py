@@ -1,10 +1,15 @@
-from credo.actions import do_exports, do_exec, do_showavailable, do_import, do_rotate, do_current, do_remote, do_synchronize, do_capture, do_env, do_unset, do_register_saml, do_serve, do_switch
+"""
+The credo cli
+
+Only cheap modules are imported here. Everything else is imported when an
+action needs it, so that things like ``credo sourceable`` don't have to wait
+for boto, paramiko and pycrypto to load.
+"""
+from credo.shell import do_unset, print_exports, exec_with_exports
 from credo.errors import CredoError, NoExecCommand
-from credo.asker import secret_sources
-from credo.overview import Credo
+from credo.agent import AgentClient
 from credo import VERSION
 
-from rainbow_logging_handler import RainbowLoggingHandler
 import argparse
 import logging
 import sys
@@ -12,7 +17,28 @@ import os
 
 log = logging.getLogger("executor")
 
+def lazy_action(name):
+    """Return a function that calls the action with this name from credo.actions, only importing it when called"""
+    def action(credo, **kwargs):
+        from credo import actions
+        return getattr(actions, name)(credo, **kwargs)
+    action.__name__ = name
+    return action
+
+def without_credo(func):
+    """Mark this action as not needing a Credo object"""
+    func.needs_credo = False
+    return func
+
+def set_boto_useragent():
+    """Make boto tell amazon it's credo talking"""
+    import boto.connection
+    if "Credo/" not in boto.connection.UserAgent:
+        boto.connection.UserAgent = "{0} Credo/{1}".format(boto.connection.UserAgent, VERSION)
+
 def setup_logging(verbose=False, boto_debug=False):
+    from rainbow_logging_handler import RainbowLoggingHandler
+
     log = logging.getLogger("")
     handler = RainbowLoggingHandler(sys.stderr)
     handler._column_color['%(asctime)s'] = ('cyan', None, False)
@@ -64,10 +90,46 @@ class CliParser(object):
         if "--version" in cred_args:
             self.show_version_and_quit()
 
-        credo = self.make_credo(cred_args, action)
+        if action is None:
+            # Let argparse complain about the missing action
+            self.cred_parser().parse_args(cred_args)
+
         kwargs, function = self.actions[action](action, action_args)
+        credo = self.make_credo(cred_args, action, needs_credo=getattr(function, "needs_credo", True))
         return credo, kwargs, function
 
+    def forward_to_agent(self, argv=None):
+        """
+        Ask a running credo agent for our exports and return whether it gave them to us
+
+        Only exports, inject and exec are forwarded, everything else is done by us
+        """
+        cred_args, action, action_args = self.split_argv(argv)
+        if action not in ("exports", "inject", "exec") or "--version" in cred_args:
+            return False
+
+        cred_args = self.cred_parser().parse_args(cred_args)
+        if cred_args.no_agent:
+            return False
+
+        client = AgentClient()
+        if not client.available:
+            return False
+
+        self.setup_logging(cred_args)
+        kwargs, _ = self.actions[action](action, action_args)
+        result = client.exports(repo=cred_args.repo, account=cred_args.account, user=cred_args.user, half_life=kwargs.get("half_life"), offline=cred_args.offline)
+        if result is None:
+            log.debug("Credo agent didn't give us exports, doing it ourselves")
+            return False
+
+        exports, path = result
+        if action == "exec":
+            exec_with_exports(kwargs["command"], exports)
+        else:
+            print_exports(exports, path)
+        return True
+
     @property
     def actions(self):
         return {
@@ -75,22 +137,25 @@ class CliParser(object):
             , "exec": self.parse_exec
             , "show": self.parse_show
             , "serve": self.parse_serve
+            , "agent": self.parse_agent
             , "switch": self.parse_switch
             , "remote": self.parse_remote
             , "import": self.parse_import
             , "rotate": self.parse_rotate
             , "version": self.parse_version
             , "sourceable": self.parse_sourceable
+            , "assume_all": self.parse_assume_all
             , "register_saml": self.parse_register_saml
 
             , "env": self.parse_env
             , "capture": self.parse_env
 
-            , "unset": self.parser_for_no_args("Unset credo environment variables", do_unset, sourceable=True)
-            , "inject": self.parser_for_no_args("Print out export statements for your aws creds", do_exports, sourceable=True, extra_args=self.other_export_args)
-            , "exports": self.parser_for_no_args("Print out export statements for your aws creds", do_exports, extra_args=self.other_export_args)
-            , "current": self.parser_for_no_args("Show what user is currently in your environment", do_current)
-            , "synchronize": self.parser_for_no_args("Synchronise with the remote for some repository", do_synchronize)
+            , "unset": self.parser_for_no_args("Unset credo environment variables", without_credo(do_unset), sourceable=True)
+            , "inject": self.parser_for_no_args("Print out export statements for your aws creds", lazy_action("do_exports"), sourceable=True, extra_args=self.other_export_args)
+            , "exports": self.parser_for_no_args("Print out export statements for your aws creds", lazy_action("do_exports"), extra_args=self.other_export_args)
+            , "lock": self.parser_for_no_args("Make a running credo agent forget what it has decrypted", without_credo(lazy_action("do_lock")))
+            , "current": self.parser_for_no_args("Show what user is currently in your environment", lazy_action("do_current"))
+            , "synchronize": self.parser_for_no_args("Synchronise with the remote for some repository", lazy_action("do_synchronize"))
             }
 
     def cred_parser(self):
@@ -130,6 +195,16 @@ class CliParser(object):
             , action = "store_true"
             )
 
+        parser.add_argument("--no-agent"
+            , help = "Don't ask a running credo agent to do the work"
+            , action = "store_true"
+            )
+
+        parser.add_argument("--offline"
+            , help = "Only use what we have locally and don't talk to amazon, idps or remotes"
+            , action = "store_true"
+            )
+
         return parser
 
     def show_version_and_quit(self):
@@ -145,16 +220,27 @@ class CliParser(object):
         parser.usage = "{0} <|| {1} ||> {2}".format(cred_usage, action, subparser_usage)
         return vars(parser.parse_args(argv))
 
-    def make_credo(self, cred_args, expected_action):
-        """Make a Credo object that knows things"""
+    def setup_logging(self, cred_args):
+        """Setup logging for these cred args, unless we already have (the agent may have been asked first)"""
+        if not getattr(self, "logging_setup", False):
+            setup_logging(verbose=cred_args.verbose, boto_debug=cred_args.boto_debug)
+            self.logging_setup = True
+
+    def make_credo(self, cred_args, expected_action, needs_credo=True):
+        """Make a Credo object that knows things, or None if the action doesn't need one"""
         cred_parser = self.cred_parser()
         cred_args = cred_parser.parse_args(cred_args)
 
-        setup_logging(verbose=cred_args.verbose, boto_debug=cred_args.boto_debug)
+        self.setup_logging(cred_args)
 
         if cred_args.action != expected_action:
             raise CredoError("Well this is weird, I thought the action was different than it turned out to be", expected=expected_action, parsed=cred_args.action)
 
+        if not needs_credo:
+            return None
+
+        set_boto_useragent()
+        from credo.overview import Credo
         credo = Credo()
         credo.setup(**vars(cred_args))
         return credo
@@ -248,9 +334,9 @@ class CliParser(object):
 
         args = self.args_from_subparser(action, parser, argv)
 
-        func = do_env
+        func = lazy_action("do_env")
         if action == "capture":
-            func = do_capture
+            func = lazy_action("do_capture")
         return args, func
 
     def parse_rotate(self, action, argv):
@@ -264,8 +350,45 @@ class CliParser(object):
             , help = "Choose a half life for your new key"
             , choices = ["hour", "day", "week"]
             )
+        parser.add_argument("--all"
+            , help = "Rotate all the credentials that match the repo, account and user options at once"
+            , action = "store_true"
+            , dest = "rotate_all"
+            )
+        parser.add_argument("--workers"
+            , help = "How many credentials to rotate at the same time with --all"
+            , type = int
+            , default = 8
+            )
+        parser.add_argument("--per-account"
+            , help = "How many credentials in the same account to rotate at the same time with --all"
+            , type = int
+            , default = 2
+            , dest = "per_account"
+            )
+        args = self.args_from_subparser(action, parser, argv)
+        return args, lazy_action("do_rotate")
+
+    def parse_assume_all(self, action, argv):
+        """Assume many idp roles at once"""
+        parser = argparse.ArgumentParser(description="Assume many idp roles with one login and cache the sessions")
+        parser.add_argument("--role"
+            , help = "A role arn or name to assume, defaults to every role the idp gives you"
+            , action = "append"
+            , dest = "roles"
+            )
+        parser.add_argument("--workers"
+            , help = "How many roles to assume at the same time"
+            , type = int
+            , default = 8
+            )
+        parser.add_argument("--write-profiles"
+            , help = "Also write a profile for each role to ~/.aws/credentials"
+            , action = "store_true"
+            , dest = "write_profiles"
+            )
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_rotate
+        return args, lazy_action("do_assume_all")
 
     def parse_show(self, action, argv):
         """Parser for showing available credentials"""
@@ -281,10 +404,11 @@ class CliParser(object):
             , dest = "collapse_if_one"
             )
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_showavailable
+        return args, lazy_action("do_showavailable")
 
     def parse_import(self, action, argv):
         """Import doesn't have any arguments yet"""
+        from credo.asker import secret_sources
         parser = argparse.ArgumentParser(description="Import amazon secrets")
         parser.add_argument("--source"
             , help = "Choose a particular source to get credentials from"
@@ -295,7 +419,7 @@ class CliParser(object):
             , choices = ["hour", "day", "week"]
             )
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_import
+        return args, lazy_action("do_import")
 
     def parse_remote(self, action, argv):
         """Options for setting an external remote for syncing with"""
@@ -318,7 +442,7 @@ class CliParser(object):
             )
 
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_remote
+        return args, lazy_action("do_remote")
 
     def parse_exec(self, action, argv):
         """Exec passes on everything else also doesn't have arguments yet"""
@@ -334,7 +458,7 @@ class CliParser(object):
         else:
             if not argv:
                 raise NoExecCommand("argv is empty!")
-            return {"command": argv}, do_exec
+            return {"command": argv}, lazy_action("do_exec")
 
     def parse_register_saml(self, action, argv):
         """Args for registering a saml provider"""
@@ -345,7 +469,7 @@ class CliParser(object):
             )
 
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_register_saml
+        return args, lazy_action("do_register_saml")
 
     def parse_sourceable(self, action, argv):
         """Use CliParser to determine if these args given to credo produces a result that can be sourced into the shell"""
@@ -378,18 +502,54 @@ class CliParser(object):
         parser = argparse.ArgumentParser(description="Serve a fake metadata service")
 
         parser.add_argument("--port"
-            , help = "The port to serve it under"
+            , help = "The port to serve it under (80, or 9911 with --container)"
             , type = int
-            , default = 80
+            , default = None
             )
 
         parser.add_argument("--host"
-            , help = "The host to serve it as"
-            , default = "169.254.169.254"
+            , help = "The host to serve it as (169.254.169.254, or 127.0.0.1 with --container)"
+            , default = None
+            )
+
+        parser.add_argument("--container"
+            , help = "Serve credentials like the ECS container credentials endpoint instead"
+            , action = "store_true"
+            )
+
+        parser.add_argument("--auth-token"
+            , help = "Token clients must send when using --container, made up if not given"
+            , dest = "auth_token"
+            , default = None
+            )
+
+        parser.add_argument("--refresh-margin"
+            , help = "Renew credentials this many seconds before they expire"
+            , type = int
+            , default = 300
+            , dest = "refresh_margin"
             )
 
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_serve
+        return args, lazy_action("do_serve")
+
+    def parse_agent(self, action, argv):
+        """Args for running a credo agent"""
+        parser = argparse.ArgumentParser(description="Run an agent that keeps decrypted credentials warm for exports, inject and exec")
+
+        parser.add_argument("--ttl"
+            , help = "Number of seconds to remember decrypted values for"
+            , type = int
+            , default = 3600
+            )
+
+        parser.add_argument("--socket"
+            , help = "Location of the unix socket to listen on"
+            , dest = "socket_location"
+            )
+
+        args = self.args_from_subparser(action, parser, argv)
+        return args, lazy_action("do_agent")
 
     def parse_switch(self, action, argv):
         """Args for registering a saml provider"""
@@ -406,17 +566,38 @@ class CliParser(object):
             , default = "169.254.169.254"
             )
 
+        parser.add_argument("--role-name"
+            , help = "The name to serve these credentials under, so the server can serve several roles at once"
+            , dest = "role_name"
+            , default = None
+            )
+
+        parser.add_argument("--auth-token"
+            , help = "The auth token of a server started with --container, defaults to $AWS_CONTAINER_AUTHORIZATION_TOKEN"
+            , dest = "auth_token"
+            , default = None
+            )
+
         args = self.args_from_subparser(action, parser, argv)
-        return args, do_switch
+        return args, lazy_action("do_switch")
 
 def main(argv=None):
-    __import__("boto")
-    useragent = sys.modules["boto.connection"].UserAgent
-    sys.modules["boto.connection"].UserAgent = "{0} Credo/{1}".format(useragent, VERSION)
-
     try:
-        credo, kwargs, function = CliParser().parse_args(argv)
-        function(credo, **kwargs)
+        parser = CliParser()
+        if parser.forward_to_agent(argv):
+            return
+
+        credo, kwargs, function = parser.parse_args(argv)
+        if credo is None:
+            function(credo, **kwargs)
+        else:
+            from credo.structure.repository import batched_changes
+            from credo.connections import offline_mode
+            try:
+                with offline_mode(credo.stay_offline), batched_changes():
+                    function(credo, **kwargs)
+            finally:
+                credo.save_caches()
     except CredoError as error:
         print ""
         print "!" * 80
@@ -1,8 +1,21 @@
-from credo.helper import copy_dict_structure
+from credo.helper import copy_dict_structure, read_json_file, write_json_atomically
 
 from fnmatch import fnmatch
+import logging
+import time
 import os
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Optional dependency is optional
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = logging.getLogger("credo.explorer")
+
 def filtered(original, looking_for=None, required_files=None):
     """
     Filter out unwanted entries from a nested dictionary structure
@@ -66,7 +79,82 @@ def filtered(original, looking_for=None, required_files=None):
 
     return result
 
-def find_repo_structure(root_dir, collection=None, sofar=None, shortened=None, levels=3):
+def list_directory(directory):
+    """
+    Return (files, others) sorted lists of the names in this directory
+
+    Uses scandir if we have it so we don't need to stat every entry
+    """
+    files = []
+    others = []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_file():
+                files.append(entry.name)
+            else:
+                others.append(entry.name)
+    else:
+        for filename in os.listdir(directory):
+            if os.path.isfile(os.path.join(directory, filename)):
+                files.append(filename)
+            else:
+                others.append(filename)
+
+    return sorted(files), sorted(others)
+
+class DirectoryIndex(object):
+    """
+    Remembers what list_directory said about directories we have explored
+
+    A directory is only listed again when it's mtime changes. Changes within
+    a couple seconds of the mtime aren't noticed by the mtime, so we don't
+    remember directories that were changed that recently.
+    """
+    racy_seconds = 2
+
+    def __init__(self, location=None):
+        self.location = location
+        self.changed = False
+        self.directories = {}
+        if location:
+            self.directories = read_json_file(location, {}).get("directories", {})
+
+    def listing(self, directory):
+        """Return (files, others) for this directory, from our memory if it hasn't changed"""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return list_directory(directory)
+
+        entry = self.directories.get(directory)
+        if isinstance(entry, dict) and entry.get("mtime") == mtime:
+            return entry["files"], entry["others"]
+
+        files, others = list_directory(directory)
+        if time.time() - mtime > self.racy_seconds:
+            self.directories[directory] = {"mtime": mtime, "files": files, "others": others}
+            self.changed = True
+        elif directory in self.directories:
+            del self.directories[directory]
+            self.changed = True
+        return files, others
+
+    def save(self):
+        """Write out what we know if it has changed, forgetting directories that don't exist anymore"""
+        if not self.location or not self.changed:
+            return
+
+        for directory in list(self.directories):
+            if not os.path.isdir(directory):
+                del self.directories[directory]
+
+        try:
+            write_json_atomically(self.location, {"directories": self.directories})
+            self.changed = False
+        except (IOError, OSError) as error:
+            log.warning("Failed to write repository index\tlocation=%s\terror=%s", self.location, error)
+
+def find_repo_structure(root_dir, collection=None, sofar=None, shortened=None, levels=3, index=None):
     """
     Recursively explore a directory structure and put it in a dictionary to the number of levels specified
 
@@ -124,6 +212,8 @@ def find_repo_structure(root_dir, collection=None, sofar=None, shortened=None, l
     and shortened would become
 
         {"github.com:blah": {"prod": {"user1": ["credentials.json"]}}}
+
+    If an index is provided, it is used to avoid listing directories that haven't changed
     """
     dirs = []
     basenames = []
@@ -133,15 +223,17 @@ def find_repo_structure(root_dir, collection=None, sofar=None, shortened=None, l
     shortened = {} if shortened is None else shortened
     collection = {} if collection is None else collection
 
-    for filename in os.listdir(root_dir):
-        location = os.path.join(root_dir, filename)
-        if os.path.isfile(location):
-            basenames.append(filename)
+    if index is None:
+        files, others = list_directory(root_dir)
+    else:
+        files, others = index.listing(root_dir)
+
+    basenames.extend(files)
+    for filename in others:
+        if filename.startswith("."):
+            extra_dirs.append(filename)
         else:
-            if filename.startswith("."):
-                extra_dirs.append(filename)
-            else:
-                dirs.append((filename, location))
+            dirs.append((filename, os.path.join(root_dir, filename)))
 
     collection["/dirs/"] = extra_dirs
     collection["/files/"] = basenames
@@ -161,7 +253,51 @@ def find_repo_structure(root_dir, collection=None, sofar=None, shortened=None, l
         for filename, location in dirs:
             nxt_collection = {}
             collection[filename] = nxt_collection
-            find_repo_structure(location, collection=nxt_collection, sofar=list(sofar) + [filename], shortened=shortened, levels=levels-1)
+            find_repo_structure(location, collection=nxt_collection, sofar=list(sofar) + [filename], shortened=shortened, levels=levels-1, index=index)
+
+    return collection, shortened
+
+def is_glob(val):
+    """Say whether this value would match things other than itself with fnmatch"""
+    return any(char in val for char in "*?[")
+
+def find_direct_structure(root_dir, looking_for, required_files=None):
+    """
+    Return (directory_structure, shortened) like find_repo_structure but for only
+    the one path specified by looking_for
+
+    Return None if any part of looking_for is missing or a glob, or if the path
+    doesn't have all the required_files.
+
+    Only the required_files are recorded at the last level and no other entries
+    are listed, so this only costs a stat per required file.
+    """
+    required_files = required_files or []
+    if not looking_for:
+        return None
+
+    def make(location):
+        if not location.endswith("/"):
+            location = "{0}/".format(location)
+        return {"/location/": location, "/files/": [], "/dirs/": []}
+
+    location = root_dir
+    collection = make(root_dir)
+    structure = collection
+    for part in looking_for:
+        if not part or is_glob(part) or part.startswith(".") or os.sep in part:
+            return None
+        location = os.path.join(location, part)
+        structure[part] = make(location)
+        structure = structure[part]
+
+    if not all(os.path.isfile(os.path.join(location, required)) for required in required_files):
+        return None
+    structure["/files/"] = list(required_files)
+
+    shortened = list(required_files)
+    for part in reversed(looking_for):
+        shortened = {part: shortened}
 
     return collection, shortened
 
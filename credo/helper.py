@@ -1,13 +1,22 @@
 from credo.asker import ask_for_choice_or_new, ask_user_for_half_life
 from credo.errors import NoValueEntered, BadKeyFile, CredoError
+from credo.shell import make_export_commands
 
+import ConfigParser
+import tempfile
+import hashlib
 import logging
+import time
 import copy
 import json
 import os
 
 log = logging.getLogger("credo.helper")
 
+def default_cache_dir():
+    """Where credo keeps things that aren't part of any repository unless told otherwise"""
+    return os.path.expanduser("~/.credo")
+
 def record_non_dicts(subject, memo):
     """Find all the things in subject that are not string or dicts and fill memo with {id(thing): thing}"""
     for key, val in subject.items():
@@ -28,12 +37,51 @@ def print_list_of_tuples(lst, prefix):
     if any(val for _, val in lst):
         print "{0}: {1}".format(prefix, " | ".join("{0}={1}".format(key, val) for key, val in lst if val))
 
-def make_export_commands(exports, no_transform=False):
-    for key, val in exports:
-        if val == "CREDO_UNSET" and not no_transform:
-            yield "unset {0}".format(key)
-        else:
-            yield "export {0}=\"{1}\"".format(key, val.replace("\\\"", "\"").replace("\"", "\\\""))
+def read_json_file(location, default=None):
+    """Return the json in this file, or default if it doesn't exist or isn't valid"""
+    if not os.path.exists(location):
+        return default
+
+    try:
+        with open(location) as fle:
+            return json.load(fle)
+    except (ValueError, IOError, OSError) as error:
+        log.warning("Failed to read json file\tlocation=%s\terror_type=%s\terror=%s", location, error.__class__.__name__, error)
+        return default
+
+def write_json_atomically(location, data):
+    """
+    Write data as json to a temporary file next to location and move it into place
+
+    So readers never see a half written file, and the file is only readable by us
+    """
+    write_atomically(location, lambda fle: json.dump(data, fle))
+
+def write_atomically(location, writer):
+    """Call writer with a temporary file next to location and move that file into place"""
+    dirname = os.path.dirname(location)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname or ".", prefix=".{0}.".format(os.path.basename(location)))
+    try:
+        with os.fdopen(fd, "w") as fle:
+            writer(fle)
+        os.rename(tmp, location)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_aws_profiles(location, profiles):
+    """Write these {name: {option: value}} profiles into an aws credentials file, leaving other profiles alone"""
+    parser = ConfigParser.RawConfigParser()
+    parser.read(location)
+    for name, options in sorted(profiles.items()):
+        if not parser.has_section(name):
+            parser.add_section(name)
+        for option, value in sorted(options.items()):
+            parser.set(name, option, value)
+    write_atomically(location, parser.write)
 
 def normalise_half_life(half_life, access_key=None):
     if half_life is None:
@@ -126,8 +174,223 @@ class SignedValueFile(object):
 
         return value
 
+class IdentityCache(object):
+    """
+    Remembers which account and username amazon said an access key belongs to
+
+    Each entry is signed with one of our keys and holds a hash of the secret key,
+    so we only trust entries we made ourselves for the exact pair we are using.
+    Entries are ignored once they are older than ttl seconds.
+    """
+    default_ttl = 60 * 60 * 12
+
+    def __init__(self, location, crypto, ttl=None):
+        self.crypto = crypto
+        self.location = location
+        self.ttl = self.default_ttl if ttl is None else ttl
+
+    @property
+    def entries(self):
+        """Memoize what is in our file"""
+        if not hasattr(self, "_entries"):
+            entries = read_json_file(self.location, {})
+            if not isinstance(entries, dict):
+                entries = {}
+            self._entries = entries
+        return self._entries
+
+    def secret_digest(self, aws_secret_access_key):
+        """Return something that identifies this secret without being it"""
+        return hashlib.sha256(aws_secret_access_key).hexdigest()
+
+    def signature_value(self, aws_access_key_id, entry):
+        """Return string for signing this entry"""
+        aliases = ",".join(str(alias) for alias in entry["aliases"] or [])
+        return "{0}|{1}|{2}|{3}|{4}|{5}|{6}".format(
+              aws_access_key_id, entry["secret"], entry["account_id"], entry["username"]
+            , aliases, entry["create_epoch"], entry["verified"]
+            )
+
+    def lookup(self, aws_access_key_id, aws_secret_access_key, any_age=False):
+        """
+        Return the identity we have recorded for this pair or None if we don't have one we trust
+
+        Entries older than our ttl are only used if any_age is True
+        """
+        entry = self.entries.get(aws_access_key_id)
+        if not isinstance(entry, dict):
+            return None
+
+        try:
+            if not any_age and time.time() - entry["verified"] > self.ttl:
+                return None
+            if entry["secret"] != self.secret_digest(aws_secret_access_key):
+                return None
+            if not self.crypto.is_signature_valid(self.signature_value(aws_access_key_id, entry), entry["fingerprint"], entry["signature"]):
+                log.warning("Identity cache has an entry with a bad signature\taccess_key=%s", aws_access_key_id)
+                return None
+        except (KeyError, TypeError, CredoError) as error:
+            log.debug("Ignoring identity cache entry\taccess_key=%s\terror_type=%s\terror=%s", aws_access_key_id, error.__class__.__name__, error)
+            return None
+
+        return entry
+
+    def record(self, aws_access_key_id, aws_secret_access_key, account_id, username, aliases, create_epoch=None):
+        """Remember what amazon said about this pair"""
+        entry = {
+              "secret": self.secret_digest(aws_secret_access_key)
+            , "account_id": account_id, "username": username, "aliases": list(aliases or [])
+            , "create_epoch": create_epoch, "verified": int(time.time())
+            }
+
+        try:
+            entry["fingerprint"], entry["signature"] = self.crypto.create_signature(self.signature_value(aws_access_key_id, entry))
+        except CredoError as error:
+            log.debug("Couldn't sign identity cache entry\taccess_key=%s\terror_type=%s\terror=%s", aws_access_key_id, error.__class__.__name__, error)
+            return
+
+        self.entries[aws_access_key_id] = entry
+        self.save()
+
+    def key_info_verified(self, digest):
+        """Say whether we recorded a key with this key_info digest working within our ttl"""
+        entry = self.entries.get("key_info|{0}".format(digest))
+        if not isinstance(entry, dict):
+            return False
+
+        try:
+            if time.time() - entry["verified"] > self.ttl:
+                return False
+            return self.crypto.is_signature_valid("key_info|{0}|{1}".format(digest, entry["verified"]), entry["fingerprint"], entry["signature"])
+        except (KeyError, TypeError, CredoError) as error:
+            log.debug("Ignoring identity cache entry\tkey_info=%s\terror_type=%s\terror=%s", digest, error.__class__.__name__, error)
+            return False
+
+    def record_key_infos(self, digests):
+        """Remember that the keys with these key_info digests work, only signing the ones we don't already trust"""
+        recorded = False
+        for digest in digests:
+            if self.key_info_verified(digest):
+                continue
+
+            entry = {"verified": int(time.time())}
+            try:
+                entry["fingerprint"], entry["signature"] = self.crypto.create_signature("key_info|{0}|{1}".format(digest, entry["verified"]))
+            except CredoError as error:
+                log.debug("Couldn't sign identity cache entry\tkey_info=%s\terror_type=%s\terror=%s", digest, error.__class__.__name__, error)
+                continue
+
+            self.entries["key_info|{0}".format(digest)] = entry
+            recorded = True
+
+        if recorded:
+            self.save()
+
+    def forget(self, aws_access_key_id=None, key_info_digests=()):
+        """Forget what we know about this access key and the keys with these key_info digests"""
+        names = ["key_info|{0}".format(digest) for digest in key_info_digests]
+        if aws_access_key_id is not None:
+            names.append(aws_access_key_id)
+
+        forgotten = [name for name in names if name in self.entries]
+        for name in forgotten:
+            del self.entries[name]
+        if forgotten:
+            self.save()
+
+    def save(self):
+        """Write our entries, forgetting any that are too old"""
+        now = time.time()
+        for aws_access_key_id, entry in list(self.entries.items()):
+            if not isinstance(entry, dict) or now - entry.get("verified", 0) > self.ttl:
+                del self.entries[aws_access_key_id]
+
+        try:
+            write_json_atomically(self.location, self.entries)
+        except (IOError, OSError) as error:
+            log.warning("Failed to write identity cache\tlocation=%s\terror=%s", self.location, error)
+
+class SessionCache(object):
+    """
+    Remembers the exports from assuming saml roles until shortly before they expire
+
+    The exports are kept in an envelope for our own keys, so only we can read
+    them, and entries are found by a hash of the provider, idp user and role.
+    """
+    def __init__(self, location, crypto, margin=300):
+        self.crypto = crypto
+        self.margin = margin
+        self.location = location
+
+    @property
+    def entries(self):
+        """Memoize what is in our file"""
+        if not hasattr(self, "_entries"):
+            entries = read_json_file(self.location, {})
+            if not isinstance(entries, dict):
+                entries = {}
+            self._entries = entries
+        return self._entries
+
+    def key_for(self, provider, idp_username, role_arn):
+        """Return what we store a session under"""
+        return hashlib.sha256("{0}|{1}|{2}".format(provider, idp_username, role_arn)).hexdigest()
+
+    def fresh(self, entry):
+        """Say whether this entry has a while to go before it expires"""
+        return isinstance(entry, dict) and entry.get("expires", 0) - self.margin > time.time()
+
+    def lookup(self, provider, idp_username, role_arn):
+        """Return the exports we have for this role or None if we don't have usable ones"""
+        key = self.key_for(provider, idp_username, role_arn)
+        entry = self.entries.get(key)
+        if not self.fresh(entry):
+            return None
+
+        try:
+            decrypted = self.crypto.decrypt_envelope(entry["envelope"], lambda vals: isinstance(vals.get("exports"), list), action="reading saml session")
+        except (KeyError, TypeError, CredoError) as error:
+            log.debug("Ignoring saml session cache entry\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            return None
+
+        if decrypted is None:
+            return None
+        return [tuple(export) for export in decrypted["exports"]]
+
+    def record(self, provider, idp_username, role_arn, exports, expires):
+        """Remember these exports until they expire"""
+        fingerprints = [fingerprint for fingerprint in self.crypto.private_key_fingerprints if fingerprint in self.crypto.public_key_fingerprints]
+        if not fingerprints:
+            return
+
+        try:
+            envelope = self.crypto.envelope({"exports": [list(export) for export in exports]}, fingerprints=fingerprints, action="caching saml session")
+        except CredoError as error:
+            log.debug("Couldn't encrypt saml session\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            return
+
+        self.entries[self.key_for(provider, idp_username, role_arn)] = {"expires": expires, "envelope": envelope}
+        self.save()
+
+    def save(self):
+        """Write our entries, forgetting any that have expired"""
+        for key, entry in list(self.entries.items()):
+            if not self.fresh(entry):
+                del self.entries[key]
+
+        try:
+            write_json_atomically(self.location, self.entries)
+        except (IOError, OSError) as error:
+            log.warning("Failed to write saml session cache\tlocation=%s\terror=%s", self.location, error)
+
 class KeysFile(object):
-    """Understands how to load and save to a keys file"""
+    """
+    Understands how to load and save to a keys file
+
+    Version 1 files encrypt the keys separately for every public key
+    Version 2 files encrypt the keys once and hold the secret for every public key
+    """
+    version = 2
     def __init__(self, default_keys_type=list, default_keys_type_name="amazon"):
         self.default_keys_type = default_keys_type
         self.default_keys_type_name = default_keys_type_name
@@ -156,7 +419,12 @@ class KeysFile(object):
         if not isinstance(contents.get("keys", []), self.default_keys_type):
             raise BadKeyFile("Keys file keys are not correct", expected_type=self.default_keys_type, got_type=type(contents["keys"]))
 
+        version = contents.get("version", 1)
+        if version not in (1, 2):
+            raise BadKeyFile("Keys file is from an unknown version of credo", location=location, version=version)
+
         self.contents = contents
+        self.file_version = version
         self.typ = self.contents.get("type", self.default_keys_type_name)
         self.keys = self.contents.get("keys", self.default_keys_type())
 
@@ -178,7 +446,7 @@ class KeysFile(object):
             raise BadKeyFile("Can't get encrypted values for the keys file!", err=err, location=location)
 
         try:
-            vals = {"type": keys.type, "keys": key_vals}
+            vals = {"version": self.version, "type": keys.type, "keys": key_vals}
             contents = json.dumps(vals, indent=4)
         except ValueError as err:
             raise BadKeyFile("Can't create keys as json", err=err, location=location)
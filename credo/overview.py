@@ -1,8 +1,10 @@
 from credo.errors import NoConfigFile, BadConfigFile, BadConfiguration, ProgrammerError, CredoError, RepoError
 from credo.asker import ask_for_choice, ask_for_choice_or_new, ask_for_ssh_key_folders
 from credo.structure.credential_path import CredentialPath
-from credo.crypto import Crypto
-from credo import explorer
+from credo.structure.repository import Repository
+from credo.crypto import Crypto, SSHKeys, SignatureCache
+from credo.helper import IdentityCache, SessionCache, default_cache_dir
+from credo import explorer, background, connections
 
 import logging
 import json
@@ -77,7 +79,7 @@ class Credo(object):
     root_dir = ConfigFileProperty("root_dir")
     providers = ConfigFileProperty("providers")
     ssh_key_folders = ConfigFileProperty("ssh_key_folders")
-    options_from_config = ["root_dir", "ssh_key_folders", "half_life", "providers"]
+    options_from_config = ["root_dir", "ssh_key_folders", "half_life", "providers", "identity_cache_ttl", "sync_interval", "background_rotation", "offline", "cache_dir"]
 
     def validate_options(self):
         """Make sure our options make sense"""
@@ -96,6 +98,31 @@ class Credo(object):
         if errors:
             raise BadConfiguration(errors=errors)
 
+    @property
+    def cache_dir(self):
+        """Where we keep things that aren't part of any repository, ~/.credo unless the config says otherwise"""
+        cache_dir = getattr(self, "_cache_dir", None)
+        if not cache_dir:
+            return default_cache_dir()
+        return os.path.abspath(os.path.expanduser(cache_dir))
+
+    @cache_dir.setter
+    def cache_dir(self, val):
+        self._cache_dir = val
+
+    @property
+    def repo_index(self):
+        """Memoize an index of the directories under root_dir"""
+        if not getattr(self, "_repo_index", None):
+            self._repo_index = explorer.DirectoryIndex(os.path.join(self.cache_dir, "repo_index.json"))
+        return self._repo_index
+
+    def find_repo_structure(self, levels=3):
+        """Return (directory_structure, shortened) for our root_dir using our index"""
+        result = explorer.find_repo_structure(self.root_dir, levels=levels, index=self.repo_index)
+        self.repo_index.save()
+        return result
+
     ########################
     ###   CRYPTO
     ########################
@@ -116,7 +143,9 @@ class Credo(object):
             else:
                 ssh_key_folders = []
 
-        crypto = Crypto()
+        # Saved by save_caches at the end of the run
+        signature_cache = SignatureCache(os.path.join(self.cache_dir, "signature_cache.json"))
+        crypto = Crypto(SSHKeys(index_location=os.path.join(self.cache_dir, "ssh_key_index.json")), signature_cache=signature_cache)
         for folder in ssh_key_folders:
             crypto.find_keys(folder)
 
@@ -128,12 +157,40 @@ class Credo(object):
 
         return crypto
 
+    def save_caches(self):
+        """Write out the caches we only save once at the end of a run"""
+        crypto = getattr(self, "_crypto", None)
+        if crypto is not None and crypto.signature_cache is not None:
+            crypto.signature_cache.save()
+
+    @property
+    def identity_cache(self):
+        """Memoize an identity cache that is signed with our crypto"""
+        if not getattr(self, "_identity_cache", None):
+            location = os.path.join(self.cache_dir, "identity_cache.json")
+            self._identity_cache = IdentityCache(location, self.crypto, ttl=getattr(self, "identity_cache_ttl", None))
+        return self._identity_cache
+
+    @property
+    def session_cache(self):
+        """Memoize a cache of saml sessions that is encrypted with our crypto"""
+        if not getattr(self, "_session_cache", None):
+            location = os.path.join(self.cache_dir, "session_cache.json")
+            self._session_cache = SessionCache(location, self.crypto)
+        return self._session_cache
+
     ########################
     ###   CHOSEN CREDENTIALS
     ########################
 
-    def make_chosen(self, rotate=True, invalidate_creds=False, half_life=None):
-        """Make the chosen credentials from our repository"""
+    def make_chosen(self, rotate=True, invalidate_creds=False, half_life=None, background_rotation=None):
+        """
+        Make the chosen credentials from our repository
+
+        If background_rotation (or the option of the same name) is True, then
+        keys that are past their half life but not expired are rotated in the
+        background and we use the current keys for now.
+        """
         structure, chains = self.find_credentials(asker=ask_for_choice)
         chosen = list(self.credentials_from(structure, chains, complain_if_missing=True))[0]
         if chosen.requires_encryption:
@@ -144,23 +201,61 @@ class Credo(object):
 
         self.set_options(repo=chosen.credential_path.repository.name, account=chosen.credential_path.account.name, user=chosen.credential_path.user.name)
 
-        if rotate:
-            if chosen.keys.needs_rotation():
-                changed = chosen.credential_path.repository.synchronize(override=True)
-                if changed:
-                    chosen.load()
-                    chosen.credential_path.repository.pub_key_syncer.sync()
+        if background_rotation is None:
+            background_rotation = getattr(self, "background_rotation", False)
 
-            chosen.save(half_life=half_life)
+        if rotate and connections.is_offline():
+            log.info("Not checking if keys need rotating while offline")
+        elif rotate:
+            rotate_now = True
+            if chosen.keys.needs_rotation():
+                if background_rotation and not invalidate_creds and getattr(chosen.keys, "usable_until_rotated", lambda: False)():
+                    self.rotate_in_background(chosen, half_life=half_life)
+                    rotate_now = False
+                else:
+                    changed = chosen.credential_path.repository.synchronize(override=True)
+                    if changed:
+                        chosen.load()
+                        chosen.credential_path.repository.pub_key_syncer.sync()
+
+            chosen.save(half_life=half_life, rotate=rotate_now)
         return chosen
 
+    def rotate_in_background(self, chosen, half_life=None):
+        """
+        Ask for the chosen credentials to be rotated without waiting for it
+
+        If we have a deferred_rotations list, then we just add to it and leave
+        it up to whoever gave us that list to do the rotation.
+        """
+        if half_life is None and chosen.keys.iam_pair:
+            half_life = chosen.keys.iam_pair.half_life
+
+        if getattr(self, "deferred_rotations", None) is not None:
+            self.deferred_rotations.append(half_life)
+            return
+
+        cred_path = chosen.credential_path
+        background.rotate(self.config_file_location, cred_path.repository.name, cred_path.account.name, cred_path.user.name
+            , half_life=half_life, cache_dir=self.cache_dir
+            )
+
     def find_credentials(self, asker=None, missing_is_bad=False, want_new=False, no_mask=False):
         """
         Traverse our directory structure, asking as necessary
 
         and return the credentials object we find
+
+        If we know exactly which credentials we want, we go straight to them
+        and only walk the whole repository if they aren't there
         """
-        directory_structure, shortened = explorer.find_repo_structure(self.root_dir, levels=3)
+        if not want_new and not no_mask:
+            direct = explorer.find_direct_structure(self.root_dir, [self.repo, self.account, self.user], required_files=["credentials.json"])
+            if direct is not None:
+                directory_structure, shortened = direct
+                return directory_structure, explorer.flatten(directory_structure, shortened)
+
+        directory_structure, shortened = self.find_repo_structure(levels=3)
         if no_mask:
             mask = shortened
         else:
@@ -187,15 +282,25 @@ class Credo(object):
             if not os.path.exists(credentials_location) and complain_if_missing:
                 raise CredoError("Trying to find credentials that don't exist!", repo=repo, account=account, user=user)
 
-            credential_path = CredentialPath(self.crypto)
+            credential_path = CredentialPath(self.crypto, identity_cache=self.identity_cache, sync_interval=getattr(self, "sync_interval", None), session_cache=self.session_cache, cache_dir=self.cache_dir)
             credential_path.fill_out(directory_structure, repo, account, user, typ=typ)
             credentials = credential_path.credentials
             credentials.load()
             yield credentials
 
+    def synchronize_repositories(self, directory_structure, chains):
+        """Synchronize the repositories in these chains before we use them and return {name: repository}"""
+        repositories = {}
+        for _, repo, _, _ in chains:
+            if repo not in repositories:
+                location = directory_structure[repo]['/location/']
+                repositories[repo] = Repository(repo, location, self.crypto, sync_interval=getattr(self, "sync_interval", None), cache_dir=self.cache_dir)
+                repositories[repo].synchronize(override=True)
+        return repositories
+
     def find_one_repository(self, want_new=True):
         """Find one repository and return it's name and location"""
-        _, shortened = explorer.find_repo_structure(self.root_dir, levels=1)
+        _, shortened = self.find_repo_structure(levels=1)
         mask = explorer.filtered(shortened, [self.repo])
         asker = ask_for_choice_or_new
         if not want_new:
@@ -210,7 +315,7 @@ class Credo(object):
 
     def find_credential_path_part(self, all_accounts=False, all_users=False, find_user=False, typ=None):
         """Find a repository, account or user"""
-        directory_structure, shortened = explorer.find_repo_structure(self.root_dir, levels=3)
+        directory_structure, shortened = self.find_repo_structure(levels=3)
         mask = explorer.filtered(shortened, [self.repo, self.account, self.user])
         asker = ask_for_choice
 
@@ -231,7 +336,7 @@ class Credo(object):
             if mask[repo][account]:
                 user = mask[repo][account].keys()[0]
 
-        credential_path = CredentialPath(self.crypto)
+        credential_path = CredentialPath(self.crypto, identity_cache=self.identity_cache, sync_interval=getattr(self, "sync_interval", None), session_cache=self.session_cache, cache_dir=self.cache_dir)
         credential_path.fill_out(directory_structure, repo, account, user, typ=typ)
 
         if credential_path.user:
@@ -251,6 +356,10 @@ class Credo(object):
         user = kwargs.get("user")
         account = kwargs.get("account")
 
+        # Kept apart from the offline option so write_config doesn't remember it
+        if kwargs.get("offline"):
+            self.offline_from_args = True
+
         if account and "@" in account:
             if account.count("@") > 1:
                 raise BadConfiguration("Account may only have one @ in it", account=account)
@@ -292,9 +401,15 @@ class Credo(object):
             if option in options:
                 setattr(self, option, options[option])
 
+    @property
+    def stay_offline(self):
+        """Whether the command line or config says to not use the network"""
+        return bool(getattr(self, "offline_from_args", False) or getattr(self, "offline", False))
+
     def write_config(self):
         """Write the configuration"""
         cfg = dict((option, getattr(self, option, None)) for option in self.options_from_config)
+        cfg["cache_dir"] = getattr(self, "_cache_dir", None)
         json.dump(cfg, open(self.config_file_location, "w"))
 
     ########################
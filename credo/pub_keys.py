@@ -1,10 +1,14 @@
 from __future__ import print_function
 
 from credo.asker import ask_for_choice, ask_for_public_keys
+from credo.helper import read_json_file, write_json_atomically
 from credo.errors import BadConfiguration, UserQuit
+from credo import connections
 
+import threading
 import requests
 import logging
+import Queue
 import json
 import time
 import sys
@@ -12,12 +16,120 @@ import os
 
 log = logging.getLogger("credo.pub_keys")
 
+class PemCache(object):
+    """
+    Pems we got from urls, along with when we got them and what we need to ask
+    the server whether they changed since then
+
+    The whole cache is read once and written once, atomically.
+    """
+    max_age = 3600
+    timeout = 10
+    workers = 8
+
+    def __init__(self, location):
+        self.location = location
+        self.changed = False
+
+        self.cache = read_json_file(location, {})
+        if not isinstance(self.cache, dict):
+            self.cache = {}
+        for key in ("times", "cached", "etags", "modified"):
+            if not isinstance(self.cache.get(key), dict):
+                self.cache[key] = {}
+
+    def pems(self, url):
+        """Return the pems we have for this url or None if we don't have any"""
+        cached = self.cache["cached"].get(url)
+        if isinstance(cached, list) and all(isinstance(pem, basestring) for pem in cached):
+            return cached
+
+    def stale(self, url):
+        """Say whether our pems for this url are too old to trust without asking again"""
+        last_downloaded = self.cache["times"].get(url)
+        if not isinstance(last_downloaded, (int, float)):
+            return True
+        diff = time.time() - last_downloaded
+        return diff < 0 or diff > self.max_age
+
+    def refresh(self, urls):
+        """Ask for all these urls at once, only getting the pems back if they changed"""
+        jobs = Queue.Queue()
+        for url in urls:
+            jobs.put((url, self.cache["etags"].get(url), self.cache["modified"].get(url), self.pems(url) is not None))
+
+        results = []
+        def worker():
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                results.append((job[0], self.fetch(*job)))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, len(urls)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for url, response in results:
+            if response is None:
+                continue
+
+            self.changed = True
+            self.cache["times"][url] = time.time()
+            if response.status_code == 304:
+                log.debug("Pems haven't changed\turl=%s", url)
+                continue
+
+            self.cache["cached"][url] = [line for line in response.content.split("\n") if line.startswith("ssh-rsa")]
+            for key, header in (("etags", "ETag"), ("modified", "Last-Modified")):
+                if response.headers.get(header):
+                    self.cache[key][url] = response.headers[header]
+                else:
+                    self.cache[key].pop(url, None)
+            log.info("Got %s keys from %s", len(self.cache["cached"][url]), url)
+
+    def fetch(self, url, etag, modified, conditional):
+        """Return the response from asking for this url, or None if that didn't work"""
+        headers = {}
+        if conditional:
+            if etag:
+                headers["If-None-Match"] = etag
+            if modified:
+                headers["If-Modified-Since"] = modified
+
+        try:
+            response = connections.session().get(url, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            log.error("Failed to get pem keys from url\turl=%s\terr=%s\treason=%s", url, err.__class__.__name__, err)
+            return None
+
+        if response.status_code == 304 and conditional:
+            return response
+        if response.status_code != 200:
+            log.error("Failed to get pem keys from url\turl=%s\tstatus=%s", url, response.status_code)
+            return None
+        return response
+
+    def save(self):
+        """Write the cache if we changed it"""
+        if not self.changed:
+            return
+
+        try:
+            write_json_atomically(self.location, self.cache)
+        except (IOError, OSError) as err:
+            log.error("Couldn't write cache\tlocation=%s\terr=%s", self.location, err)
+
 class PubKeySyncer(object):
     """Knows about what public keys we can encrypt with"""
-    def __init__(self, root_dir, repository):
+    def __init__(self, cache_dir, repository):
         self.repository = repository
         self.crypto = self.repository.crypto
-        self.root_dir = root_dir
+        self.cache_dir = cache_dir
 
     def sync(self, ask_anyway=False):
         """
@@ -46,10 +158,9 @@ class PubKeySyncer(object):
             info["pems"].extend(pems)
             info["locations"].update(locations)
 
-            downloaded = []
+            downloaded = self.download_all_pems(info.get("urls", []))
             for url in info.get("urls", []):
-                downloaded.extend(self.download_pems(url))
-            info["pems"].extend(downloaded)
+                info["pems"].extend(downloaded[url])
 
             for pem in info["pems"]:
                 location = info["locations"].get(pem)
@@ -75,70 +186,37 @@ class PubKeySyncer(object):
                 log.info("Removing public key we aren't encrypting with anymore\tfingerprint=%s", fingerprint)
                 crypto.remove_public_key(fingerprint)
 
-    def download_pems(self, url):
-        """Get pems from some url"""
-        cache = {}
-        cache_location = os.path.join(self.root_dir, "cache")
-        if os.path.exists(cache_location):
-            try:
-                with open(cache_location) as fle:
-                    cache = json.load(fle)
-            except ValueError as err:
-                log.warning("Failed to load the pem url cache\tlocation=%s\terr=%s", cache_location, err)
-        else:
-            log.debug("No cache to load urls from\tlocation=%s", cache_location)
-
-        last_downloaded = None
-        if url in cache.get("cached", {}):
-            if "times" in cache and url in cache["times"]:
-                last_downloaded = cache["times"][url]
-                if not isinstance(last_downloaded, float) and not isinstance(last_downloaded, int):
-                    last_downloaded = None
+    @property
+    def cache_location(self):
+        return os.path.join(self.cache_dir, "cache")
 
-                else:
-                    diff = time.time() - last_downloaded
-                    if diff < 0 or diff > 3600:
-                        log.info("Cache for %s is older than an hour, re-getting the keys", url)
-                        last_downloaded = None
-
-        cached = []
-        if last_downloaded is not None and url in cache.get("cached", {}):
-            cached = cache["cached"][url]
-            if isinstance(cached, list) and all(isinstance(pem, basestring) for pem in cached):
-                log.info("Using %s cached pem keys from %s", len(cached), url)
-                return cached
-
-        if "times" not in cache:
-            cache["times"] = {}
-        cache["times"][url] = time.time()
-
-        if "cached" not in cache:
-            cache["cached"] = {}
-
-        try:
-            lines = requests.get(url).content.split('\n')
-        except requests.exceptions.RequestException as err:
-            lines = None
-            log.error("Failed to get pem keys from url\turl=%s\terr=%s\treason=%s", url, err.__class__.__name__, err)
-            if cached:
-                log.info("Using %s keys from cache of %s", len(cached), url)
+    def download_all_pems(self, urls):
+        """
+        Return {url: pems} for these urls
 
-        if lines:
-            cached = []
-            for line in lines:
-                if line.startswith("ssh-rsa"):
-                    cached.append(line)
+        Urls we have no pems for are downloaded now, all at once. Urls we have
+        pems for that are older than max_age are used as is and refreshed in a
+        background process.
+        """
+        cache = PemCache(self.cache_location)
 
-            cache["cached"][url] = cached
-            log.info("Got %s keys from %s", len(cached), url)
+        missing = [url for url in urls if cache.pems(url) is None]
+        if missing and connections.is_offline():
+            log.warning("Can't download pem keys while offline\turls=%s", missing)
+        elif missing:
+            cache.refresh(missing)
+            cache.save()
 
-            try:
-                with open(cache_location, "w") as fle:
-                    json.dump(cache, fle)
-            except ValueError as err:
-                log.error("Couldn't write cache\tlocation=%s\terr=e%s", cache_location, err)
+        stale = [url for url in urls if url not in missing and cache.stale(url)]
+        if stale and not connections.is_offline():
+            from credo import background
+            background.refresh_pems(self.cache_location, stale)
 
-        return cached
+        result = {}
+        for url in urls:
+            result[url] = cache.pems(url) or []
+            log.info("Using %s pem keys from %s", len(result[url]), url)
+        return result
 
     def get_public_keys(self, ask_anyway=False, known_private_key_fingerprints=None, remote=None):
         """
@@ -238,6 +316,8 @@ class PubKeySyncer(object):
 
         fingerprint, signature = signature
         for_signing = self.make_signing_value(contents.get("urls", []), contents.get("pems", []))
+        if self.crypto.verified_before(for_signing, fingerprint, signature):
+            return contents
 
         has_public_key = self.crypto.retrieve_public_key_from_disk(fingerprint, reason="to check the signature in {0}".format(location))
         if has_public_key and self.crypto.is_signature_valid(for_signing, fingerprint, signature):
@@ -0,0 +1,157 @@
+from credo.asker import non_interactive
+from credo.errors import CredoError
+
+from collections import namedtuple
+import threading
+import logging
+import random
+import Queue
+import time
+import boto
+
+log = logging.getLogger("credo.rotation")
+
+class RotationResult(namedtuple("RotationResult", ["path", "status", "detail"])):
+    """What happened when we tried to rotate some credentials"""
+
+class FleetRotation(object):
+    """
+    Rotates many credentials at once
+
+    The talking to amazon is done by a pool of workers threads, with at most
+    per_account of them working on the same account at once, and calls that
+    amazon throttles being retried with exponential backoff.
+
+    Saving the credentials is left to whoever calls run so that encryption
+    and committing happens in one thread. The private keys the credentials
+    need are unlocked before the workers start, because they can't ask for
+    passwords.
+    """
+    throttled_codes = ("Throttling", "ThrottlingException", "RequestLimitExceeded")
+
+    def __init__(self, credentials, half_life=None, force=False, workers=8, per_account=2, attempts=5, backoff=1):
+        self.force = force
+        self.backoff = backoff
+        self.workers = max(1, workers)
+        self.attempts = max(1, attempts)
+        self.half_life = half_life
+        self.per_account = max(1, per_account)
+        self.credentials = list(credentials)
+
+        self.account_locks = {}
+        self.account_locks_lock = threading.Lock()
+        self.account_released = threading.Condition()
+
+    def account_lock(self, credentials):
+        """Return the semaphore for the account these credentials are for"""
+        cred_path = credentials.credential_path
+        account = (cred_path.repository.name, cred_path.account.name)
+        with self.account_locks_lock:
+            if account not in self.account_locks:
+                self.account_locks[account] = threading.BoundedSemaphore(self.per_account)
+            return self.account_locks[account]
+
+    def is_throttled(self, error):
+        """Say whether this error is amazon telling us to slow down"""
+        return isinstance(error, boto.exception.BotoServerError) and (error.code in self.throttled_codes or error.status == 429)
+
+    def with_backoff(self, func):
+        """Call func, trying again with exponential backoff if amazon throttles us"""
+        for attempt in range(self.attempts):
+            try:
+                return func()
+            except boto.exception.BotoServerError as error:
+                if not self.is_throttled(error) or attempt == self.attempts - 1:
+                    raise
+                wait = self.backoff * (2 ** attempt) * (1 + random.random())
+                log.info("Amazon is throttling us, waiting before trying again\twait=%.1f\terror_code=%s", wait, error.code)
+                time.sleep(wait)
+
+    def rotate_one(self, credentials):
+        """Rotate these credentials and return a RotationResult"""
+        keys = credentials.keys
+        if not hasattr(keys, "rotate"):
+            return RotationResult(credentials.path, "skipped", "Not amazon credentials")
+
+        if self.force:
+            credentials.invalidate_creds()
+
+        if not self.with_backoff(keys.needs_rotation):
+            return RotationResult(credentials.path, "unchanged", None)
+
+        iam_pair = self.with_backoff(lambda: keys.iam_pair)
+        if not iam_pair:
+            return RotationResult(credentials.path, "failed", "No working keys to rotate with")
+
+        half_life = self.half_life or iam_pair.half_life
+        if self.with_backoff(lambda: keys.rotate(half_life)):
+            return RotationResult(credentials.path, "rotated", None)
+        return RotationResult(credentials.path, "unchanged", None)
+
+    def worker(self, jobs, results):
+        """Rotate credentials from jobs until there are none left"""
+        skipped = set()
+        while True:
+            try:
+                credentials = jobs.get_nowait()
+            except Queue.Empty:
+                return
+
+            # Put credentials for a busy account back so we can work on other accounts
+            account_lock = self.account_lock(credentials)
+            if not account_lock.acquire(False):
+                jobs.put(credentials)
+                if id(credentials) in skipped:
+                    # Everything left is for busy accounts, so wait for one of them to be free
+                    with self.account_released:
+                        self.account_released.wait(0.1)
+                    skipped.clear()
+                else:
+                    skipped.add(id(credentials))
+                continue
+            skipped.clear()
+
+            try:
+                results.append(self.rotate_one(credentials))
+            except CredoError as error:
+                results.append(RotationResult(credentials.path, "failed", "{0}: {1}".format(error.__class__.__name__, error)))
+            except Exception as error:
+                log.exception("Unexpected error rotating credentials\tpath=%s", credentials.path)
+                results.append(RotationResult(credentials.path, "failed", "{0}: {1}".format(error.__class__.__name__, error)))
+            finally:
+                account_lock.release()
+                with self.account_released:
+                    self.account_released.notify_all()
+
+    def unlock(self):
+        """Unlock the private keys our credentials are encrypted for while we can still ask for passwords"""
+        needed = {}
+        for credentials in self.credentials:
+            keys = credentials.keys
+            if hasattr(keys, "secret_fingerprints"):
+                crypto = credentials.credential_path.crypto
+                needed.setdefault(id(crypto), (crypto, set()))[1].update(keys.secret_fingerprints)
+
+        for crypto, fingerprints in needed.values():
+            crypto.unlock(fingerprints)
+
+    def run(self):
+        """Rotate all our credentials and return a list of RotationResult"""
+        self.unlock()
+
+        jobs = Queue.Queue()
+        for credentials in self.credentials:
+            jobs.put(credentials)
+
+        results = []
+        with non_interactive():
+            threads = [threading.Thread(target=self.worker, args=(jobs, results)) for _ in range(min(self.workers, len(self.credentials)))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                # Join with a timeout so ctrl-c still works
+                while thread.is_alive():
+                    thread.join(1)
+
+        return sorted(results)
@@ -0,0 +1,132 @@
+"""
+Tornado handlers for the fake metadata service
+
+Anything that talks to amazon or an idp is done in the server's executor so
+the ioloop is free to answer everyone else in the meantime.
+"""
+from credo.cred_types.saml import SamlInfo, SamlRole
+from credo.errors import SamlNotAuthorized
+
+from tornado import web, gen
+import logging
+import json
+
+log = logging.getLogger("credo.server.handlers")
+
+class MetadataHandler(web.RequestHandler):
+    """Base for our handlers that knows about the server and IMDSv2 tokens"""
+    def initialize(self, server):
+        self.server = server
+
+    def prepare(self):
+        # Requests without a token are IMDSv1 requests and are still allowed
+        if self.request.method == "GET":
+            token = self.request.headers.get(self.server.token_header)
+            if token is not None and not self.server.token_valid(token):
+                self.empty_response(401)
+
+    def empty_response(self, status):
+        self.set_status(status)
+        self.finish()
+
+    def json_error(self, status, error):
+        self.set_status(status)
+        self.finish({"error": error})
+
+    def write_error(self, status_code, **kwargs):
+        errors = {400: "bad request", 404: "not found"}
+        self.finish({"error": errors.get(status_code, "internal server error")})
+
+class NotFoundHandler(MetadataHandler):
+    def prepare(self):
+        raise web.HTTPError(404)
+
+class StaticHandler(MetadataHandler):
+    """Serve a body that never changes"""
+    def initialize(self, server, body):
+        self.server = server
+        self.body = body
+
+    def get(self):
+        self.finish(self.body)
+
+class TokenHandler(MetadataHandler):
+    def put(self):
+        # Like amazon, refuse tokens for requests that came through a proxy
+        if self.request.headers.get("X-Forwarded-For"):
+            return self.empty_response(403)
+
+        try:
+            ttl = int(self.request.headers.get(self.server.token_ttl_header, ""))
+        except ValueError:
+            return self.empty_response(400)
+        if ttl < 1 or ttl > self.server.max_token_ttl:
+            return self.empty_response(400)
+
+        self.set_header("Content-Type", "text/plain")
+        self.set_header(self.server.token_ttl_header, str(ttl))
+        self.finish(self.server.make_token(ttl))
+
+class SwitchHandler(MetadataHandler):
+    def prepare(self):
+        # Anything on the machine can reach a container credentials server, so switching needs the token too
+        if self.server.container and not self.server.authorized(self.request.headers.get("Authorization")):
+            self.empty_response(401)
+
+    @gen.coroutine
+    def post(self):
+        if not self.request.body:
+            self.json_error(500, "Need post data")
+            return
+
+        try:
+            obj = json.loads(self.request.body)
+            saml_info = SamlInfo(obj["provider"], SamlRole(obj["principal_arn"], obj["role_arn"]), obj["idp_username"])
+        except (ValueError, TypeError, KeyError, AttributeError) as error:
+            log.warning("Got a bad switch request\terror_type=%s\terror=%s", error.__class__.__name__, error)
+            self.json_error(400, "bad request")
+            return
+
+        basic_auth = obj.get("basic_auth", self.server.basic_auth)
+        if basic_auth is None:
+            self.json_error(500, "NEED_AUTH")
+            return
+
+        try:
+            yield self.server.executor.submit(self.server.switch, saml_info, basic_auth, obj.get("role_name"))
+        except SamlNotAuthorized:
+            self.json_error(500, "BAD_PASSWORD")
+            return
+        self.finish("success")
+
+class RoleListHandler(MetadataHandler):
+    def get(self):
+        self.finish(self.server.role_listing)
+
+class CredentialsHandler(MetadataHandler):
+    @gen.coroutine
+    def get(self, name):
+        role = self.server.roles.get(name)
+        if role is None:
+            if not self.server.roles:
+                self.json_error(500, "DO SWITCH")
+            else:
+                self.json_error(404, "not found")
+            return
+
+        body = role.fresh_keys_body()
+        if body is None:
+            if role.basic_auth is None:
+                self.json_error(500, "DO SWITCH")
+                return
+            keys = yield self.server.executor.submit(getattr, role, "keys")
+            body = role.keys_body(keys)
+
+        self.set_header("Content-Type", "application/json")
+        self.finish(body)
+
+class ContainerCredentialsHandler(CredentialsHandler):
+    """Serve keys like the ECS container credentials endpoint"""
+    def prepare(self):
+        if not self.server.authorized(self.request.headers.get("Authorization")):
+            self.empty_response(401)
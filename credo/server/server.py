@@ -4,40 +4,201 @@ from credo.amazon import IamSaml
 
 from datetime import datetime, timedelta
 from boto.utils import parse_ts
+import threading
 import logging
-import pickle
+import base64
+import hmac
+import boto
+import json
+import time
 import sys
 import os
 
 log = logging.getLogger("credo.server")
 
+class ServedRole(object):
+    """The saml role the server hands out keys for under one name, and those keys"""
+    def __init__(self, server, name, saml_info, basic_auth):
+        self.name = name
+        self.server = server
+        self.saml_info = saml_info
+        self.basic_auth = basic_auth
+
+        self.lock = threading.Lock()
+        self._keys = None
+        self._keys_body = None
+
+    @property
+    def basic_auth(self):
+        if self._basic_auth is not None and datetime.utcnow() > self._basic_auth_time + timedelta(hours=4):
+            log.warning("Password is too old to refresh keys with, switch again to keep them fresh\trole=%s", self.name)
+            self._basic_auth = None
+        return self._basic_auth
+
+    @basic_auth.setter
+    def basic_auth(self, val):
+        self._basic_auth = val
+        self._basic_auth_time = datetime.utcnow()
+
+    @property
+    def keys(self):
+        """
+        Return our keys, only assuming the role here if we have none or they expired
+
+        Normally the refresher renews them before that happens
+        """
+        keys = self._keys
+        if keys is not None and datetime.utcnow() <= parse_ts(keys["Expiration"]):
+            return keys
+
+        with self.lock:
+            keys = self._keys
+            if keys is not None:
+                if datetime.utcnow() <= parse_ts(keys["Expiration"]):
+                    return keys
+                log.info("Keys expired, recreating them\trole=%s", self.name)
+
+            log.info("Assuming role\trole=%s", self.name)
+            self._keys = self.server.assume_role(self.saml_info, self.basic_auth)
+
+        # Let the refresher know when these need renewing
+        self.server.refresh_wanted.set()
+        return self._keys
+
+    @keys.setter
+    def keys(self, val):
+        self._keys = val
+
+    def fresh_keys_body(self):
+        """Return our keys as json if we have some that haven't expired"""
+        keys = self._keys
+        if keys is None:
+            return None
+        body = self.keys_body(keys)
+        if datetime.utcnow() <= self._keys_body[2]:
+            return body
+
+    def keys_body(self, keys):
+        """Return these keys as json, only serializing them when they change"""
+        cached = self._keys_body
+        if cached is None or cached[0] is not keys:
+            cached = self._keys_body = (keys, json.dumps(keys, indent=2), parse_ts(keys["Expiration"]))
+        return cached[1]
+
+    def seconds_until_refresh(self, margin):
+        """Return how long until our keys should be renewed, or None if we have none or can't renew them"""
+        keys = self._keys
+        if keys is None or self.basic_auth is None:
+            return None
+        expiration = parse_ts(keys["Expiration"]) - timedelta(seconds=margin)
+        return (expiration - datetime.utcnow()).total_seconds()
+
+    def refresh(self):
+        """Get new keys for these credentials and swap them in, returning whether we did"""
+        basic_auth = self.basic_auth
+        if basic_auth is None:
+            log.warning("Can't refresh keys without a recent password\trole=%s", self.name)
+            return False
+
+        log.info("Refreshing keys before they expire\trole=%s", self.name)
+        try:
+            keys = self.server.assume_role(self.saml_info, basic_auth)
+        except (CredoError, boto.exception.BotoServerError) as error:
+            log.error("Failed to refresh keys\trole=%s\terror_type=%s\terror=%s", self.name, error.__class__.__name__, error)
+            return False
+
+        with self.lock:
+            # Don't bother if a switch replaced us while we were busy
+            if self.server.roles.get(self.name) is not self:
+                return False
+            self._keys = keys
+        return True
+
 class Server(object):
-    def __init__(self, host, port, credo):
+    token_header = "X-aws-ec2-metadata-token"
+    token_ttl_header = "X-aws-ec2-metadata-token-ttl-seconds"
+    max_token_ttl = 21600
+    default_role_name = "BaseIAMRole"
+
+    def __init__(self, host, port, credo, refresh_margin=300, workers=4, container=False, auth_token=None):
         self.host = host
         self.port = port
         self.credo = credo
+        self.tokens = {}
+        self.workers = workers
+        self.container = container
+        self.auth_token = auth_token
+        self.refresh_margin = refresh_margin
+
+        self.roles = {}
+        self.role_listing = self.default_role_name
+        self.roles_lock = threading.Lock()
+        self.refresh_wanted = threading.Event()
 
     def start(self):
-        try:
-            from tornado.httpserver import HTTPServer
-            from tornado.wsgi import WSGIContainer
-            from tornado.ioloop import IOLoop
-        except ImportError:
-            raise CredoError("Please pip install tornado")
-        http_server = HTTPServer(WSGIContainer(self.app))
-        http_server.listen(self.port, self.host)
-        IOLoop.instance().start()
+        app = self.app
+        from tornado.ioloop import IOLoop
 
-    @property
-    def credentials(self):
-        return getattr(self, "_credentials", None)
+        self.start_refresher()
+        app.listen(self.port, self.host)
+        IOLoop.current().start()
+
+    def start_refresher(self):
+        """Start a thread that renews our keys before they expire"""
+        refresher = threading.Thread(target=self.refresh_loop, name="credo-refresher")
+        refresher.daemon = True
+        refresher.start()
+        return refresher
+
+    def seconds_until_refresh(self):
+        """Return how long until the next role's keys should be renewed, or None if we have none"""
+        waits = [role.seconds_until_refresh(self.refresh_margin) for role in list(self.roles.values())]
+        waits = [wait for wait in waits if wait is not None]
+        if not waits:
+            return None
+        return min(waits)
 
-    @credentials.setter
-    def credentials(self, val):
-        self._credentials = val
+    def refresh_loop(self, retry_after=30):
+        """Renew keys refresh_margin seconds before they expire, forever"""
+        while True:
+            wait = self.seconds_until_refresh()
+            if wait is None or wait > 0:
+                # Wait till it's time or till switch gives us new keys
+                self.refresh_wanted.wait(60 if wait is None else min(wait, 3600))
+                self.refresh_wanted.clear()
+                continue
+
+            if not self.refresh():
+                self.refresh_wanted.wait(retry_after)
+                self.refresh_wanted.clear()
+
+    def refresh(self):
+        """Renew the keys for every role that is due, returning whether they all were"""
+        refreshed = True
+        for role in list(self.roles.values()):
+            wait = role.seconds_until_refresh(self.refresh_margin)
+            if wait is not None and wait <= 0:
+                refreshed = role.refresh() and refreshed
+        return refreshed
+
+    def assume_role(self, saml_info, basic_auth):
+        """Assume the role from this SamlInfo and return keys as the metadata service gives them"""
+        pair = IamSaml(saml_info.provider, saml_info.idp_username, "")
+        pair.basic_auth = basic_auth
+        keys = pair.get_result(saml_info.role).credentials.to_dict()
+
+        return {
+              "Code": "Success"
+            , "LastUpdated": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S:00Z")
+            , "AccessKeyId": keys["access_key"]
+            , "SecretAccessKey": keys["secret_key"]
+            , "Token": keys["session_token"]
+            , "Expiration": keys["expiration"]
+            }
 
     @property
     def basic_auth(self):
+        """The most recent password we were given, so switch doesn't have to ask every time"""
         if datetime.utcnow() > getattr(self, "_basic_auth_time", datetime.utcnow()) + timedelta(hours=4):
             self._basic_auth = None
         return getattr(self, "_basic_auth", None)
@@ -47,107 +208,78 @@ class Server(object):
         self._basic_auth = val
         self._basic_auth_time = datetime.utcnow()
 
-    @property
-    def keys(self):
-        keys = getattr(self, "_keys", None)
-        if keys is not None:
-            expiration = parse_ts(keys["Expiration"])
-            if datetime.utcnow() > expiration:
-                log.info("Keys expired, recreating them")
-                keys = None
+    def switch(self, saml_info, basic_auth, name=None):
+        """Serve keys for this SamlInfo under this name, assuming the role straight away"""
+        role = ServedRole(self, name or self.default_role_name, saml_info, basic_auth)
 
-        if keys is None:
-            log.info("Assuming role")
-            pair = IamSaml(self.credentials.keys.provider, self.credentials.keys.idp_username, "")
-            pair.basic_auth = self.basic_auth
-            keys = pair.get_result(self.credentials.keys.role).credentials.to_dict()
-
-            self._keys = {
-                  "Code": "Success"
-                , "LastUpdated": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S:00Z")
-                , "AccessKeyId": keys["access_key"]
-                , "SecretAccessKey": keys["secret_key"]
-                , "Token": keys["session_token"]
-                , "Expiration": keys["expiration"]
-                }
-        return self._keys
+        # keys is a property that actually gets the credentials
+        role.keys
+        self.basic_auth = basic_auth
 
-    @keys.setter
-    def keys(self, val):
-        self._keys = val
+        with self.roles_lock:
+            self.roles[role.name] = role
+            self.role_listing = "\n".join(sorted(self.roles))
+        log.info("Switched role\trole=%s", role.name)
+        return role
 
-    @property
-    def app(self):
-        try:
-            from flask import Flask
-        except ImportError:
-            raise CredoError("Please pip install flask")
+    def make_token(self, ttl):
+        """Make a session token like the IMDSv2 token endpoint does"""
+        now = time.time()
+        for token, expires in list(self.tokens.items()):
+            if expires < now:
+                del self.tokens[token]
 
-        if getattr(self, "_app", None) is None:
-            self._app = Flask("credo.server")
-            self.register_routes(self._app)
-        return self._app
+        token = base64.urlsafe_b64encode(os.urandom(32)).rstrip("=")
+        self.tokens[token] = now + ttl
+        return token
 
-    def register_routes(self, app):
-        from flask import jsonify, abort, make_response, request
+    def token_valid(self, token):
+        """Say whether this is a token we made that hasn't expired"""
+        return self.tokens.get(token, 0) > time.time()
 
-        @app.route('/', methods = ['GET'])
-        def index():
-            return 'latest'
+    def authorized(self, authorization):
+        """Say whether this Authorization header has our container auth token"""
+        if not self.auth_token or authorization is None:
+            return False
+        return hmac.compare_digest(str(authorization), str(self.auth_token))
 
-        @app.route('/latest/', methods = ['GET'])
-        def latest():
-            return 'meta-data'
+    def container_credentials_uri(self, name=None):
+        """The uri to give sdks in AWS_CONTAINER_CREDENTIALS_FULL_URI for this role"""
+        return "http://{0}:{1}/credentials/{2}".format(self.host, self.port, name or self.default_role_name)
 
-        @app.route('/latest/meta-data/', methods = ['GET'])
-        def meta_data():
-            return 'iam\nswitch'
+    @property
+    def app(self):
+        if getattr(self, "_app", None) is None:
+            try:
+                from concurrent.futures import ThreadPoolExecutor
+                from credo.server import handlers
+                from tornado import web
+            except ImportError:
+                raise CredoError("Please pip install tornado")
 
-        @app.route('/latest/meta-data/switch/', methods = ["POST"])
-        def switch():
-            if not request.data:
-                return make_response(jsonify({"error": "Need post data"}), 500)
-            obj = pickle.loads(request.data)
-            basic_auth = obj.get("basic_auth", self.basic_auth)
-            credentials = obj["credentials"]
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
 
-            if basic_auth is None:
-                return make_response(jsonify({"error": "NEED_AUTH"}), 500)
+            if self.container:
+                # Like the ECS agent, so sdks don't have to probe for a metadata service first
+                routes = [("/credentials/([^/]+)", handlers.ContainerCredentialsHandler, {"server": self})]
             else:
-                self.basic_auth = basic_auth
-                self.credentials = credentials
-                self.keys = None
-
-                # keys is a property that actually gets the credentials
-                try:
-                    self.keys
-                except SamlNotAuthorized:
-                    return make_response(jsonify({"error": "BAD_PASSWORD"}), 500)
-                return "success"
-
-        @app.route('/latest/meta-data/iam/', methods = ['GET'])
-        def iam():
-            return 'security-credentials'
-
-        @app.route('/latest/meta-data/iam/security-credentials/', methods = ['GET'])
-        def security_credentials():
-            return 'BaseIAMRole'
-
-        @app.route('/latest/meta-data/iam/security-credentials/BaseIAMRole', methods = ['GET'])
-        def base_iam_role():
-            if self.credentials is None or self.basic_auth is None:
-                return make_response(jsonify({"error": "DO SWITCH"}), 500)
-            return jsonify(self.keys)
-
-        @app.errorhandler(400)
-        def not_found(error):
-            return make_response(jsonify({'error': 'bad request'}), 400)
-
-        @app.errorhandler(404)
-        def not_found(error):
-            return make_response(jsonify({'error': 'not found'}), 404)
-
-        @app.errorhandler(500)
-        def not_found(error):
-            return make_response(jsonify({'error': 'internal server error'}), 500)
+                static = {
+                      "/": "latest"
+                    , "/latest/": "meta-data"
+                    , "/latest/meta-data/": "iam\nswitch"
+                    , "/latest/meta-data/iam/": "security-credentials"
+                    }
+
+                routes = [(path, handlers.StaticHandler, {"server": self, "body": body}) for path, body in static.items()]
+                routes.extend([
+                      ("/latest/api/token", handlers.TokenHandler, {"server": self})
+                    , ("/latest/meta-data/iam/security-credentials/", handlers.RoleListHandler, {"server": self})
+                    , ("/latest/meta-data/iam/security-credentials/([^/]+)", handlers.CredentialsHandler, {"server": self})
+                    ])
+            routes.append(("/latest/meta-data/switch/", handlers.SwitchHandler, {"server": self}))
 
+            self._app = web.Application(routes
+                , default_handler_class = handlers.NotFoundHandler
+                , default_handler_args = {"server": self}
+                )
+        return self._app
@@ -0,0 +1,66 @@
+"""
+Printing and using exports for the shell
+
+This is imported by the cli before it knows what it's doing, so it must stay
+cheap to import
+"""
+import os
+
+def make_export_commands(exports, no_transform=False):
+    """Yield export and unset commands for these (key, val) exports"""
+    for key, val in exports:
+        if val == "CREDO_UNSET" and not no_transform:
+            yield "unset {0}".format(key)
+        else:
+            yield "export {0}=\"{1}\"".format(key, val.replace("\\\"", "\"").replace("\"", "\\\""))
+
+def do_unset(credo, **kwargs):
+    """Just print out the exports and unsets necessary to unset credo exports"""
+    exports = []
+    for key, val in os.environ.items():
+        if key.startswith("CREDO_UNSET"):
+            name = key[12:]
+            exports.append((name, val))
+            exports.append((key, "CREDO_UNSET"))
+
+    for command in make_export_commands(exports):
+        print(command)
+
+def print_exports(exports, path):
+    """Print out export lines for these (key, val) exports and unsetters for what they override"""
+    shell_exports = {}
+    for key, val in exports:
+        shell_exports[key] = val
+
+    if not shell_exports:
+        print("# {0} has no environment variables".format(path))
+
+    unsetters = {}
+    for key, val in shell_exports.items():
+        name = "CREDO_UNSET_{0}".format(key)
+        if key not in os.environ or os.environ[key] == val:
+            unsetters[name] = "CREDO_UNSET"
+        else:
+            unsetters[name] = os.environ[key]
+
+    print("## Find values to unset")
+    do_unset(None)
+
+    print("\n## Values to be set now")
+    for command in make_export_commands(sorted(shell_exports.items())):
+        print(command)
+
+    print("\n## And unsetters for when we change")
+    for command in make_export_commands(sorted(unsetters.items()), no_transform=True):
+        print(command)
+
+def exec_with_exports(command, exports):
+    """Replace this process with the command, using an environment with these (key, val) exports"""
+    environment = dict(os.environ)
+    for key, val in exports:
+        if val == "CREDO_UNSET":
+            if key in environment:
+                del environment[key]
+        else:
+            environment[key] = val
+    os.execvpe(command[0], command, environment)
@@ -16,12 +16,16 @@ class CredentialPath(object):
     repository = None
     credentials = None
 
-    def __init__(self, crypto):
+    def __init__(self, crypto, identity_cache=None, sync_interval=None, session_cache=None, cache_dir=None):
         self.crypto = crypto
+        self.cache_dir = cache_dir
+        self.sync_interval = sync_interval
+        self.session_cache = session_cache
+        self.identity_cache = identity_cache
 
     def fill_out(self, directory_structure, repo, account, user, typ="amazon"):
         """Make the things leading up to the credentials"""
-        self.repository = Repository(repo, directory_structure[repo]['/location/'], self.crypto)
+        self.repository = Repository(repo, directory_structure[repo]['/location/'], self.crypto, sync_interval=self.sync_interval, cache_dir=self.cache_dir)
         if account:
             self.account = Account(account, directory_structure[repo][account]['/location/'], self)
             if user:
@@ -1,20 +1,28 @@
 from credo.cred_types.saml import SamlInfo, SamlRole
 from credo.cred_types.amazon import AmazonKeys
-from credo.errors import BadCredentialFile
+from credo.errors import BadCredentialFile, Offline
 from credo.structure.keys import Keys
 from credo.asker import get_response
 from credo.amazon import IamSaml
+from credo import connections
+
+from boto.utils import parse_ts
+import calendar
 import logging
 
 log = logging.getLogger("credo.structure.credentials")
 
+def expires_epoch(creds):
+    """Return when these sts credentials expire as seconds since the epoch"""
+    return calendar.timegm(parse_ts(creds.expiration).timetuple())
+
 class Credentials(Keys):
     """Knows about credential files"""
     requires_encryption = True
 
-    def save(self, force=False, half_life=None):
-        """Save our credentials to file"""
-        if self.keys.needs_rotation():
+    def save(self, force=False, half_life=None, rotate=True):
+        """Save our credentials to file, rotating our keys first if they need it and rotate is True"""
+        if rotate and self.keys.needs_rotation():
             self.keys.rotate(half_life)
 
         if force or self.changed or self.keys.changed:
@@ -96,10 +104,51 @@ class SamlCredentials(Credentials):
         return "Saml things!"
 
     def exports(self):
-        """Export some values"""
-        password = get_response("Password for idp user {0}".format(self.keys.idp_username), password=True)
-        pair = IamSaml(self.keys.provider, self.keys.idp_username, password)
-        return pair.exports(self.keys.role)
+        """Export some values, using a cached session if we have one that hasn't expired"""
+        keys = self.keys
+        session_cache = getattr(self.credential_path, "session_cache", None)
+        if session_cache is not None:
+            exports = session_cache.lookup(keys.provider, keys.idp_username, keys.role.role_arn)
+            if exports:
+                log.info("Using cached saml session\trole=%s", keys.role.role_arn)
+                return exports
+
+        if connections.is_offline():
+            raise Offline("No cached saml session to use", role=keys.role.role_arn)
+
+        password = get_response("Password for idp user {0}".format(keys.idp_username), password=True)
+        pair = IamSaml(keys.provider, keys.idp_username, password)
+        creds = pair.session(keys.role)
+        exports = pair.exports_for(creds)
+
+        if session_cache is not None:
+            session_cache.record(keys.provider, keys.idp_username, keys.role.role_arn, exports, expires_epoch(creds))
+        return exports
+
+    def assume_many(self, roles=None, workers=8):
+        """
+        Assume many roles from one idp login and return [(role, credentials, error)]
+
+        Roles is a list of role arns or names and defaults to every role the idp
+        says we have. Every session we get is put in the session cache.
+        """
+        keys = self.keys
+        password = get_response("Password for idp user {0}".format(keys.idp_username), password=True)
+        pair = IamSaml(keys.provider, keys.idp_username, password)
+
+        wanted = pair.arns
+        if roles:
+            wanted = [role for role in wanted if role.role_arn in roles or role.role_name in roles]
+
+        log.info("Assuming roles\tcount=%s\tworkers=%s", len(wanted), workers)
+        results = pair.sessions(wanted, workers=workers)
+
+        session_cache = getattr(self.credential_path, "session_cache", None)
+        if session_cache is not None:
+            for role, creds, _ in results:
+                if creds is not None:
+                    session_cache.record(keys.provider, keys.idp_username, role.role_arn, pair.exports_for(creds), expires_epoch(creds))
+        return results
 
     def set_info(self, provider, role, idp_username):
         """Register our provider, account and idp_user details"""
@@ -1,24 +1,86 @@
 from credo.asker import ask_for_choice, ask_for_choice_or_new
 from credo.cred_types.environment import EnvironmentMixin
 from credo.versioning import has_git_abilities
-from credo.errors import UserQuit, RepoError
+from credo.helper import read_json_file, write_json_atomically, default_cache_dir
+from credo.errors import UserQuit, RepoError, Offline
 from credo.versioning import determine_driver
 from credo.pub_keys import PubKeySyncer
+from credo import background, connections
 
+from contextlib import contextmanager
+import threading
 import logging
+import time
 import os
 
 log = logging.getLogger("credo.structure.repository")
 
-def synchronize(repo_name, location, crypto):
+# Holds {location: ChangeBatch} as pending when this thread is inside batched_changes
+batching = threading.local()
+
+def pending_changes():
+    """Return the changes waiting for the end of batched_changes in this thread or None"""
+    return getattr(batching, "pending", None)
+
+@contextmanager
+def batched_changes():
+    """
+    Collect the changes made to repositories in this block
+
+    and commit them once per repository at the end
+    """
+    if pending_changes() is not None:
+        yield
+        return
+
+    batching.pending = {}
+    try:
+        yield
+    finally:
+        batches, batching.pending = batching.pending, None
+        for batch in batches.values():
+            batch.commit()
+
+class ChangeBatch(object):
+    """The messages and files for one commit"""
+    def __init__(self, driver):
+        self.driver = driver
+        self.messages = []
+        self.changed_files = []
+
+    def add(self, message, changed_files):
+        """Add a message and the files it changed"""
+        self.messages.append(message)
+        if changed_files is True or self.changed_files is True:
+            self.changed_files = True
+        else:
+            for filename in changed_files:
+                if filename not in self.changed_files:
+                    self.changed_files.append(filename)
+
+    @property
+    def message(self):
+        """Combine our messages into one commit message"""
+        if len(self.messages) == 1:
+            return self.messages[0]
+        return "{0} changes\n\n{1}".format(len(self.messages), "\n".join("* {0}".format(message) for message in self.messages))
+
+    def commit(self):
+        """Ask the driver to commit our changes"""
+        if self.messages:
+            self.driver.add_change(self.message, self.changed_files)
+            self.messages = []
+            self.changed_files = []
+
+def synchronize(repo_name, location, crypto, cache_dir=None):
     """Synchronise this repository"""
-    repository = Repository(repo_name, location, crypto)
+    repository = Repository(repo_name, location, crypto, cache_dir=cache_dir)
     if repository.versioned:
         repository.synchronize()
 
-def configure(repo_name, location, crypto, new_remote=None, version_with=None):
+def configure(repo_name, location, crypto, new_remote=None, version_with=None, cache_dir=None):
     """Configure a repository"""
-    repository = Repository(repo_name, location, crypto)
+    repository = Repository(repo_name, location, crypto, cache_dir=cache_dir)
     if repository.versioned:
         remote = "<none set>"
         if repository.remote:
@@ -64,20 +126,91 @@ def configure(repo_name, location, crypto, new_remote=None, version_with=None):
             repository.change_remote(new_remote, remote_type=version_with)
 
 class Repository(object, EnvironmentMixin):
-    """Understands how to version a directory"""
-    def __init__(self, name, location, crypto):
+    """
+    Understands how to version a directory
+
+    If sync_interval is None we synchronize whenever we are asked to, otherwise
+    we synchronize in the background at most every sync_interval seconds unless
+    we have made changes.
+
+    Things that aren't part of the repository, like when we last synchronized,
+    are kept in cache_dir, which defaults to ~/.credo.
+    """
+    def __init__(self, name, location, crypto, sync_interval=None, cache_dir=None):
         self.name = name
         self.crypto = crypto
         self.location = location
+        self.sync_interval = sync_interval
+        self.made_changes = False
 
         self.driver = determine_driver(location)
 
-        root_dir = os.path.join(os.path.dirname(self.location), "..")
-        self.pub_key_syncer = PubKeySyncer(root_dir, self)
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.pub_key_syncer = PubKeySyncer(self.cache_dir, self)
+
+    def synchronize(self, override=False, in_background=True):
+        """
+        Ask the driver to synchronize the folder
+
+        Overrides are always done straight away because the caller wants the result
+        """
+        self.commit_pending_changes()
+        if connections.is_offline():
+            if override:
+                raise Offline("Can't synchronize a repository", repo=self.name)
+            log.info("Not synchronizing while offline\trepo=%s", self.name)
+            if self.made_changes:
+                # Forget when we last synchronized so we do it as soon as we are online
+                self.record_synchronized(when=0)
+            return
+
+        if override or self.sync_interval is None:
+            self.driver.synchronize(override=override)
+            self.record_synchronized()
+            return
+
+        if not self.versioned or not self.remote:
+            return
+
+        last_synced = self.last_synchronized()
+        if not self.made_changes and last_synced and time.time() - last_synced < self.sync_interval:
+            log.debug("Synchronized recently enough\trepo=%s\tlast_synced=%s", self.name, last_synced)
+            return
+
+        self.record_synchronized()
+        self.made_changes = False
+        if in_background:
+            background.synchronize(self.location, log_location=os.path.join(self.cache_dir, "background.log"))
+        else:
+            self.driver.synchronize()
+
+    @property
+    def sync_times_location(self):
+        """Where we record when repositories were last synchronized"""
+        return os.path.join(self.cache_dir, "last_synced.json")
 
-    def synchronize(self, override=False):
-        """Ask the driver to synchronize the folder"""
-        self.driver.synchronize(override=override)
+    def last_synchronized(self):
+        """Return when we last synchronized or None"""
+        times = read_json_file(self.sync_times_location, {})
+        if isinstance(times, dict):
+            return times.get(os.path.abspath(self.location))
+
+    def record_synchronized(self, when=None):
+        """Record that we synchronized at this time, defaulting to now"""
+        if not self.versioned:
+            return
+
+        if when is None:
+            when = time.time()
+
+        times = read_json_file(self.sync_times_location, {})
+        if not isinstance(times, dict):
+            times = {}
+        times[os.path.abspath(self.location)] = when
+        try:
+            write_json_atomically(self.sync_times_location, times)
+        except (IOError, OSError) as error:
+            log.warning("Failed to record when we synchronized\tlocation=%s\terror=%s", self.sync_times_location, error)
 
     @property
     def path(self):
@@ -150,7 +283,11 @@ class Repository(object, EnvironmentMixin):
             self.driver.change_remote(choice)
 
     def add_change(self, message, changed_files, **info):
-        """Ask the driver to add the changed files and commit with the provided message"""
+        """
+        Ask the driver to add the changed files and commit with the provided message
+
+        Inside batched_changes the commit waits till the end of the block
+        """
         message_suffix = ", ".join("{0}={1}".format(key, val) for key, val in info.items())
         if message_suffix:
             message = "{0} ({1})".format(message, message_suffix)
@@ -162,5 +299,21 @@ class Repository(object, EnvironmentMixin):
             else:
                 changes.append(filename)
 
-        self.driver.add_change(message, changes)
+        pending = pending_changes()
+        if pending is None:
+            self.driver.add_change(message, changes)
+        else:
+            location = os.path.abspath(self.location)
+            if location not in pending:
+                pending[location] = ChangeBatch(self.driver)
+            pending[location].add(message, changes)
+        self.made_changes = True
+
+    def commit_pending_changes(self):
+        """Commit any changes that are waiting for the end of batched_changes"""
+        pending = pending_changes()
+        if pending:
+            batch = pending.pop(os.path.abspath(self.location), None)
+            if batch:
+                batch.commit()
 
@@ -0,0 +1,23 @@
+from credo.crypto import Crypto
+
+import paramiko
+import os
+
+class KeysAssertionsMixin:
+    def make_ssh_key(self, directory, name="id_rsa"):
+        """Write a new private key and it's public key into this directory and return the key"""
+        key = paramiko.RSAKey.generate(1024)
+        location = os.path.join(directory, name)
+        key.write_private_key_file(location)
+        with open("{0}.pub".format(location), "w") as fle:
+            fle.write("ssh-rsa {0}".format(key.get_base64()))
+        return key
+
+    def make_crypto(self, directory, names=("id_rsa", ), **kwargs):
+        """Make a Crypto that knows about new private and public keys with these names"""
+        for name in names:
+            self.make_ssh_key(directory, name)
+
+        crypto = Crypto(**kwargs)
+        crypto.find_keys(directory)
+        return crypto
@@ -0,0 +1,65 @@
+# coding: spec
+
+from credo.structure.credentials import SamlCredentials
+from credo.agent import Agent, AgentRequestHandler
+
+from tests.helpers import CredoCase
+
+from StringIO import StringIO
+import threading
+import mock
+import json
+import os
+
+describe CredoCase, "Agent":
+    it "unlocks the private keys before it starts serving":
+        with self.a_temp_dir() as directory:
+            agent = Agent(location=os.path.join(directory, "agent.sock"))
+            credo = mock.Mock(name="credo", config_file_location=os.path.join(directory, "config.json"))
+            credo.crypto.unlock.return_value = ["fingerprint1"]
+
+            server = mock.Mock(name="server")
+            server.serve_forever.side_effect = lambda: self.assertEqual(len(credo.crypto.unlock.mock_calls), 1)
+            with mock.patch("SocketServer.UnixStreamServer", return_value=server):
+                agent.start(credo)
+
+            server.serve_forever.assert_called_once_with()
+            self.assertIs(agent.crypto, credo.crypto)
+
+    it "responds without waiting for the work that comes after":
+        agent = Agent(location="/nonexistant/agent.sock")
+        after = mock.Mock(name="after")
+        agent.handle = mock.Mock(name="handle", return_value=({"status": "ok"}, after))
+
+        wfile = StringIO()
+        def setup(handler):
+            handler.rfile = StringIO('{"command": "exports"}\n')
+            handler.wfile = wfile
+
+        with mock.patch.object(AgentRequestHandler, "setup", setup), mock.patch.object(AgentRequestHandler, "finish", lambda handler: None):
+            AgentRequestHandler(mock.Mock(name="request"), "", mock.Mock(name="server", agent=agent))
+
+        self.assertEqual(json.loads(wfile.getvalue()), {"status": "ok"})
+        self.assertEqual(after.called, False)
+
+        worker = threading.Thread(target=agent.do_after_work)
+        worker.daemon = True
+        worker.start()
+        agent.after_work.join()
+        after.assert_called_once_with()
+
+    it "doesn't remember saml exports past the session they came from":
+        agent = Agent(location="/nonexistant/agent.sock")
+        agent.remember_crypto(mock.Mock(name="crypto"))
+
+        credo = mock.Mock(name="credo", stay_offline=False, half_life=None)
+        credo.make_chosen.return_value = mock.Mock(name="chosen", spec=SamlCredentials, path="repo1/account1/saml")
+        credo.make_chosen.return_value.shell_exports.return_value = [("AWS_SESSION_TOKEN", "token")]
+        credo.make_chosen.return_value.credential_path = mock.Mock(name="credential_path")
+        agent.make_credo = mock.Mock(name="make_credo", return_value=credo)
+
+        for _ in range(2):
+            response, _ = agent.handle_exports(repo="repo1", account="account1", user="saml")
+            self.assertEqual(response, {"status": "ok", "exports": [("AWS_SESSION_TOKEN", "token")], "path": "repo1/account1/saml"})
+        self.assertEqual(len(credo.make_chosen.mock_calls), 2)
+        self.assertEqual(agent.chosen, {})
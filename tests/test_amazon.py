@@ -0,0 +1,97 @@
+# coding: spec
+
+from credo.cred_types.saml import SamlRole
+from credo.errors import BadSamlProvider
+from credo.amazon import IamSaml
+from credo import connections
+
+from tests.helpers import CredoCase
+
+from textwrap import dedent
+import requests
+import boto
+import mock
+
+describe CredoCase, "Assuming many saml roles":
+    it "assumes every role with the one assertion and reports the ones that fail":
+        roles = [SamlRole("arn:aws:iam::{0}:saml-provider/idp".format(account), "arn:aws:iam::{0}:role/admin".format(account)) for account in ("111", "222", "333")]
+        pair = IamSaml("idp.example.com", "bob", "password")
+        pair._arns = roles
+        pair._assertion = "assertion"
+
+        denied = boto.exception.BotoServerError(403, "Forbidden")
+        def assume_role_with_saml(role_arn, principal_arn, saml_assertion, duration_seconds=None):
+            self.assertEqual(saml_assertion, "assertion")
+            if role_arn.startswith("arn:aws:iam::222"):
+                raise denied
+            return mock.Mock(name="assumed", credentials="creds for {0}".format(role_arn))
+
+        connection = mock.Mock(name="connection", assume_role_with_saml=assume_role_with_saml)
+        with mock.patch("credo.amazon.FixedSTSConnection", return_value=connection):
+            results = pair.sessions(workers=2)
+
+        self.assertEqual([(role.account_id, creds) for role, creds, _ in results]
+            , [("111", "creds for arn:aws:iam::111:role/admin"), ("222", None), ("333", "creds for arn:aws:iam::333:role/admin")]
+            )
+        self.assertIn("BotoServerError", results[1][2])
+
+    it "keeps going when assuming a role fails unexpectedly":
+        roles = [SamlRole("arn:aws:iam::{0}:saml-provider/idp".format(account), "arn:aws:iam::{0}:role/admin".format(account)) for account in ("111", "222", "333")]
+        pair = IamSaml("idp.example.com", "bob", "password")
+        pair._arns = roles
+        pair._assertion = "assertion"
+
+        def assume_role_with_saml(role_arn, principal_arn, saml_assertion, duration_seconds=None):
+            if role_arn.startswith("arn:aws:iam::111"):
+                raise requests.exceptions.ConnectionError("Connection refused")
+            return mock.Mock(name="assumed", credentials="creds for {0}".format(role_arn))
+
+        connection = mock.Mock(name="connection", assume_role_with_saml=assume_role_with_saml)
+        with mock.patch("credo.amazon.FixedSTSConnection", return_value=connection):
+            results = pair.sessions(workers=1)
+
+        self.assertEqual([(role.account_id, creds is None) for role, creds, _ in results], [("111", True), ("222", False), ("333", False)])
+        self.assertIn("ConnectionError", results[0][2])
+
+describe CredoCase, "Logging into a saml provider":
+    it "retries failures with backoff using the shared session":
+        body = dedent("""
+            <soap11:Envelope xmlns:soap11="http://schemas.xmlsoap.org/soap/envelope/"><soap11:Body>
+                <Attribute FriendlyName="Role"><AttributeValue>arn:aws:iam::111:saml-provider/idp,arn:aws:iam::111:role/admin</AttributeValue></Attribute>
+            </soap11:Body></soap11:Envelope>
+        """).strip()
+        responses = [mock.Mock(name="unavailable", status_code=503), mock.Mock(name="not_soap", status_code=200, content="<html>"), mock.Mock(name="ok", status_code=200, content=body)]
+        session = mock.Mock(name="session")
+        session.post.side_effect = responses
+
+        pair = IamSaml("idp.example.com", "bob", "password")
+        with mock.patch("credo.connections.session", return_value=session), mock.patch("time.sleep") as sleep:
+            self.assertEqual([role.role_arn for role in pair.arns], ["arn:aws:iam::111:role/admin"])
+
+        self.assertEqual(len(session.post.mock_calls), 3)
+        self.assertEqual(len(sleep.mock_calls), 2)
+        self.assertEqual(session.post.mock_calls[0][1], ("https://idp.example.com/idp/profile/SAML2/SOAP/ECP", ))
+
+    it "gives up when it runs out of time":
+        session = mock.Mock(name="session")
+        session.post.return_value = mock.Mock(name="unavailable", status_code=503)
+
+        pair = IamSaml("idp.example.com", "bob", "password")
+        with mock.patch("credo.connections.session", return_value=session), mock.patch("time.sleep"):
+            with mock.patch("random.uniform", return_value=100):
+                with self.assertRaises(BadSamlProvider):
+                    pair.arns
+        self.assertEqual(len(session.post.mock_calls), 1)
+
+    it "doesn't let each attempt wait longer than the time we have left":
+        session = mock.Mock(name="session")
+        session.post.return_value = mock.Mock(name="unavailable", status_code=503)
+
+        deadline = connections.Deadline(5)
+        with mock.patch("credo.connections.session", return_value=session), mock.patch("time.sleep"):
+            with mock.patch("random.uniform", return_value=0):
+                connections.post("https://sts.amazonaws.com", deadline=deadline)
+
+        self.assertEqual(len(session.post.mock_calls), 5)
+        for call in session.post.mock_calls:
+            self.assertLessEqual(call[2]["timeout"], 5)
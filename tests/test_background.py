@@ -0,0 +1,87 @@
+# coding: spec
+
+from credo.background import scheduled_recently, record_scheduled, forget_scheduled, rotate, rotate_name, main
+from credo.errors import NeedsInteraction, Offline
+from credo.overview import Credo
+
+from tests.helpers import CredoCase
+
+import mock
+import os
+
+describe CredoCase, "Scheduling background rotation":
+    it "only schedules the same thing once in the window":
+        with self.a_temp_dir() as directory:
+            self.assertEqual(scheduled_recently(directory, "thing", 60), False)
+            record_scheduled(directory, "thing", 60)
+            self.assertEqual(scheduled_recently(directory, "thing", 60), True)
+            self.assertEqual(scheduled_recently(directory, "other", 60), False)
+            self.assertEqual(scheduled_recently(directory, "thing", -1), False)
+
+            forget_scheduled(directory, "thing")
+            self.assertEqual(scheduled_recently(directory, "thing", 60), False)
+
+    it "starts a detached process when there is no agent":
+        with self.a_temp_dir() as directory:
+            with mock.patch("credo.agent.AgentClient.request", lambda *args, **kwargs: None):
+                with mock.patch("credo.background.run_detached") as run_detached:
+                    rotate("/config.json", "repo1", "account1", "user1", half_life=3600, cache_dir=directory)
+                    rotate("/config.json", "repo1", "account1", "user1", half_life=3600, cache_dir=directory)
+
+            run_detached.assert_called_once_with(
+                  ["rotate", "--repo", "repo1", "--account", "account1", "--user", "user1", "--config", "/config.json", "--half-life", "3600"]
+                , log_location=os.path.join(directory, "background.log")
+                )
+
+    it "doesn't remember scheduling a rotation that didn't start":
+        with self.a_temp_dir() as directory:
+            with mock.patch("credo.agent.AgentClient.request", lambda *args, **kwargs: None):
+                with mock.patch("credo.background.run_detached", return_value=False) as run_detached:
+                    self.assertEqual(rotate("/config.json", "repo1", "account1", "user1", cache_dir=directory), False)
+                    self.assertEqual(rotate("/config.json", "repo1", "account1", "user1", cache_dir=directory), False)
+
+            self.assertEqual(len(run_detached.mock_calls), 2)
+
+    it "leaves rotation to the background when the current keys are still usable":
+        with self.a_temp_dir() as directory:
+            credo = Credo()
+            credo.root_dir = os.path.join(directory, "repos")
+            credo.cache_dir = directory
+            credo.config_file_location = "/config.json"
+            credo.background_rotation = True
+
+            chosen = mock.Mock(name="chosen", requires_encryption=False)
+            chosen.keys.needs_rotation.return_value = True
+            chosen.keys.usable_until_rotated.return_value = True
+            chosen.keys.iam_pair.half_life = 3600
+            chosen.credential_path.repository.name = "repo1"
+            chosen.credential_path.account.name = "account1"
+            chosen.credential_path.user.name = "user1"
+
+            credo.find_credentials = mock.Mock(name="find_credentials", return_value=({}, []))
+            credo.credentials_from = mock.Mock(name="credentials_from", return_value=iter([chosen]))
+
+            with mock.patch("credo.background.rotate") as background_rotate:
+                self.assertIs(credo.make_chosen(rotate=True), chosen)
+
+            background_rotate.assert_called_once_with("/config.json", "repo1", "account1", "user1", half_life=3600, cache_dir=directory)
+            chosen.save.assert_called_once_with(half_life=None, rotate=False)
+            self.assertEqual(len(chosen.credential_path.repository.synchronize.mock_calls), 0)
+
+describe CredoCase, "Rotating in the background":
+    def run_rotate(self, directory, error):
+        """Run the background rotate task failing with this error and return whether it is still scheduled"""
+        record_scheduled(directory, rotate_name("repo1", "account1", "user1"), 600)
+        credo = mock.Mock(name="credo", cache_dir=directory)
+        with mock.patch("credo.overview.Credo", return_value=credo), mock.patch("credo.background.rotate_credentials", side_effect=error):
+            with self.assertRaises(SystemExit):
+                main(["rotate", "--repo", "repo1", "--account", "account1", "--user", "user1"])
+        return scheduled_recently(directory, rotate_name("repo1", "account1", "user1"), 600)
+
+    it "waits out retry_after when trying again straight away won't help":
+        with self.a_temp_dir() as directory:
+            self.assertEqual(self.run_rotate(directory, NeedsInteraction()), True)
+
+    it "lets the next command try again when the failure was transient":
+        with self.a_temp_dir() as directory:
+            self.assertEqual(self.run_rotate(directory, Offline()), False)
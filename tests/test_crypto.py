@@ -0,0 +1,182 @@
+# coding: spec
+
+from credo.crypto import Crypto, SSHKeys, SignatureCache
+from credo.errors import NoSuchFingerPrint, BadCypherText
+from credo.asker import get_response
+
+from tests.helpers import CredoCase
+
+from binascii import hexlify
+import paramiko
+import mock
+import json
+import os
+
+describe CredoCase, "Crypto envelopes":
+    it "encrypts once for all the public keys and decrypts with any of them":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory, ["one", "two"])
+            envelope = crypto.envelope({"a": "b"})
+
+            self.assertSortedEqual(envelope["secrets"].keys(), crypto.public_key_fingerprints)
+            self.assertEqual(len(envelope["verifier"]), 2)
+            self.assertEqual(crypto.decrypt_values({"envelope": envelope}, lambda data: True), {"a": "b"})
+
+    it "tries our other private keys when one of them can't decrypt the secret":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory, ["one", "two"])
+            envelope = crypto.envelope({"a": "b"})
+            broken = envelope["secrets"].keys()[0]
+
+            original = crypto.keys.decrypt
+            def decrypt(package, fingerprint, **info):
+                if fingerprint == broken:
+                    raise BadCypherText("Wrong key")
+                return original(package, fingerprint, **info)
+
+            with mock.patch.object(crypto.keys, "decrypt", decrypt):
+                self.assertEqual(crypto.decrypt_values({"envelope": envelope}, lambda data: True), {"a": "b"})
+
+                only_broken = dict(envelope, secrets={broken: envelope["secrets"][broken]})
+                self.assertRaises(BadCypherText, crypto.decrypt_values, {"envelope": only_broken}, lambda data: True)
+
+    it "only uses the fingerprints it is given":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory, ["one", "two"])
+            fingerprint = crypto.public_key_fingerprints[0]
+            envelope = crypto.envelope({"a": "b"}, fingerprints=[fingerprint])
+            self.assertEqual(envelope["secrets"].keys(), [fingerprint])
+
+    it "refuses data that has been swapped":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory, ["one"])
+            envelope = crypto.envelope({"a": "b"})
+            other = crypto.envelope({"c": "d"})
+            envelope["data"] = other["data"]
+            self.assertIs(crypto.decrypt_values({"envelope": envelope}, lambda data: True), None)
+
+    it "still decrypts the older fingerprinted format":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory, ["one", "two"])
+            fingerprints = json.loads(json.dumps(crypto.fingerprinted({"a": "b"})))
+            self.assertEqual(crypto.decrypt_values({"fingerprints": fingerprints}, lambda data: True), {"a": "b"})
+            self.assertEqual(crypto.decryptable_values({"fingerprints": fingerprints}), True)
+
+describe CredoCase, "Finding ssh keys with an index":
+    it "doesn't read keys that haven't changed":
+        with self.a_temp_dir() as directory:
+            folder = os.path.join(directory, "ssh")
+            os.makedirs(folder)
+            key = paramiko.RSAKey.generate(1024)
+            key.write_private_key_file(os.path.join(folder, "id_rsa"))
+            with open(os.path.join(folder, "other.pub"), "w") as fle:
+                fle.write("ssh-rsa {0}".format(paramiko.RSAKey.generate(1024).get_base64()))
+            with open(os.path.join(folder, "notes"), "w") as fle:
+                fle.write("not a key")
+
+            index_location = os.path.join(directory, "index.json")
+            first = SSHKeys(index_location=index_location)
+            first.find_keys(folder)
+
+            second = SSHKeys(index_location=index_location)
+            with mock.patch.object(second.collection, "make_rsakey", side_effect=AssertionError("Shouldn't read keys")):
+                second.find_keys(folder)
+
+            self.assertEqual(second.collection.private_fingerprints.keys(), first.collection.private_fingerprints.keys())
+            self.assertSortedEqual(second.collection.public_fingerprints.keys(), first.collection.public_fingerprints.keys())
+            self.assertEqual(second.collection.private_key_locations, first.collection.private_key_locations)
+
+            fingerprint = [fp for fp in first.collection.public_fingerprints if fp not in first.collection.private_fingerprints][0]
+            self.assertEqual(second.collection.public_rsaobj_for(fingerprint).get_base64(), first.collection.public_rsaobj_for(fingerprint).get_base64())
+
+    it "reads keys again when they change":
+        with self.a_temp_dir() as directory:
+            folder = os.path.join(directory, "ssh")
+            os.makedirs(folder)
+            location = os.path.join(folder, "thing.pub")
+            with open(location, "w") as fle:
+                fle.write("ssh-rsa {0}".format(paramiko.RSAKey.generate(1024).get_base64()))
+
+            index_location = os.path.join(directory, "index.json")
+            first = SSHKeys(index_location=index_location)
+            first.find_keys(folder)
+
+            with open(location, "w") as fle:
+                fle.write("ssh-rsa {0} with a comment".format(paramiko.RSAKey.generate(1024).get_base64()))
+
+            second = SSHKeys(index_location=index_location)
+            second.find_keys(folder)
+            self.assertEqual(len(second.collection.public_fingerprints), 1)
+            self.assertNotEqual(second.collection.public_fingerprints.keys(), first.collection.public_fingerprints.keys())
+
+    it "doesn't read a removed public key back in":
+        with self.a_temp_dir() as directory:
+            key = paramiko.RSAKey.generate(1024)
+            location = os.path.join(directory, "someone.pub")
+            with open(location, "w") as fle:
+                fle.write("ssh-rsa {0}".format(key.get_base64()))
+
+            crypto = Crypto()
+            collection = crypto.keys.collection
+            fingerprint = collection.make_fingerprint(key)
+            collection.add_known_public_key(fingerprint, location)
+            collection.remove_public_key(fingerprint)
+
+            self.assertRaises(NoSuchFingerPrint, collection.public_rsaobj_for, fingerprint)
+            self.assertNotIn(fingerprint, collection.public_fingerprints)
+            self.assertIs(collection.location_for_fingerprint(fingerprint), None)
+
+describe CredoCase, "Caching signature verification":
+    it "only verifies the same signature for the same content once":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "signature_cache.json")
+            crypto = self.make_crypto(directory, signature_cache=SignatureCache(location))
+            fingerprint, signature = crypto.create_signature("some content")
+
+            self.assertEqual(crypto.is_signature_valid("some content", fingerprint, signature), True)
+            self.assertEqual(crypto.is_signature_valid("other content", fingerprint, signature), False)
+            self.assertEqual(os.path.exists(location), False)
+            crypto.signature_cache.save()
+
+            crypto.signature_cache = SignatureCache(location)
+            self.assertEqual(len(crypto.signature_cache.verified), 1)
+            with mock.patch.object(crypto.keys.collection, "public_rsaobj_for", side_effect=AssertionError("Shouldn't verify again")):
+                self.assertEqual(crypto.is_signature_valid("some content", fingerprint, signature), True)
+            self.assertEqual(crypto.is_signature_valid("changed content", fingerprint, signature), False)
+
+    it "ignores a cache file that we didn't sign":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "signature_cache.json")
+            crypto = self.make_crypto(directory, signature_cache=SignatureCache(location))
+            fingerprint, signature = crypto.create_signature("some content")
+            crypto.signature_cache.record("some content", fingerprint, signature)
+            crypto.signature_cache.save()
+
+            with open(location) as fle:
+                contents = json.load(fle)
+            contents["verified"][crypto.signature_cache.key_for("forged content", fingerprint, signature)] = contents["verified"].values()[0]
+            with open(location, "w") as fle:
+                json.dump(contents, fle)
+
+            crypto.signature_cache = SignatureCache(location)
+            self.assertEqual(crypto.signature_cache.verified, {})
+            self.assertEqual(crypto.is_signature_valid("forged content", fingerprint, signature), False)
+
+    it "only saves when it can sign without asking for a password":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "signature_cache.json")
+            crypto = self.make_crypto(directory, signature_cache=SignatureCache(location))
+            key = paramiko.RSAKey.from_private_key_file(os.path.join(directory, "id_rsa"))
+            fingerprint = crypto.keys.collection.make_fingerprint(key)
+            signature = hexlify(str(key.sign_ssh_data("some content")))
+            self.assertEqual(crypto.is_signature_valid("some content", fingerprint, signature), True)
+
+            # Pretend the private key needs a password
+            locked = lambda fingerprint: get_response("Password for your private key", password=True)
+            with mock.patch.object(crypto.keys.collection, "private_rsaobj_for", locked), mock.patch("getpass.getpass", side_effect=AssertionError("Shouldn't ask for a password")):
+                crypto.signature_cache.save()
+            self.assertEqual(os.path.exists(location), False)
+
+            crypto.signature_cache.save()
+            with open(location) as fle:
+                self.assertEqual(len(json.load(fle)["verified"]), 1)
@@ -0,0 +1,29 @@
+# coding: spec
+
+from credo.cred_types.environment import EnvironmentFile
+
+from tests.helpers import CredoCase
+
+import mock
+import os
+
+describe CredoCase, "Decrypting environment files":
+    it "only decrypts the same environment once":
+        with self.a_temp_dir() as directory:
+            crypto = self.make_crypto(directory)
+
+            location = os.path.join(directory, "env.json")
+            env = EnvironmentFile(location, crypto, mock.Mock(name="owner", spec=[]))
+            env.add("ONE", "1")
+            env.save()
+
+            with mock.patch.object(crypto, "decrypt_values", wraps=crypto.decrypt_values) as decrypt_values:
+                self.assertEqual(EnvironmentFile.loaded_file_from(location, crypto, None)[0].exports(), [("ONE", "1")])
+                self.assertEqual(EnvironmentFile.loaded_file_from(location, crypto, None)[0].exports(), [("ONE", "1")])
+                self.assertEqual(len(decrypt_values.mock_calls), 1)
+
+                changed = EnvironmentFile.loaded_file_from(location, crypto, None)[0]
+                changed.add("TWO", "2")
+                changed.save()
+                self.assertEqual(EnvironmentFile.loaded_file_from(location, crypto, None)[0].exports(), [("ONE", "1"), ("TWO", "2")])
+                self.assertEqual(len(decrypt_values.mock_calls), 2)
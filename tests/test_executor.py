@@ -0,0 +1,44 @@
+# coding: spec
+
+from credo.executor import CliParser
+
+from tests.helpers import CredoCase
+
+from textwrap import dedent
+import subprocess
+import mock
+import json
+import sys
+
+describe CredoCase, "Starting the cli":
+    def imported_by(self, *argv):
+        """Run credo with these arguments in a new process and return (exit_code, heavy modules it imported)"""
+        script = dedent("""
+            import json
+            import sys
+            from credo import executor
+            code = 0
+            try:
+                executor.main(sys.argv[1:])
+            except SystemExit as error:
+                code = error.code
+            heavy = ("boto", "paramiko", "Crypto", "keyring", "requests", "tornado", "flask")
+            sys.stderr.write(json.dumps([code, sorted(set(name.split(".")[0] for name in sys.modules if name.split(".")[0] in heavy))]))
+        """)
+        process = subprocess.Popen([sys.executable, "-c", script] + list(argv), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        return json.loads(err.strip().split("\n")[-1])
+
+    it "doesn't import crypto or aws libraries for sourceable, unset and version":
+        self.assertEqual(self.imported_by("sourceable", "inject"), [0, []])
+        self.assertEqual(self.imported_by("sourceable", "show"), [1, []])
+        self.assertEqual(self.imported_by("unset"), [0, []])
+        self.assertEqual(self.imported_by("version"), [0, []])
+
+    it "only sets up logging once when the agent can't help":
+        parser = CliParser()
+        with mock.patch("credo.executor.setup_logging") as setup_logging:
+            with mock.patch("credo.executor.AgentClient.available", True), mock.patch("credo.executor.AgentClient.exports", return_value=None):
+                self.assertEqual(parser.forward_to_agent(["exports"]), False)
+            self.assertIs(parser.make_credo(["exports"], "exports", needs_credo=False), None)
+        setup_logging.assert_called_once_with(verbose=False, boto_debug=False)
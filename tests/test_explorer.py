@@ -1,12 +1,13 @@
 # coding: spec
 
-from credo.explorer import filtered, find_repo_structure, flatten
+from credo.explorer import filtered, find_repo_structure, flatten, list_directory, DirectoryIndex, find_direct_structure
 
 from tests.helpers import CredoCase
 
 from noseOfYeti.tokeniser.support import noy_sup_setUp
 import mock
 import json
+import time
 import os
 
 describe CredoCase, "find_repo_structure":
@@ -189,6 +190,85 @@ describe CredoCase, "find_repo_structure":
             self.assertJsonDictEqual(directory_structure, expected_structure)
             self.assertJsonDictEqual(shortened, expected_shortened)
 
+describe CredoCase, "DirectoryIndex":
+    def age(self, directory, seconds=60):
+        """Make all the directories look like they were changed a while ago"""
+        then = time.time() - seconds
+        for root, dirs, _ in os.walk(directory):
+            for name in dirs:
+                os.utime(os.path.join(root, name), (then, then))
+        os.utime(directory, (then, then))
+
+    it "gives the same structure as walking without an index":
+        with self.a_temp_dir() as directory:
+            self.touch_files(directory
+                , [ "repo1/account1/user1/credentials.json"
+                  , "repo1/account2/user1b/credentials.json"
+                  , "repo1/.git/HEAD"
+                  , "repo2/account4/user2/things"
+                  , "hmmm"
+                  ]
+                )
+            self.age(directory)
+
+            index = DirectoryIndex(os.path.join(directory, "..", "{0}.index".format(os.path.basename(directory))))
+            try:
+                self.assertEqual(find_repo_structure(directory, levels=3, index=index), find_repo_structure(directory, levels=3))
+                index.save()
+                self.assertEqual(find_repo_structure(directory, levels=3, index=DirectoryIndex(index.location)), find_repo_structure(directory, levels=3))
+            finally:
+                if os.path.exists(index.location):
+                    os.remove(index.location)
+
+    it "only lists directories that have changed":
+        with self.a_temp_dir() as directory:
+            self.touch_files(directory
+                , [ "repo1/account1/user1/credentials.json"
+                  , "repo2/account4/user2/credentials.json"
+                  ]
+                )
+            self.age(directory)
+
+            index = DirectoryIndex()
+            find_repo_structure(directory, levels=3, index=index)
+
+            self.touch_files(directory, ["repo1/account1/user3/credentials.json"])
+            self.age(os.path.join(directory, "repo1", "account1", "user3"))
+
+            with mock.patch("credo.explorer.list_directory", wraps=list_directory) as lister:
+                _, shortened = find_repo_structure(directory, levels=3, index=index)
+
+            self.assertEqual(sorted(call[0][0] for call in lister.call_args_list)
+                , [os.path.join(directory, "repo1", "account1"), os.path.join(directory, "repo1", "account1", "user3")]
+                )
+            self.assertEqual(sorted(shortened["repo1"]["account1"].keys()), ["user1", "user3"])
+
+describe CredoCase, "find_direct_structure":
+    it "gives the same chain as walking and filtering the whole structure":
+        with self.a_temp_dir() as directory:
+            self.touch_files(directory
+                , [ "repo1/account1/user1/credentials.json"
+                  , "repo1/account1/user2/credentials.json"
+                  , "repo2/account1/user1/credentials.json"
+                  ]
+                )
+
+            looking_for = ["repo1", "account1", "user1"]
+            directory_structure, shortened = find_direct_structure(directory, looking_for, required_files=["credentials.json"])
+            self.assertEqual(shortened, {"repo1": {"account1": {"user1": ["credentials.json"]}}})
+
+            full_structure, full_shortened = find_repo_structure(directory, levels=3)
+            mask = filtered(full_shortened, looking_for, required_files=["credentials.json"])
+            self.assertEqual(flatten(directory_structure, shortened), flatten(full_structure, mask))
+
+    it "returns None if it can't go straight to the path":
+        with self.a_temp_dir() as directory:
+            self.touch_files(directory, ["repo1/account1/user1/credentials.json", "repo1/account1/user2/other"])
+            self.assertIs(find_direct_structure(directory, ["repo1", "account1", None], required_files=["credentials.json"]), None)
+            self.assertIs(find_direct_structure(directory, ["repo1", "account*", "user1"], required_files=["credentials.json"]), None)
+            self.assertIs(find_direct_structure(directory, ["repo1", "account1", "user2"], required_files=["credentials.json"]), None)
+            self.assertIs(find_direct_structure(directory, ["repo1", "account1", "user3"], required_files=["credentials.json"]), None)
+
 describe CredoCase, "filtered":
     it "returns a copy":
         original = {"one": {"two": {"three": ["four"]}}}
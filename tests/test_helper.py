@@ -0,0 +1,116 @@
+# coding: spec
+
+from credo.helper import IdentityCache, SessionCache, write_aws_profiles
+from credo.cred_types.amazon import AmazonKeys
+from credo.amazon import IamPair
+
+from tests.helpers import CredoCase
+
+import ConfigParser
+import boto
+import mock
+import json
+import time
+import os
+
+describe CredoCase, "IdentityCache":
+    def make_cache(self, directory, ttl=None):
+        """Make an identity cache signed by a new private key"""
+        return IdentityCache(os.path.join(directory, "identity_cache.json"), self.make_crypto(directory), ttl=ttl)
+
+    it "remembers identities for the same access and secret key":
+        with self.a_temp_dir() as directory:
+            cache = self.make_cache(directory)
+            cache.record("AKID", "secret", "123456789012", "bob", ["an-alias"], create_epoch=20)
+
+            again = IdentityCache(cache.location, cache.crypto)
+            entry = again.lookup("AKID", "secret")
+            self.assertEqual((entry["account_id"], entry["username"], entry["aliases"], entry["create_epoch"]), ("123456789012", "bob", ["an-alias"], 20))
+            self.assertIs(again.lookup("AKID", "other_secret"), None)
+            self.assertIs(again.lookup("OTHER", "secret"), None)
+
+    it "doesn't trust entries that are too old or have been changed":
+        with self.a_temp_dir() as directory:
+            cache = self.make_cache(directory)
+            cache.record("AKID", "secret", "123456789012", "bob", [])
+
+            self.assertIs(IdentityCache(cache.location, cache.crypto, ttl=-1).lookup("AKID", "secret"), None)
+
+            with open(cache.location) as fle:
+                entries = json.load(fle)
+            entries["AKID"]["account_id"] = "999999999999"
+            with open(cache.location, "w") as fle:
+                json.dump(entries, fle)
+            self.assertIs(IdentityCache(cache.location, cache.crypto).lookup("AKID", "secret"), None)
+
+    it "lets an iam pair work without asking amazon":
+        with self.a_temp_dir() as directory:
+            cache = self.make_cache(directory)
+            cache.record("AKID", "secret", "123456789012", "bob", [])
+
+            pair = IamPair("AKID", "secret", identity_cache=cache)
+            pair._connection = mock.Mock(name="connection", get_user=mock.Mock(side_effect=AssertionError("Shouldn't ask amazon")))
+            self.assertEqual(pair.works, True)
+            self.assertEqual((pair.ask_amazon_for_account(), pair.ask_amazon_for_username()), ("123456789012", "bob"))
+
+    it "lets keys say they don't need rotating without decrypting them":
+        with self.a_temp_dir() as directory:
+            cache = self.make_cache(directory)
+            credential_path = mock.Mock(name="credential_path", identity_cache=cache)
+            credential_path.crypto.decrypt_values.side_effect = AssertionError("Shouldn't decrypt")
+
+            key_info = {"envelope": {"data": "d", "verifier": "v", "secrets": {}}, "create_epoch": time.time() - 60, "half_life": 3600}
+            keys = AmazonKeys([key_info], credential_path)
+            cache.record_key_infos([keys.keys[0].info_digest])
+            self.assertEqual(keys.needs_rotation(), False)
+
+            old = AmazonKeys([dict(key_info, create_epoch=time.time() - 7200)], credential_path)
+            cache.record_key_infos([old.keys[0].info_digest])
+            self.assertRaises(AssertionError, old.needs_rotation)
+
+            self.assertEqual(IdentityCache(cache.location, cache.crypto).key_info_verified(keys.keys[0].info_digest), True)
+            self.assertEqual(IdentityCache(cache.location, cache.crypto, ttl=-1).key_info_verified(keys.keys[0].info_digest), False)
+
+    it "forgets that a key worked when amazon rejects it":
+        with self.a_temp_dir() as directory:
+            cache = self.make_cache(directory)
+            cache.record_key_infos(["digest"])
+
+            pair = IamPair("AKID", "secret", identity_cache=cache, key_info_digest="digest")
+            rejected = boto.exception.BotoServerError(403, "Forbidden")
+            rejected.error_code = "InvalidClientTokenId"
+            pair._connection = mock.Mock(name="connection", get_user=mock.Mock(side_effect=rejected))
+            self.assertEqual(pair.works, False)
+            self.assertEqual(IdentityCache(cache.location, cache.crypto).key_info_verified("digest"), False)
+
+describe CredoCase, "SessionCache":
+    it "remembers exports encrypted until shortly before they expire":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "session_cache.json")
+            cache = SessionCache(location, self.make_crypto(directory), margin=300)
+            exports = [("AWS_ACCESS_KEY_ID", "ASIA"), ("AWS_SECRET_ACCESS_KEY", "sekret")]
+            cache.record("https://idp", "bob", "arn:aws:iam::123:role/admin", exports, time.time() + 3600)
+            cache.record("https://idp", "bob", "arn:aws:iam::123:role/reader", exports, time.time() + 200)
+
+            with open(location) as fle:
+                self.assertNotIn("sekret", fle.read())
+
+            again = SessionCache(location, cache.crypto, margin=300)
+            self.assertEqual(again.lookup("https://idp", "bob", "arn:aws:iam::123:role/admin"), exports)
+            self.assertIs(again.lookup("https://idp", "alice", "arn:aws:iam::123:role/admin"), None)
+            self.assertIs(again.lookup("https://idp", "bob", "arn:aws:iam::123:role/reader"), None)
+            self.assertEqual(len(again.entries), 1)
+
+describe CredoCase, "write_aws_profiles":
+    it "adds and updates profiles without touching the others":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "credentials")
+            with open(location, "w") as fle:
+                fle.write("[default]\naws_access_key_id = mine\n\n[111-admin]\naws_access_key_id = old\n")
+
+            write_aws_profiles(location, {"111-admin": {"aws_access_key_id": "new", "aws_session_token": "token"}})
+
+            parser = ConfigParser.RawConfigParser()
+            parser.read(location)
+            self.assertEqual(parser.get("default", "aws_access_key_id"), "mine")
+            self.assertEqual(dict(parser.items("111-admin")), {"aws_access_key_id": "new", "aws_session_token": "token"})
@@ -0,0 +1,54 @@
+# coding: spec
+
+from credo.pub_keys import PubKeySyncer, PemCache
+from credo.helper import write_json_atomically
+
+from tests.helpers import CredoCase
+
+import mock
+import json
+import time
+import os
+
+describe CredoCase, "Downloading pems":
+    def response(self, status_code, content="", headers=None):
+        return mock.Mock(name="response", status_code=status_code, content=content, headers=headers or {})
+
+    it "downloads missing urls at once and writes the cache once":
+        with self.a_temp_dir() as directory:
+            responses = {
+                  "https://one/keys": self.response(200, "ssh-rsa one\nnot a key\n", {"ETag": '"abc"'})
+                , "https://two/keys": self.response(200, "ssh-rsa two\n")
+                }
+            session = mock.Mock(name="session")
+            session.get.side_effect = lambda url, headers, timeout: responses[url]
+
+            syncer = PubKeySyncer(directory, mock.Mock(name="repository"))
+            with mock.patch("credo.connections.session", return_value=session), mock.patch("credo.pub_keys.write_json_atomically", wraps=write_json_atomically) as write:
+                pems = syncer.download_all_pems(["https://one/keys", "https://two/keys"])
+
+            self.assertEqual(pems, {"https://one/keys": ["ssh-rsa one"], "https://two/keys": ["ssh-rsa two"]})
+            self.assertEqual(len(write.mock_calls), 1)
+            self.assertEqual(json.load(open(syncer.cache_location))["etags"], {"https://one/keys": '"abc"'})
+
+    it "serves stale pems and revalidates them in the background":
+        with self.a_temp_dir() as directory:
+            location = os.path.join(directory, "cache")
+            with open(location, "w") as fle:
+                json.dump({"times": {"https://one/keys": time.time() - 7200}, "cached": {"https://one/keys": ["ssh-rsa old"]}, "etags": {"https://one/keys": '"abc"'}}, fle)
+
+            syncer = PubKeySyncer(directory, mock.Mock(name="repository"))
+            with mock.patch("credo.background.refresh_pems") as refresh_pems:
+                self.assertEqual(syncer.download_all_pems(["https://one/keys"]), {"https://one/keys": ["ssh-rsa old"]})
+            refresh_pems.assert_called_once_with(location, ["https://one/keys"])
+
+            session = mock.Mock(name="session")
+            session.get.return_value = self.response(304)
+            with mock.patch("credo.connections.session", return_value=session):
+                cache = PemCache(location)
+                cache.refresh(["https://one/keys"])
+                cache.save()
+
+            session.get.assert_called_once_with("https://one/keys", headers={"If-None-Match": '"abc"'}, timeout=10)
+            cache = PemCache(location)
+            self.assertEqual((cache.pems("https://one/keys"), cache.stale("https://one/keys")), (["ssh-rsa old"], False))
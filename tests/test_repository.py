@@ -0,0 +1,111 @@
+# coding: spec
+
+from credo.structure.repository import Repository, batched_changes
+from credo.connections import offline_mode
+from credo.overview import Credo
+from credo.errors import Offline
+
+from tests.helpers import CredoCase
+
+import mock
+import os
+
+describe CredoCase, "Synchronizing a repository":
+    def make_repository(self, directory, sync_interval=None):
+        """Make a repository with a fake versioned driver"""
+        location = os.path.join(directory, "repos", "repo1")
+        os.makedirs(location)
+        driver = mock.Mock(name="driver", versioned=True, remote="git@somewhere:repo")
+        with mock.patch("credo.structure.repository.determine_driver", lambda location: driver):
+            return Repository("repo1", location, mock.Mock(name="crypto"), sync_interval=sync_interval, cache_dir=directory), driver
+
+    it "synchronizes straight away without a sync_interval":
+        with self.a_temp_dir() as directory:
+            repository, driver = self.make_repository(directory)
+            with mock.patch("credo.background.synchronize") as background_synchronize:
+                repository.synchronize()
+            driver.synchronize.assert_called_once_with(override=False)
+            self.assertEqual(len(background_synchronize.mock_calls), 0)
+
+    it "synchronizes in the background at most every sync_interval unless there are changes":
+        with self.a_temp_dir() as directory:
+            repository, driver = self.make_repository(directory, sync_interval=600)
+            with mock.patch("credo.background.synchronize") as background_synchronize:
+                repository.synchronize()
+                self.assertEqual(len(background_synchronize.mock_calls), 1)
+                self.assertEqual(background_synchronize.call_args[0][0], repository.location)
+
+                repository.synchronize()
+                self.assertEqual(len(background_synchronize.mock_calls), 1)
+
+                repository.add_change("A change", ["credentials.json"])
+                repository.synchronize()
+                self.assertEqual(len(background_synchronize.mock_calls), 2)
+
+                repository.synchronize(override=True)
+                self.assertEqual(len(background_synchronize.mock_calls), 2)
+
+            driver.synchronize.assert_called_once_with(override=True)
+            self.assertEqual(os.path.exists(os.path.join(directory, "last_synced.json")), True)
+
+    it "doesn't synchronize while offline but does so as soon as it is online":
+        with self.a_temp_dir() as directory:
+            repository, driver = self.make_repository(directory, sync_interval=600)
+            with mock.patch("credo.background.synchronize") as background_synchronize:
+                repository.synchronize()
+                repository.add_change("A change", ["credentials.json"])
+                with offline_mode():
+                    repository.synchronize()
+                    self.assertRaises(Offline, repository.synchronize, override=True)
+                self.assertEqual(len(background_synchronize.mock_calls), 1)
+                self.assertEqual(repository.last_synchronized(), 0)
+
+                repository.made_changes = False
+                repository.synchronize()
+                self.assertEqual(len(background_synchronize.mock_calls), 2)
+            self.assertEqual(len(driver.synchronize.mock_calls), 0)
+
+    it "keeps the repository's caches in the configured cache_dir":
+        with self.a_temp_dir() as directory:
+            root_dir = os.path.join(directory, "repos")
+            os.makedirs(os.path.join(root_dir, "repo1", "account1", "user1"))
+
+            credo = Credo()
+            credo.root_dir, credo.repo, credo.account, credo.user = root_dir, "repo1", "account1", "user1"
+            credo.cache_dir = os.path.join(directory, "cache")
+            credo._crypto = mock.Mock(name="crypto")
+
+            user = credo.find_credential_path_part(find_user=True)
+            repository = user.credential_path.repository
+            self.assertEqual(repository.pub_key_syncer.cache_location, os.path.join(directory, "cache", "cache"))
+
+describe CredoCase, "Batching changes":
+    it "commits once per repository at the end of the block":
+        with self.a_temp_dir() as directory:
+            driver = mock.Mock(name="driver")
+            with mock.patch("credo.structure.repository.determine_driver", lambda location: driver):
+                repository = Repository("repo1", os.path.join(directory, "repo1"), mock.Mock(name="crypto"))
+                other = Repository("repo1", os.path.join(directory, "repo1"), mock.Mock(name="crypto"))
+
+            with batched_changes():
+                repository.add_change("Writing username", [os.path.join(directory, "repo1", "a", "b", "username")])
+                other.add_change("Writing account id", ["a/account_id"])
+                repository.add_change("Saving new keys", ["a/b/credentials.json", "a/account_id"])
+                self.assertEqual(len(driver.add_change.mock_calls), 0)
+
+            driver.add_change.assert_called_once_with(
+                  "3 changes\n\n* Writing username\n* Writing account id\n* Saving new keys"
+                , ["a/b/username", "a/account_id", "a/b/credentials.json"]
+                )
+
+    it "commits pending changes before synchronizing":
+        with self.a_temp_dir() as directory:
+            driver = mock.Mock(name="driver")
+            with mock.patch("credo.structure.repository.determine_driver", lambda location: driver):
+                repository = Repository("repo1", os.path.join(directory, "repo1"), mock.Mock(name="crypto"))
+
+            with batched_changes():
+                repository.add_change("Saving new keys", ["credentials.json"])
+                repository.synchronize()
+                self.assertEqual([call[0] for call in driver.mock_calls], ["add_change", "synchronize"])
+            self.assertEqual(len(driver.add_change.mock_calls), 1)
@@ -0,0 +1,97 @@
+# coding: spec
+
+from credo.rotation import FleetRotation, RotationResult
+
+from tests.helpers import CredoCase
+
+import threading
+import boto
+import mock
+import time
+
+describe CredoCase, "FleetRotation":
+    def make_credentials(self, account, user, rotate):
+        """Make something that looks like credentials for this account and user"""
+        credentials = mock.Mock(name="credentials", path="{0}|{1}".format(account, user))
+        credentials.credential_path.repository.name = "repo1"
+        credentials.credential_path.account.name = account
+        credentials.keys.needs_rotation.return_value = True
+        credentials.keys.iam_pair.half_life = 3600
+        credentials.keys.rotate.side_effect = rotate
+        credentials.keys.secret_fingerprints = set(["fingerprint1"])
+        return credentials
+
+    it "unlocks the private keys before the workers start, while it can still ask for passwords":
+        from credo import asker
+        unlocked = []
+        crypto = mock.Mock(name="crypto")
+        crypto.unlock.side_effect = lambda fingerprints: unlocked.append((sorted(fingerprints), asker.interactive))
+
+        credentials = [self.make_credentials("one", "user{0}".format(index), lambda half_life: unlocked.append("rotated")) for index in range(2)]
+        credentials[1].keys.secret_fingerprints = set(["fingerprint2"])
+        for creds in credentials:
+            creds.credential_path.crypto = crypto
+
+        FleetRotation(credentials, workers=2).run()
+        self.assertEqual(unlocked, [(["fingerprint1", "fingerprint2"], True), "rotated", "rotated"])
+
+    it "rotates everything with at most per_account workers in an account at once":
+        lock = threading.Lock()
+        active = {}
+        most = {}
+
+        def rotator(account):
+            def rotate(half_life):
+                with lock:
+                    active[account] = active.get(account, 0) + 1
+                    most[account] = max(most.get(account, 0), active[account])
+                time.sleep(0.05)
+                with lock:
+                    active[account] -= 1
+                return True
+            return rotate
+
+        credentials = [self.make_credentials(account, "user{0}".format(index), rotator(account)) for account in ("one", "two") for index in range(4)]
+        results = FleetRotation(credentials, workers=8, per_account=2).run()
+
+        self.assertEqual([result.status for result in results], ["rotated"] * 8)
+        self.assertEqual(most, {"one": 2, "two": 2})
+        for creds in credentials:
+            creds.keys.rotate.assert_called_once_with(3600)
+
+    it "works on other accounts while one account is at it's limit":
+        started = []
+
+        def rotator(account):
+            def rotate(half_life):
+                started.append(account)
+                time.sleep(0.05)
+                return True
+            return rotate
+
+        credentials = [self.make_credentials(account, "user{0}".format(index), rotator(account)) for account in ("one", "two") for index in range(3)]
+        results = FleetRotation(credentials, workers=2, per_account=1).run()
+
+        self.assertEqual([result.status for result in results], ["rotated"] * 6)
+        self.assertEqual(sorted(started[:2]), ["one", "two"])
+
+    it "backs off when amazon throttles and reports failures":
+        throttled = boto.exception.BotoServerError(400, "Bad Request")
+        throttled.error_code = "Throttling"
+        denied = boto.exception.BotoServerError(403, "Forbidden")
+        denied.error_code = "AccessDenied"
+
+        flaky = self.make_credentials("one", "flaky", [throttled, throttled, True])
+        broken = self.make_credentials("one", "broken", denied)
+        fine = self.make_credentials("two", "fine", None)
+        fine.keys.needs_rotation.return_value = False
+
+        with mock.patch("time.sleep") as sleep:
+            results = FleetRotation([flaky, broken, fine], half_life=60, workers=2).run()
+
+        self.assertEqual(len(sleep.mock_calls), 2)
+        self.assertEqual([(result.path, result.status) for result in results]
+            , [("one|broken", "failed"), ("one|flaky", "rotated"), ("two|fine", "unchanged")]
+            )
+        self.assertEqual(results[1], RotationResult("one|flaky", "rotated", None))
+        flaky.keys.rotate.assert_called_with(60)
@@ -0,0 +1,178 @@
+# coding: spec
+
+from credo.server.server import Server, ServedRole
+
+from tests.helpers import CredoCase
+
+from nose.plugins.skip import SkipTest
+from datetime import datetime, timedelta
+import mock
+import json
+
+try:
+    # Optional dependency is optional
+    from tornado.testing import AsyncHTTPTestCase
+    ServerCase = AsyncHTTPTestCase
+except ImportError:
+    AsyncHTTPTestCase = None
+    ServerCase = CredoCase
+
+def keys_expiring_in(seconds, access_key="AKID"):
+    expiration = (datetime.utcnow() + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return {"AccessKeyId": access_key, "Expiration": expiration}
+
+def served_role(server, name, keys):
+    """Put a role with these keys straight into the server"""
+    role = server.roles[name] = ServedRole(server, name, mock.Mock(name=name), "auth")
+    role.keys = keys
+    return role
+
+describe ServerCase, "Metadata server":
+    def setUp(self):
+        if AsyncHTTPTestCase is None:
+            raise SkipTest("Need tornado to test the metadata server")
+        self.server = Server("127.0.0.1", 80, mock.Mock(name="credo"))
+        super(TestMetadataServer, self).setUp()
+
+    def get_app(self):
+        return self.server.app
+
+    def put_token(self, **headers):
+        return self.fetch("/latest/api/token", method="PUT", body="", headers=headers)
+
+    it "gives out tokens with a ttl and accepts them":
+        response = self.put_token(**{"X-aws-ec2-metadata-token-ttl-seconds": "21600"})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["X-aws-ec2-metadata-token-ttl-seconds"], "21600")
+
+        token = response.body
+        response = self.fetch("/latest/meta-data/iam/security-credentials/", headers={"X-aws-ec2-metadata-token": token})
+        self.assertEqual((response.code, response.body), (200, "BaseIAMRole"))
+
+    it "refuses bad ttls, proxied requests and unknown or expired tokens":
+        self.assertEqual(self.put_token().code, 400)
+        self.assertEqual(self.put_token(**{"X-aws-ec2-metadata-token-ttl-seconds": "0"}).code, 400)
+        self.assertEqual(self.put_token(**{"X-aws-ec2-metadata-token-ttl-seconds": "21601"}).code, 400)
+        self.assertEqual(self.put_token(**{"X-aws-ec2-metadata-token-ttl-seconds": "60", "X-Forwarded-For": "1.2.3.4"}).code, 403)
+
+        self.assertEqual(self.fetch("/latest/meta-data/", headers={"X-aws-ec2-metadata-token": "nope"}).code, 401)
+
+        token = self.put_token(**{"X-aws-ec2-metadata-token-ttl-seconds": "1"}).body
+        self.server.tokens[token] -= 2
+        self.assertEqual(self.fetch("/latest/meta-data/", headers={"X-aws-ec2-metadata-token": token}).code, 401)
+
+    it "still answers requests without a token":
+        response = self.fetch("/latest/meta-data/")
+        self.assertEqual((response.code, response.body), (200, "iam\nswitch"))
+        self.assertEqual(self.fetch("/nope").code, 404)
+
+    it "serves several roles at once without assuming them while their keys are fresh":
+        self.assertEqual(self.fetch("/latest/meta-data/iam/security-credentials/").body, "BaseIAMRole")
+        self.assertEqual(json.loads(self.fetch("/latest/meta-data/iam/security-credentials/BaseIAMRole").body), {"error": "DO SWITCH"})
+
+        keys = {"admin": keys_expiring_in(3600, "ADMIN"), "reader": keys_expiring_in(3600, "READER")}
+        with mock.patch.object(self.server, "assume_role", lambda saml_info, basic_auth: keys[saml_info]):
+            self.server.switch("admin", "auth", "admin")
+            self.server.switch("reader", "auth", "reader")
+
+        self.assertEqual(self.fetch("/latest/meta-data/iam/security-credentials/").body, "admin\nreader")
+        with mock.patch.object(self.server, "assume_role") as assume_role:
+            for name, access_key in (("admin", "ADMIN"), ("reader", "READER")):
+                response = self.fetch("/latest/meta-data/iam/security-credentials/{0}".format(name))
+                self.assertEqual(json.loads(response.body)["AccessKeyId"], access_key)
+        self.assertEqual(len(assume_role.mock_calls), 0)
+        self.assertEqual(self.fetch("/latest/meta-data/iam/security-credentials/BaseIAMRole").code, 404)
+
+    it "switches roles from a small json message":
+        url = "/latest/meta-data/switch/"
+        request = {"provider": "https://idp/ecp", "idp_username": "bob", "principal_arn": "arn:aws:iam::123:saml-provider/idp", "role_arn": "arn:aws:iam::123:role/admin"}
+
+        self.assertEqual(json.loads(self.fetch(url, method="POST", body=json.dumps(request)).body), {"error": "NEED_AUTH"})
+        self.assertEqual(self.fetch(url, method="POST", body="{}").code, 400)
+
+        request.update(basic_auth="auth", role_name="admin")
+        with mock.patch.object(self.server, "assume_role", return_value=keys_expiring_in(3600)) as assume_role:
+            response = self.fetch(url, method="POST", body=json.dumps(request))
+        self.assertEqual((response.code, response.body), (200, "success"))
+
+        saml_info = assume_role.mock_calls[0][1][0]
+        self.assertEqual((saml_info.provider, saml_info.idp_username, saml_info.role.role_name), ("https://idp/ecp", "bob", "admin"))
+        self.assertEqual(sorted(self.server.roles), ["admin"])
+
+describe ServerCase, "Container credentials server":
+    def setUp(self):
+        if AsyncHTTPTestCase is None:
+            raise SkipTest("Need tornado to test the metadata server")
+        self.server = Server("127.0.0.1", 9911, mock.Mock(name="credo"), container=True, auth_token="sekret")
+        super(TestContainerCredentialsServer, self).setUp()
+
+    def get_app(self):
+        return self.server.app
+
+    it "serves keys by role name to clients with the auth token":
+        served_role(self.server, "BaseIAMRole", keys_expiring_in(3600, "AKID"))
+        self.assertEqual(self.server.container_credentials_uri(), "http://127.0.0.1:9911/credentials/BaseIAMRole")
+
+        response = self.fetch("/credentials/BaseIAMRole", headers={"Authorization": "sekret"})
+        self.assertEqual(json.loads(response.body)["AccessKeyId"], "AKID")
+
+        self.assertEqual(self.fetch("/credentials/BaseIAMRole").code, 401)
+        self.assertEqual(self.fetch("/credentials/BaseIAMRole", headers={"Authorization": "nope"}).code, 401)
+        self.assertEqual(self.fetch("/latest/meta-data/iam/security-credentials/").code, 404)
+
+    it "only switches roles for clients with the auth token":
+        url = "/latest/meta-data/switch/"
+        request = json.dumps({"provider": "https://idp/ecp", "idp_username": "bob", "principal_arn": "arn:aws:iam::123:saml-provider/idp", "role_arn": "arn:aws:iam::123:role/admin"})
+
+        self.assertEqual(self.fetch(url, method="POST", body=request).code, 401)
+        self.assertEqual(self.fetch(url, method="POST", body=request, headers={"Authorization": "nope"}).code, 401)
+        response = self.fetch(url, method="POST", body=request, headers={"Authorization": "sekret"})
+        self.assertEqual(json.loads(response.body), {"error": "NEED_AUTH"})
+
+describe CredoCase, "Refreshing metadata server keys":
+    it "refreshes keys before they expire without making requests wait":
+        server = Server("127.0.0.1", 80, mock.Mock(name="credo"), refresh_margin=300)
+        role = served_role(server, "BaseIAMRole", keys_expiring_in(200))
+        other = served_role(server, "other", keys_expiring_in(3600, "OTHER"))
+
+        self.assertLess(server.seconds_until_refresh(), 0)
+        with mock.patch.object(server, "assume_role", return_value=keys_expiring_in(3600, "NEW")) as assume_role:
+            self.assertEqual(role.keys["AccessKeyId"], "AKID")
+            self.assertEqual(len(assume_role.mock_calls), 0)
+
+            self.assertEqual(server.refresh(), True)
+            assume_role.assert_called_once_with(role.saml_info, "auth")
+
+        self.assertEqual(role.keys["AccessKeyId"], "NEW")
+        self.assertEqual(other.keys["AccessKeyId"], "OTHER")
+        self.assertGreater(server.seconds_until_refresh(), 3000)
+
+    it "doesn't replace keys for a role that was switched during the refresh":
+        server = Server("127.0.0.1", 80, mock.Mock(name="credo"))
+        role = served_role(server, "BaseIAMRole", keys_expiring_in(10))
+
+        def switch_while_assuming(saml_info, basic_auth):
+            served_role(server, "BaseIAMRole", keys_expiring_in(3600, "SWITCHED"))
+            return keys_expiring_in(3600, "STALE")
+
+        with mock.patch.object(server, "assume_role", switch_while_assuming):
+            self.assertEqual(server.refresh(), False)
+        self.assertEqual(server.roles["BaseIAMRole"].keys["AccessKeyId"], "SWITCHED")
+
+    it "stops trying to refresh a role once it's password is too old":
+        server = Server("127.0.0.1", 80, mock.Mock(name="credo"))
+        role = served_role(server, "BaseIAMRole", keys_expiring_in(10))
+        role._basic_auth_time -= timedelta(hours=5)
+
+        self.assertIs(server.seconds_until_refresh(), None)
+        with mock.patch.object(server, "assume_role") as assume_role:
+            self.assertEqual(server.refresh(), True)
+        self.assertEqual(len(assume_role.mock_calls), 0)
+
+    it "assumes the role when a request finds the keys expired":
+        server = Server("127.0.0.1", 80, mock.Mock(name="credo"))
+        role = served_role(server, "BaseIAMRole", keys_expiring_in(-10))
+
+        with mock.patch.object(server, "assume_role", return_value=keys_expiring_in(3600, "NEW")):
+            self.assertEqual(role.keys["AccessKeyId"], "NEW")
+        self.assertEqual(server.refresh_wanted.is_set(), True)